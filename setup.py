@@ -9,7 +9,7 @@ setup(name='vmup',
       license='ISC',
       url='https://github.com/directman12/vmup',
       packages=['vmup'],
-      scripts=['vmup.py'],
+      scripts=['vmup.py', 'vmupd.py'],
       install_requires=['xmlmapper', 'libvirt-python', 'requests'],
       keywords='libvirt virtualization kvm',
       classifiers=[
@@ -0,0 +1,74 @@
+import base64
+import json
+import logging
+import time
+
+import libvirt
+import libvirt_qemu
+
+LOG = logging.getLogger(__name__)
+
+# the channel that the guest agent listens on
+AGENT_CHANNEL = 'org.qemu.guest_agent.0'
+
+
+def command(dom, cmd, timeout=10, **kwargs):
+    req = {'execute': cmd}
+    if kwargs:
+        req['arguments'] = {k.replace('_', '-'): v for k, v in kwargs.items()}
+
+    res = libvirt_qemu.qemuAgentCommand(dom, json.dumps(req), timeout, 0)
+    return json.loads(res).get('return')
+
+
+def wait_for_agent(dom, timeout=300):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            command(dom, 'guest-ping')
+            return
+        except libvirt.libvirtError:
+            if time.time() > deadline:
+                raise
+
+            time.sleep(1)
+
+
+def run(dom, argv, wait=True, timeout=600):
+    res = command(dom, 'guest-exec', path=argv[0], arg=argv[1:],
+                  capture_output=wait)
+    pid = res['pid']
+
+    if not wait:
+        return pid, None, None
+
+    deadline = time.time() + timeout
+    while True:
+        status = command(dom, 'guest-exec-status', pid=pid)
+        if status['exited']:
+            break
+
+        if time.time() > deadline:
+            raise Exception("Command %s did not finish in the guest "
+                            "after %s seconds" % (argv, timeout))
+
+        time.sleep(0.5)
+
+    out = base64.b64decode(status.get('out-data', '')).decode()
+    err = base64.b64decode(status.get('err-data', '')).decode()
+    return status.get('exitcode'), out, err
+
+
+def wait_for_cloud_init(dom, timeout=600):
+    start = time.time()
+    wait_for_agent(dom, timeout)
+
+    LOG.debug("Guest agent is up, waiting for cloud-init to finish...")
+    remaining = max(timeout - (time.time() - start), 1)
+    code, out, err = run(dom, ['cloud-init', 'status', '--wait'],
+                         timeout=remaining)
+    if code != 0:
+        raise Exception("cloud-init did not finish cleanly: %s" %
+                        (out or err).strip())
+
+    return time.time() - start
@@ -1,15 +1,25 @@
 import base64
+from concurrent import futures
 import configparser
+import copy
 import crypt
+import functools
+import hashlib
 import logging
 import os.path
 import pkg_resources
 import random
 import re
+import shutil
 
 import libvirt
 from lxml import etree
 
+from vmup import agent
+from vmup import images
+from vmup import ipam
+from vmup import kernelboot
+from vmup import pkgcache
 from vmup import virxml as vx
 from vmup import notacloud as nac
 from vmup import disk as disk_helper
@@ -20,75 +30,191 @@ libvirt.registerErrorHandler(lambda c, e: None, None)
 
 LOG = logging.getLogger(__name__)
 
+# options to configure_networking which control the virtio-net
+# device itself (offloads are passed as 'host_X' and 'guest_X')
+_NET_TUNING_OPTS = ('driver', 'queues', 'mtu',
+                    'rx_queue_size', 'tx_queue_size')
+
+# the options extra disks may set (see 'vmup --disk')
+DISK_OPTS = ('fmt', 'cache', 'io', 'discard')
+
+# these live for the life of the process, so that long-running
+# users (like vmupd) don't have to reconnect or reparse every time
+_CONNECTIONS = {}
+_TEMPLATES = {}
+
+# the namespace for vmup's own domain metadata
+METADATA_NS = 'https://github.com/directxman12/vmup'
+
+# where ephemeral VMs keep their disks and seeds (a tmpfs, so that
+# throwaway VMs never touch the image pool), one dir per VM
+SCRATCH_DIR = '/dev/shm/vmup'
+
+
+def scratch_path(name, scratch_dir=SCRATCH_DIR):
+    return os.path.join(scratch_dir, name)
+
+
+def get_connection(uri):
+    conn = _CONNECTIONS.get(uri)
+    if conn is None or not conn.isAlive():
+        conn = libvirt.open(uri)
+        _CONNECTIONS[uri] = conn
+
+    return conn
+
+
+def domain_metadata(dom):
+    try:
+        meta = dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                            METADATA_NS,
+                            libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+    except libvirt.libvirtError as ex:
+        if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+            return etree.Element('seed')
+        else:
+            raise
+
+    return etree.fromstring(meta)
+
+
+def lookup_domain(conn, name):
+    # like conn.lookupByName, but also finds running warm pool spares
+    # claimed under the given name (see warmpool), since those keep the
+    # spare's own domain name
+    try:
+        return conn.lookupByName(name)
+    except libvirt.libvirtError as ex:
+        if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+            raise
+
+        for dom in conn.listAllDomains():
+            if domain_metadata(dom).get('claimed') == name:
+                return dom
+
+        raise
+
+
+def _load_template(path='.vmup.template.xml'):
+    if os.path.exists(path):
+        path = os.path.abspath(path)
+        key = (path, os.path.getmtime(path))
+    else:
+        key = None
+
+    if key not in _TEMPLATES:
+        if key is not None:
+            with open(path) as templ_file:
+                templ = templ_file.read()
+        else:
+            templ = pkg_resources.resource_string(__name__, "template.xml")
+
+        # use a different parser to ensure pretty-printing works
+        parser = etree.XMLParser(remove_blank_text=True)
+        _TEMPLATES[key] = etree.fromstring(templ, parser=parser)
+
+    return copy.deepcopy(_TEMPLATES[key])
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_repo_file(contents):
+    # NB: the same repo files get used over and over (especially in vmupd),
+    #     so only parse each one once
+    c = configparser.ConfigParser()
+    c.read_string(contents)
+
+    return tuple((section, tuple(c[section].items()))
+                 for section in c.sections())
+
+
+def resolve_image_dir(conn, image_dir):
+    # returns ('pool', pool) for 'POOL:name', otherwise ('file', path)
+    if image_dir[:5].lower() != 'pool:':
+        return 'file', image_dir
+
+    pool_name = image_dir[5:]
+    try:
+        return 'pool', conn.storagePoolLookupByName(pool_name)
+    except libvirt.libvirtError as ex:
+        if ex.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_POOL:
+            raise ValueError("No such storage pool '%s'" % pool_name)
+        else:
+            raise
+
 
 class VM(vx.Domain):
     def __init__(self, hostname, image_dir='POOL:default',
-                 conn_uri=None):
+                 conn_uri=None, template='.vmup.template.xml'):
         self._hostname = hostname
 
         self._conn_uri = conn_uri
         self._conn_obj = None
 
-        self._img_loc = image_dir
-        self._img_loc_type = 'file'
-        if image_dir[:5].lower() == 'pool:':
-            pool_name = image_dir[5:]
-            try:
-                self._img_loc = self._conn.storagePoolLookupByName(pool_name)
-            except libvirt.libvirtError as ex:
-                if ex.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_POOL:
-                    raise ValueError("No such storage pool '%s'" % pool_name)
-                else:
-                    raise
+        self._img_loc_type, self._img_loc = resolve_image_dir(self._conn,
+                                                              image_dir)
 
-            self._img_loc_type = 'pool'
+        # where the VM's own disks and seed go (see make_ephemeral)
+        self._disk_loc_type, self._disk_loc = (self._img_loc_type,
+                                               self._img_loc)
+        self._transient = False
 
         self._existing_mac = None
 
-        self._disk_cnt = 0
+        # maps disk sources to their target devices in the existing
+        # domain, so that re-runs keep the same device names
+        self._existing_targets = {}
+        self._used_targets = set()
 
         self._net_config = []
 
-        if os.path.exists('.vmup.template.xml'):
-            with open('.vmup.template.xml') as templ_file:
-                templ = templ_file.read()
-        else:
-            templ = pkg_resources.resource_string(__name__, "template.xml")
-        # use a different parser to ensure pretty-printing works
-        parser = etree.XMLParser(remove_blank_text=True)
-        super(VM, self).__init__(etree.fromstring(templ, parser=parser))
+        self._seed_digest = None
+        # the passwords behind the hashes in the userdata (see seed_digest)
+        self._password_hashes = {}
+
+        self._pkg_cache_url = None
+        self._seed_server = None
+
+        # the VM's address, if known ahead of time
+        self.ip_address = None
+        self._ipam = None
+
+        super(VM, self).__init__(_load_template(template))
 
         self.name = hostname.replace('.', '-')
 
+        # NB: the cloud-init modules get trimmed down to what the user-data
+        #     actually uses (see nac.BOOT_PROFILES)
         self.userdata = nac.UserData()
 
-        # NB: did you know that write_files runs *before* 'create-users'?
-        #     this makes the owner field pretty much worthless.
-        #     Lets move that after, shall we?
-        self.userdata.cloud_init_modules = [  # HAX
-            'migrator', 'bootcmd', 'growpart', 'resizefs', 'set_hostname',
-            'update_hostname', 'update_etc_hosts', 'rsyslog', 'users-groups',
-            'write-files', 'ssh']
-
-        # In fact, while we're at it, let's trim out what we don't need...
-        self.userdata.cloud_config_modules = [
-            'mounts', 'locale', 'set-passwords', 'yum-add-repo', 'package-update-upgrade-install',
-            'timezone', 'disable-ec2-metadata', 'runcmd']
-
-        self.cloud_final_modules = [
-            'scripts-per-once', 'scripts-per-boot', 'scripts-per-instance', 'scripts-user',
-            'ssh-authkey-fingerprints', 'keys-to-console']
-
-    def fetch_base_image(self, source, always_fetch=False):
-        # fetch the base image
+    def fetch_base_image(self, source, always_fetch=False, normalize=None,
+                         peers=()):
+        # fetch the base image (if there's no local copy)
         if self._img_loc_type == 'pool':
             _, backing_file = disk_helper.fetch_image(
-                source, pool=self._img_loc,
-                check_local=not always_fetch)
+                source, pool=self._img_loc, normalize=normalize, peers=peers)
         else:
             _, backing_file = disk_helper.fetch_image(
-                source, img_dir=self._img_loc,
-                check_local=not always_fetch)
+                source, img_dir=self._img_loc, normalize=normalize,
+                peers=peers)
+
+        # NB: updating images happens in the background (see 'vmup images
+        #     sync'), so always_fetch just means "make sure it's fresh"
+        if not source.startswith('/'):
+            # NB: this only feeds eviction, so it's no reason to fail
+            try:
+                images.record_use(backing_file)
+            except (OSError, ValueError) as ex:
+                LOG.warning("Unable to record the use of '%s': %s" %
+                            (backing_file, ex))
+
+            fresh = images.freshness(source, backing_file)
+            if always_fetch and fresh.stale:
+                LOG.warning("Base image for '%s' may be out of date (%s), "
+                            "try 'vmup images sync %s'" %
+                            (source, fresh.summary, source))
+            else:
+                LOG.debug("Base image for '%s': %s" %
+                          (source, fresh.summary))
 
         return backing_file
 
@@ -112,6 +238,12 @@ class VM(vx.Domain):
         else:
             self._existing_mac = None
 
+        self._existing_targets = {}
+        for disk in dom_view.disks:
+            source = self._disk_source(disk)
+            if source is not None:
+                self._existing_targets[source] = disk.target.split(':')[1]
+
         LOG.info("Reusing existing UUID '%s' and MAC address '%s'..." %
                  (self.uuid, self._existing_mac))
 
@@ -162,6 +294,7 @@ class VM(vx.Domain):
             else:
                 args['lock_password'] = False
                 args['password_hash'] = crypt.crypt(password)
+                self._password_hashes[args['password_hash']] = password
 
             args['groups'] = groups
             args['ssh_authorized_keys'] = authorized_keys
@@ -175,49 +308,244 @@ class VM(vx.Domain):
         # don't force the user to immediately reset the password
         self.userdata.set_passwords(expire=False)
 
-    def finalize(self, recreate_ci=False):
+    def finalize(self, recreate_ci=False, write_seed=True):
         if self._net_config:
             self._net_config.extend(['auto lo', 'iface lo inet loopback'])
 
-        self._make_cloud_init(overwrite=recreate_ci)
+        if write_seed:
+            self.write_seed(overwrite=recreate_ci)
+
+        if self._seed_server is None:
+            self.disks.append(self._ci_disk_conf())
+
         return self.to_xml(pretty_print=True, encoding=str)
 
+    def seed_digest(self):
+        # NB: this skips the instance id, which changes every time
+        seed = nac.get_userdata(self.userdata) + '\n'.join(self._net_config)
+        seed += self._hostname
+
+        # NB: crypt picks a random salt each time, so go by the passwords
+        #     themselves instead of their hashes
+        for password_hash, password in self._password_hashes.items():
+            seed = seed.replace(password_hash, password)
+
+        return hashlib.sha256(seed.encode()).hexdigest()
+
+    def _existing_metadata(self, dom):
+        return domain_metadata(dom)
+
+    def _update_metadata(self, dom, **attrs):
+        meta = self._existing_metadata(dom)
+        for attr, val in attrs.items():
+            meta.set(attr, val)
+
+        dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                        etree.tostring(meta, encoding=str),
+                        'vmup', METADATA_NS,
+                        libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+    def existing_seed_digest(self, dom):
+        return self._existing_metadata(dom).get('digest')
+
+    def record_seed_digest(self, dom):
+        if self._seed_digest is None:
+            return
+
+        self._update_metadata(dom, digest=self._seed_digest)
+
+    def existing_config_digest(self, dom):
+        # the digest of the XML the domain was last defined from
+        return self._existing_metadata(dom).get('config')
+
+    def config_digest(self, xml=None, skip=()):
+        # NB: this skips what gets generated or reused from the existing
+        #     domain (the UUID, MACs, and device addresses), so that the
+        #     same configuration always gives the same digest
+        # (skip is any other elements to leave out, as paths)
+        if xml is None:
+            xml = self.to_xml(encoding=str)
+
+        desc = etree.fromstring(
+            xml, etree.XMLParser(remove_blank_text=True))
+        generated = (desc.findall('uuid') + desc.findall('metadata') +
+                     desc.findall('devices/interface/mac') +
+                     desc.findall('devices/*/address'))
+        for path in skip:
+            generated.extend(desc.findall(path))
+
+        for elem in generated:
+            elem.getparent().remove(elem)
+
+        return hashlib.sha256(
+            etree.tostring(desc, method='c14n')).hexdigest()
+
+    def record_config_digest(self, dom, xml=None):
+        self._update_metadata(dom, config=self.config_digest(xml))
+
+    def make_ephemeral(self, scratch_dir=SCRATCH_DIR):
+        # Keep the disks and seed in a scratch dir instead of the image
+        # dir or pool (base images still come from there), and only ever
+        # run the VM as a transient domain.  Once it stops, everything
+        # gets cleaned up (see ephemeral.watch).
+        if self._lookup_domain() is not None:
+            raise ValueError("VM '%s' already exists, and ephemeral VMs "
+                             "can't replace existing ones" % self.name)
+
+        path = scratch_path(self.name, scratch_dir)
+        os.makedirs(path, exist_ok=True)
+
+        self._disk_loc_type, self._disk_loc = 'file', path
+        self._transient = True
+
     def launch(self, xml=None, redefine=None, start=True):
         if xml is None:
             xml = self.to_xml(pretty_print=True, encoding=str)
 
+        config_digest = self.config_digest(xml)
+
         dom = self._lookup_domain()
 
+        if self._transient:
+            self._launch_transient(dom, xml)
+            return
+
+        # NB: starting a domain with a managed save image restores it,
+        #     which is only right if it's still configured the same way
+        # (domains from before digests were recorded get the benefit of
+        # the doubt)
+        if dom is not None and dom.hasManagedSaveImage(0):
+            existing_digest = self.existing_config_digest(dom)
+            if redefine or existing_digest not in (None, config_digest):
+                LOG.info("VM configuration changed, discarding its saved "
+                         "state...")
+                dom.managedSaveRemove(0)
+            elif start:
+                LOG.info("Restoring VM from its saved state...")
+
+        # NB: libvirt refuses to undefine a domain with snapshots (like
+        #     the one from 'vmup checkpoint'), so drop their metadata
+        #     along with it, and put it back once the domain is redefined
+        snapshots = []
         if redefine and dom is not None:
             LOG.debug("Undefining existing VM...")
-            dom.undefine()
+            snapshots = [
+                (snap.getXMLDesc(0), snap.isCurrent(0))
+                for snap in dom.listAllSnapshots(
+                    libvirt.VIR_DOMAIN_SNAPSHOT_LIST_TOPOLOGICAL)]
+            dom.undefineFlags(
+                libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
+                libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE)
             dom = None
 
         if dom is None:
             LOG.debug("Defining new VM...")
             dom = self._conn.defineXML(xml)
+            self._update_metadata(dom, config=config_digest)
+
+        for snap_xml, current in snapshots:
+            flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REDEFINE
+            if current:
+                flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_CURRENT
+            dom.snapshotCreateXML(snap_xml, flags)
+
+        self.record_seed_digest(dom)
+
+        # make sure the DHCP reservation is in place before the first boot
+        if self._ipam is not None:
+            self._ipam.commit()
 
         if start and dom is not None:
             LOG.info("Launching VM...")
             dom.create()
-            LOG.info("Launched VM!")
+            if self.ip_address is not None:
+                LOG.info("Launched VM at %s!" % self.ip_address)
+            else:
+                LOG.info("Launched VM!")
 
-    def provision_disk(self, name, size, backing_file=None,
-                       fmt='qcow2', overwrite=False):
+    def _launch_transient(self, dom, xml):
+        # NB: there's no defining or reusing a transient domain, it only
+        #     exists while it runs
+        if dom is not None:
+            raise ValueError("VM '%s' already exists" % self.name)
 
-        if self._img_loc_type == 'pool':
-            disk_helper.make_disk_volume(
-                self._img_loc, self._main_disk_name(name, fmt), size,
-                fmt, backing_file=backing_file, overwrite=overwrite)
+        # this marks the VM as launched, and lets its address be released
+        # once it's gone (see cleanup.reap_ephemeral)
+        # NB: it has to be in place before the VM starts, since the VM may
+        #     stop (and get cleaned up after) right away
+        with open(os.path.join(self._disk_loc, 'domain.xml'), 'w') as out:
+            out.write(xml)
+
+        if self._ipam is not None:
+            self._ipam.commit()
 
+        LOG.info("Launching ephemeral VM...")
+        try:
+            self._conn.createXML(xml, 0)
+        except libvirt.libvirtError:
+            # nothing else knows about a VM that never started, so clean
+            # up after it here
+            if self._ipam is not None:
+                for iface in self.interfaces:
+                    self._ipam.release(iface.mac_address)
+                self._ipam.commit()
+
+            if self._seed_server is not None:
+                self._seed_server.store.remove(self.name)
+
+            shutil.rmtree(self._disk_loc, ignore_errors=True)
+            raise
+
+        if self.ip_address is not None:
+            LOG.info("Launched VM at %s!" % self.ip_address)
         else:
-            disk_helper.make_disk_file(
-                self._main_disk_path(name, fmt), size,
-                os.path.join(self._img_loc, backing_file), fmt,
-                overwrite=overwrite)
+            LOG.info("Launched VM!")
 
-        disk = self._main_disk_conf(name, fmt)
-        self.disks.append(disk)
+    def provision_disk(self, name, size, backing_file=None,
+                       fmt='qcow2', overwrite=False, **driver_opts):
+        self.provision_disks([dict(name=name, size=size,
+                                   backing_file=backing_file, fmt=fmt,
+                                   **driver_opts)],
+                             overwrite=overwrite)
+
+    def provision_disks(self, disks, overwrite=False, create=True):
+        # each disk is a dict of the arguments to provision_disk --
+        # the volumes are all created at once, but device names are
+        # assigned in the order given
+        for disk in disks:
+            if disk.get('flatten') and disk.get('backing_file'):
+                # a flattened disk is a copy, so it has the base's format
+                disk['fmt'] = disk_helper.image_info(
+                    self._backing_path(disk['backing_file']))['format']
+
+            # skip growpart and resizefs when the root disk is no bigger
+            # than the image it comes from
+            if disk['name'] == 'main':
+                grow = True
+                if disk.get('backing_file'):
+                    base_size = disk_helper.image_info(self._backing_path(
+                        disk['backing_file']))['virtual-size']
+                    grow = disk_helper.size_to_bytes(disk['size']) > base_size
+
+                self.userdata.set_grow_root(grow)
+
+        if create:
+            self.create_disks(disks, overwrite=overwrite)
+
+        for disk in disks:
+            driver_opts = {k: v for k, v in disk.items()
+                           if k not in ('name', 'size', 'backing_file',
+                                        'fmt', 'flatten')}
+            conf = self._main_disk_conf(disk['name'],
+                                        disk.get('fmt', 'qcow2'),
+                                        **driver_opts)
+            self.disks.append(conf)
+
+    def add_agent_channel(self):
+        channel = vx.Channel()
+        channel.channel_type = 'unix'
+        channel.target = 'virtio:%s' % agent.AGENT_CHANNEL
+        self.channels.append(channel)
 
     def share_directory(self, source_path, dest_path, name=None,
                         writable=False, mode=None):
@@ -256,10 +584,31 @@ class VM(vx.Domain):
         self.userdata.run_command(command)
 
     def configure_networking(self, fmt, **kwargs):
+        kwargs = {k.replace('-', '_'): v for k, v in kwargs.items()}
+
         mac = kwargs.get('mac')
         if mac is None:
             mac = self._gen_mac_addr()
 
+        # pull out the virtio-net tuning options so that they don't get
+        # passed through to the guest network config
+        tuning = {k: kwargs.pop(k) for k in list(kwargs.keys())
+                  if k in _NET_TUNING_OPTS or
+                  k.startswith('host_') or k.startswith('guest_')}
+
+        # 'ip=auto' reserves an address in the libvirt network's DHCP range
+        if kwargs.get('ip') == 'auto':
+            if fmt != 'default':
+                raise ValueError("Automatic addresses are only supported "
+                                 "with libvirt networks")
+
+            self._ipam = ipam.IPAllocator(self._conn,
+                                          kwargs.get('network', 'default'))
+            self.ip_address = self._ipam.allocate(self._hostname, mac)
+            kwargs.pop('ip')
+        elif kwargs.get('ip') is not None:
+            self.ip_address = kwargs['ip']
+
         if fmt == 'default':
             conf = self._default_net_conf(kwargs.pop('network', 'default'),
                                           mac, kwargs.pop('portgroup', None))
@@ -272,16 +621,16 @@ class VM(vx.Domain):
             raise ValueError("Unknown networking type '%s'" % fmt)
 
         if conf is not None:
+            self._tune_net_conf(conf, **tuning)
             self.interfaces.append(conf)
 
-            self._set_net_config(**{k.replace('-', '_'): v
-                                    for k, v in kwargs.items()})
+            self._set_net_config(**kwargs)
 
         # inject /etc/hosts with useful info
         # we could just use the cloud-init hosts file manager,
         # but that overwrites on every boot
-        if 'ip' in kwargs:
-            ip = kwargs['ip']
+        if self.ip_address is not None:
+            ip = self.ip_address
         else:
             ip = '127.0.0.1'
 
@@ -305,9 +654,27 @@ class VM(vx.Domain):
         full_cmd = "(%s && %s) || %s" % (grep_cmd, sed_cmd, append_cmd)
 
         # THIS COMMAND LOOKS FUN WHEN PRINTED OUT
-        self.userdata.run_command(['sh', '-c', full_cmd],
-                                  when="boot", freq="instance")
+        # (it goes in the boot script as-is, without a separate shell)
+        self.userdata.run_command(full_cmd, when="boot", freq="instance")
+
+
+    def configure_memory(self, free_page_reporting=False, stats_period=None,
+                         autodeflate=False, share_pages=True, discard=False):
+        # let the host take back memory the guest isn't using...
+        self.balloon_model = 'virtio'
+        if free_page_reporting:
+            self.free_page_reporting = 'on'
+
+        if autodeflate:
+            self.balloon_autodeflate = 'on'
+
+        # ...and report what the guest is actually using
+        if stats_period is not None:
+            self.balloon_stats_period = stats_period
 
+        # NB: KSM can only merge pages when nosharepages is absent
+        self.share_pages = share_pages
+        self.memory_discard = discard
 
     def install_package(self, name, version=None):
         self.userdata.install_package(name, version)
@@ -315,58 +682,221 @@ class VM(vx.Domain):
     def upgrade_all_packages(self):
         self.userdata.run_upgrade()
 
+    def use_seed_server(self, server):
+        # have cloud-init fetch the seed over HTTP (nocloud-net), instead
+        # of writing out an ISO and attaching it
+        self._seed_server = server
+        self.smbios_mode = 'sysinfo'
+        self.sysinfo_type = 'smbios'
+        self.system_info = {
+            'serial': 'ds=nocloud-net;s=%s' % server.url(self.name)}
+
+    def use_direct_kernel_boot(self, backing_file):
+        # boot straight into the base image's kernel, skipping the
+        # firmware and GRUB (the files get extracted once per image)
+        # NB: the guest's own kernel updates won't take effect this way
+        files = kernelboot.boot_files(
+            os.path.abspath(self._backing_path(backing_file)))
+        self.kernel = files.kernel
+        self.initrd = files.initrd
+        self.kernel_cmdline = files.cmdline
+
+    def use_package_cache(self, cache_url):
+        # repos added after this fetch through the given package cache
+        self._pkg_cache_url = cache_url
+
     def use_repo(self, repo_file_contents):
-        c = configparser.ConfigParser()
-        c.read_string(repo_file_contents)
+        for section, opts in _parse_repo_file(repo_file_contents):
+            opts = dict(opts)
+            desc = opts.pop('name')
+            enabled = opts.pop('enabled', '0') == '1'
+
+            if self._pkg_cache_url is not None and 'baseurl' in opts:
+                opts['baseurl'] = ' '.join(
+                    pkgcache.proxied_url(self._pkg_cache_url, url)
+                    for url in opts['baseurl'].split())
+
+                # otherwise yum would go straight to the mirrors
+                opts.pop('metalink', None)
+                opts.pop('mirrorlist', None)
 
-        for section in c.sections():
-            desc = c[section].pop('name')
-            enabled = c[section].pop('enabled', '0') == '1'
             self.userdata.configure_yum_repo(
-                name=section, desc=desc, enabled=enabled, **c[section])
+                name=section, desc=desc, enabled=enabled, **opts)
+
+    def create_disks(self, disks, overwrite=False):
+        if not disks:
+            return
+
+        # NB: refresh the pool once up front, rather than from every
+        #     worker (which serializes them on libvirt's pool lock)
+        if self._disk_loc_type == 'pool':
+            self._disk_loc.refresh()
+
+        with futures.ThreadPoolExecutor(max_workers=len(disks)) as executor:
+            jobs = [executor.submit(self._create_disk, disk['name'],
+                                    disk['size'], disk.get('backing_file'),
+                                    disk.get('fmt', 'qcow2'),
+                                    overwrite=overwrite,
+                                    flatten=disk.get('flatten', False))
+                    for disk in disks]
+
+            for job in jobs:
+                job.result()
+
+        # have libvirt notice the new volumes' formats and sizes
+        if self._disk_loc_type == 'pool':
+            self._disk_loc.refresh()
+
+    def disk_source(self, name, fmt='qcow2'):
+        # matches what _disk_source returns for the disk's config
+        if self._disk_loc_type == 'pool':
+            return '%s:%s' % (self._disk_loc.name(),
+                              self._main_disk_name(name, fmt))
+        else:
+            return self._main_disk_path(name, fmt)
 
-    def _next_disk(self):
-        disk = chr(self._disk_cnt + ord('a'))
-        self._disk_cnt += 1
-        return disk
+    def disk_capacity(self, name, fmt='qcow2'):
+        # returns None if the disk doesn't exist yet
+        if self._disk_loc_type == 'pool':
+            self._disk_loc.refresh()
+            try:
+                vol = self._disk_loc.storageVolLookupByName(
+                    self._main_disk_name(name, fmt))
+            except libvirt.libvirtError as ex:
+                if ex.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_VOL:
+                    return None
+                else:
+                    raise
+
+            return vol.info()[1]
+        else:
+            path = self._main_disk_path(name, fmt)
+            if not os.path.exists(path):
+                return None
+
+            return disk_helper.image_info(path)['virtual-size']
+
+    def resize_disk(self, name, size, fmt='qcow2'):
+        # NB: disks in use by a running domain must be resized through
+        #     libvirt (see reconcile), not behind QEMU's back
+        new_size = disk_helper.size_to_bytes(size)
+        if self._disk_loc_type == 'pool':
+            vol = self._disk_loc.storageVolLookupByName(
+                self._main_disk_name(name, fmt))
+            vol.resize(new_size)
+        else:
+            disk_helper.resize_disk_file(self._main_disk_path(name, fmt),
+                                         new_size)
+
+    def _backing_path(self, backing_file):
+        # backing files may be volume names when using a pool
+        if os.path.isabs(backing_file):
+            return backing_file
+        elif self._img_loc_type == 'pool':
+            return self._img_loc.storageVolLookupByName(backing_file).path()
+        else:
+            return os.path.join(self._img_loc, backing_file)
+
+    def _create_disk(self, name, size, backing_file=None,
+                     fmt='qcow2', overwrite=False, flatten=False):
+        if flatten and backing_file is not None:
+            source = self._backing_path(backing_file)
+            if self._disk_loc_type == 'pool':
+                disk_helper.make_flat_volume(
+                    self._disk_loc, self._main_disk_name(name, fmt), size,
+                    source, fmt, overwrite=overwrite, refresh=False)
+            else:
+                disk_helper.make_flat_disk(
+                    self._main_disk_path(name, fmt), size, source, fmt,
+                    overwrite=overwrite)
+
+        elif self._disk_loc_type == 'pool':
+            disk_helper.make_disk_volume(
+                self._disk_loc, self._main_disk_name(name, fmt), size,
+                fmt, backing_file=backing_file, overwrite=overwrite,
+                refresh=False)
+
+        else:
+            if backing_file is not None:
+                backing_file = self._backing_path(backing_file)
+
+            disk_helper.make_disk_file(
+                self._main_disk_path(name, fmt), size,
+                backing_file, fmt, overwrite=overwrite)
+
+    def _disk_source(self, disk):
+        dev_type = disk.device_type.split(':')[0]
+        if dev_type == 'volume':
+            return disk.source_vol
+        elif dev_type == 'file':
+            return disk.source_file
+        else:
+            return None
+
+    def _next_disk(self, prefix, source):
+        # prefer the device the disk had last time, then the first
+        # device not used by this or the existing domain
+        dev = self._existing_targets.get(source)
+        if dev is None or dev in self._used_targets:
+            reserved = self._used_targets.union(
+                self._existing_targets.values())
+            free = [prefix + chr(c) for c in range(ord('a'), ord('z') + 1)
+                    if prefix + chr(c) not in reserved]
+            if not free:
+                raise ValueError("No free '%s' devices left" % prefix)
+
+            dev = free[0]
+
+        self._used_targets.add(dev)
+        return dev
 
     def _main_disk_name(self, name, fmt):
         return "%s-%s.%s" % (self.name, name, fmt)
 
     def _main_disk_path(self, name, fmt):
-        return os.path.join(self._img_loc, self._main_disk_name(name, fmt))
+        return os.path.join(self._disk_loc, self._main_disk_name(name, fmt))
 
     def _ci_disk_conf(self):
         ci_disk = vx.Disk()
-        if self._img_loc_type == 'pool':
+        if self._disk_loc_type == 'pool':
             ci_disk.device_type = 'volume:cdrom'
-            ci_disk.source_vol = '%s:%s' % (self._img_loc.name(),
+            ci_disk.source_vol = '%s:%s' % (self._disk_loc.name(),
                                                '%s-cidata.iso' % self.name)
         else:
             ci_disk.device_type = 'file:cdrom'
-            ci_disk.source_file = os.path.join(self._img_loc,
+            ci_disk.source_file = os.path.join(self._disk_loc,
                                                '%s-cidata.iso' % self.name)
 
         ci_disk.driver = 'qemu:raw'
-        ci_disk.target = 'ide:hd%s' % self._next_disk()
+        ci_disk.target = 'ide:%s' % self._next_disk(
+            'hd', self._disk_source(ci_disk))
         ci_disk.read_only = True
 
         return ci_disk
 
-    def _main_disk_conf(self, name, fmt='qcow2'):
+    def _main_disk_conf(self, name, fmt='qcow2', cache=None, io=None,
+                        discard=None):
         disk = vx.Disk()
-        if self._img_loc_type == 'pool':
+        if self._disk_loc_type == 'pool':
             disk.device_type = 'volume:disk'
-            disk.source_vol = '%s:%s' % (self._img_loc.name(),
+            disk.source_vol = '%s:%s' % (self._disk_loc.name(),
                                          self._main_disk_name(name, fmt))
         else:
             disk.device_type = 'file:disk'
             disk.source_file = self._main_disk_path(name, fmt)
 
         disk.driver = 'qemu:%s' % fmt
-        disk.target = 'virtio:vd%s' % self._next_disk()
+        disk.target = 'virtio:%s' % self._next_disk(
+            'vd', self._disk_source(disk))
 
-        self._disk_cnt += 1
+        if cache is not None:
+            disk.cache = cache
+
+        if io is not None:
+            disk.io_mode = io
+
+        if discard is not None:
+            disk.discard = discard
 
         return disk
 
@@ -413,6 +943,48 @@ class VM(vx.Domain):
 
         return iface
 
+    def _tune_net_conf(self, iface, driver='vhost', queues=None, mtu=None,
+                       rx_queue_size=None, tx_queue_size=None, **offloads):
+        iface.driver_name = driver
+
+        # one queue pair per vCPU lets the guest spread network
+        # processing across all of its CPUs
+        if queues is None:
+            queues = int(self.cpus)
+
+        queues = int(queues)
+        if queues > 1:
+            iface.queues = queues
+
+        if rx_queue_size is not None:
+            iface.rx_queue_size = int(rx_queue_size)
+
+        if tx_queue_size is not None:
+            iface.tx_queue_size = int(tx_queue_size)
+
+        if mtu is not None:
+            iface.mtu = int(mtu)
+
+        # offloads look like 'host_tso4=off' or 'guest_csum=on'
+        host_offloads = {}
+        guest_offloads = {}
+        for opt, val in offloads.items():
+            side, feature = opt.split('_', 1)
+            if val not in ('on', 'off'):
+                raise ValueError("Offload option '%s' must be 'on' or 'off', "
+                                 "not '%s'" % (opt, val))
+
+            if side == 'host':
+                host_offloads[feature] = val
+            else:
+                guest_offloads[feature] = val
+
+        if host_offloads:
+            iface.host_offloads = host_offloads
+
+        if guest_offloads:
+            iface.guest_offloads = guest_offloads
+
     def _set_net_config(self, device=None, ip=None, gateway=None,
                         broadcast=None, bootproto=None, dns_search=None,
                         mac=None, nameservers=None, auto=True, ipv6=False,
@@ -423,8 +995,8 @@ class VM(vx.Domain):
         if auto:
             self._net_config.append("auto %s" % device)
 
-        if bootproto is None and ip is not None:
-            bootproto = 'static'
+        if bootproto is None:
+            bootproto = 'static' if ip is not None else 'dhcp'
 
         net_num = '' if not ipv6 else '6'
         self._net_config.append(
@@ -469,29 +1041,45 @@ class VM(vx.Domain):
 
                 echo_fmt_str = "echo 'nameserver %s' %s /etc/resolv.conf"
                 self.userdata.run_command(
-                    ["sh", "-c",  echo_fmt_str % (nameservers[0], '>')],
+                    echo_fmt_str % (nameservers[0], '>'),
                     when='boot', freq='instance', ind=0)
                 for i, ns in enumerate(nameservers[1:]):
                     self.userdata.run_command(
-                        ["sh", "-c",  echo_fmt_str % (ns, '>>')],
+                        echo_fmt_str % (ns, '>>'),
                         when='boot', freq='instance', ind=i+1)
 
             if broadcast is not None:
                 self._net_config.append('    broadcast %s' % broadcast)
 
-    def _make_cloud_init(self, overwrite=False):
+    def write_seed(self, overwrite=False):
+        if self._seed_server is not None:
+            store = self._seed_server.store
+            if store.has(self.name) and not overwrite:
+                LOG.info("Seed for '%s' is already being served, not "
+                         "replacing..." % self.name)
+                return
+
+            store.put(self.name,
+                      nac.get_metadata(self._hostname, net=self._net_config),
+                      nac.get_userdata(self.userdata))
+            self._seed_digest = self.seed_digest()
+            return
+
         pool = None
         outdir = None
-        if self._img_loc_type == 'pool':
-            pool = self._img_loc
+        if self._disk_loc_type == 'pool':
+            pool = self._disk_loc
         else:
-            outdir = self._img_loc
+            outdir = self._disk_loc
+
+        written = nac.make_cloud_init(self._hostname, self.userdata,
+                                      outdir=outdir, overwrite=overwrite,
+                                      net=self._net_config, pool=pool,
+                                      outname='%s-cidata.iso' % self.name)
 
-        nac.make_cloud_init(self._hostname, self.userdata,
-                            outdir=outdir, overwrite=overwrite,
-                            net=self._net_config, pool=pool,
-                            outname='%s-cidata.iso' % self.name)
-        self.disks.append(self._ci_disk_conf())
+        # only remember what the seed holds if we actually wrote it
+        if written is not None:
+            self._seed_digest = self.seed_digest()
 
     def _gen_mac_addr(self):
         if self._existing_mac is not None:
@@ -508,7 +1096,7 @@ class VM(vx.Domain):
     @property
     def _conn(self):
         if self._conn_obj is None:
-            self._conn_obj = libvirt.open(self._conn_uri)
+            self._conn_obj = get_connection(self._conn_uri)
 
         return self._conn_obj
 
@@ -0,0 +1,212 @@
+import collections
+import logging
+import os
+import time
+
+import libvirt
+
+from vmup import disk as disk_helper
+from vmup import virxml as vx
+
+LOG = logging.getLogger(__name__)
+
+# one image in a backing chain
+Link = collections.namedtuple('Link', ['path', 'fmt'])
+
+# a VM disk and its chain, top (the disk itself) first
+DiskChain = collections.namedtuple('DiskChain', ['domain', 'target',
+                                                 'chain'])
+
+
+def _volume_chain(conn, vol):
+    chain = []
+    while vol is not None:
+        desc = vx.Volume(vol.XMLDesc())
+        chain.append(Link(vol.path(), desc.target.fmt))
+
+        vol = None
+        if desc.backing_file is not None:
+            try:
+                vol = conn.storageVolLookupByPath(desc.backing_file)
+            except libvirt.libvirtError as ex:
+                if ex.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                    raise
+
+                # the base lives outside of any pool
+                chain.extend(image_chain(desc.backing_file))
+
+    return chain
+
+
+def image_chain(path):
+    # read the chain straight from the qcow2 headers
+    return [Link(info['filename'], info['format'])
+            for info in disk_helper.image_chain(path)]
+
+
+def backing_chain(conn, path):
+    # prefer what the storage pool knows, since it covers images that
+    # qemu-img can't read directly (e.g. over the network)
+    try:
+        vol = conn.storageVolLookupByPath(path)
+    except libvirt.libvirtError as ex:
+        if ex.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+            raise
+
+        return image_chain(path)
+
+    return _volume_chain(conn, vol)
+
+
+def domain_disks(conn, dom):
+    # the (target, path) of each of the domain's writable disks
+    disks = []
+    desc = vx.Domain(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    for disk in desc.disks:
+        dev_type, device = disk.device_type.split(':')
+        if device != 'disk':
+            continue
+
+        target = disk.target.split(':')[1]
+        if dev_type == 'file' and disk.source_file is not None:
+            disks.append((target, disk.source_file))
+        elif dev_type == 'volume':
+            pool_name, vol_name = disk.source_vol.split(':', 1)
+            pool = conn.storagePoolLookupByName(pool_name)
+            disks.append((target,
+                          pool.storageVolLookupByName(vol_name).path()))
+
+    return disks
+
+
+def domain_chains(conn, doms=None):
+    if doms is None:
+        doms = conn.listAllDomains()
+
+    chains = []
+    for dom in doms:
+        for target, path in domain_disks(conn, dom):
+            chains.append(DiskChain(dom.name(), target,
+                                    backing_chain(conn, path)))
+
+    return chains
+
+
+def dependents(chains):
+    # map each base image to the VM disks layered on top of it
+    deps = collections.defaultdict(list)
+    for disk_chain in chains:
+        for link in disk_chain.chain[1:]:
+            deps[link.path].append(disk_chain)
+
+    return deps
+
+
+def _check_running(dom):
+    if not dom.isActive():
+        raise ValueError("VM '%s' must be running to collapse its disks "
+                         "live" % dom.name())
+
+
+def pull(dom, target, base=None, bandwidth=0):
+    # copy the data from the backing chain (down to base, or all of it)
+    # into the disk itself, while the VM keeps running.  bandwidth is in
+    # MiB/s, with 0 meaning unlimited.
+    _check_running(dom)
+
+    if base is None:
+        dom.blockPull(target, bandwidth, 0)
+    else:
+        dom.blockRebase(target, base, bandwidth, 0)
+
+    LOG.info("Started pulling the backing chain into %s of '%s'" %
+             (target, dom.name()))
+
+
+def check_commit(conn, dom, target, base=None, force=False):
+    # the image that commit would merge the disk into, raising ValueError
+    # if that isn't safe
+    _check_running(dom)
+
+    path = dict(domain_disks(conn, dom))[target]
+    chain = backing_chain(conn, path)
+    if len(chain) < 2:
+        raise ValueError("Disk %s of '%s' has no backing image to commit "
+                         "into" % (target, dom.name()))
+
+    base = base or chain[1].path
+
+    # NB: writing into a base shared with other VMs corrupts them
+    others = [d for d in dependents(domain_chains(conn))[base]
+              if (d.domain, d.target) != (dom.name(), target)]
+    if others:
+        raise ValueError("Not committing into '%s', since it is also used "
+                         "by %s" % (base, ', '.join(
+                             '%s (%s)' % (d.domain, d.target)
+                             for d in others)))
+
+    # ...and so does writing into a cached image that later VMs get
+    # created from (or that other hosts fetch)
+    if not force and disk_helper.is_fetched_image(os.path.basename(base)):
+        raise ValueError("Not committing into '%s', since it is a fetched "
+                         "base image (use --force to do it anyway)" % base)
+
+    return base
+
+
+def commit(conn, dom, target, base=None, top=None, bandwidth=0,
+           force=False):
+    # merge the images above base (default: the first backing image) down
+    # into it.  When top is the disk itself, the VM gets switched over to
+    # base once the job finishes (see wait).
+    path = dict(domain_disks(conn, dom))[target]
+    base = check_commit(conn, dom, target, base=base, force=force)
+
+    flags = 0
+    if top is None or top == path:
+        flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
+
+    dom.blockCommit(target, base, top, bandwidth, flags)
+
+    LOG.info("Started committing %s of '%s' into '%s'" %
+             (target, dom.name(), base))
+
+
+def job_progress(dom, target):
+    # (current, end) for the disk's block job, or None if there isn't one
+    info = dom.blockJobInfo(target, 0)
+    if not info:
+        return None
+
+    return info['cur'], info['end']
+
+
+def set_bandwidth(dom, target, bandwidth):
+    dom.blockJobSetSpeed(target, bandwidth, 0)
+
+
+def wait(dom, target, poll_interval=1):
+    # wait for the disk's block job to finish, switching over to the new
+    # image at the end of an active commit
+    last_logged = 0
+    while True:
+        info = dom.blockJobInfo(target, 0)
+        if not info:
+            return
+
+        active_commit = (info['type'] ==
+                         libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT)
+        if active_commit and info['end'] and info['cur'] == info['end']:
+            dom.blockJobAbort(target,
+                              libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+            LOG.info("Switched %s of '%s' over to the committed image" %
+                     (target, dom.name()))
+            return
+
+        now = time.time()
+        if info['end'] and now - last_logged >= 10:
+            LOG.info("Block job on %s of '%s': %.0f%% done" %
+                     (target, dom.name(), 100.0 * info['cur'] / info['end']))
+            last_logged = now
+
+        time.sleep(poll_interval)
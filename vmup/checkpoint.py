@@ -0,0 +1,123 @@
+import logging
+import os
+import time
+
+import libvirt
+from lxml import etree
+
+from vmup import agent
+from vmup import chains
+from vmup import disk as disk_helper
+
+LOG = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = 'vmup-checkpoint'
+
+
+def _overlay_path(path):
+    # NB: this keeps the VM-NAME-DISK.FMT naming, so destroy and gc
+    # treat the overlays like any other disk of the VM
+    base, _ = os.path.splitext(path)
+    return '%s-ckpt.qcow2' % base
+
+
+def _memory_path(path):
+    base, _ = os.path.splitext(path)
+    return '%s-ckpt.mem' % base
+
+
+def _lookup(dom):
+    try:
+        return dom.snapshotLookupByName(CHECKPOINT_NAME)
+    except libvirt.libvirtError as ex:
+        if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+            raise
+
+        return None
+
+
+def checkpoint(conn, dom, memory=False, wait=True, timeout=600):
+    # Freeze the VM's disks as they are now (once cloud-init is done),
+    # with the VM carrying on in fresh overlays on top of them.  With
+    # memory, the RAM gets saved too, so that reset skips booting.
+    if _lookup(dom) is not None:
+        raise ValueError("VM '%s' already has a checkpoint" % dom.name())
+
+    if memory and not dom.isActive():
+        raise ValueError("VM '%s' must be running to checkpoint its "
+                         "memory" % dom.name())
+
+    flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+    if wait and dom.isActive():
+        LOG.info("Waiting for cloud-init to finish in '%s'..." % dom.name())
+        elapsed = agent.wait_for_cloud_init(dom, timeout)
+        LOG.info("cloud-init finished after %.1fs" % elapsed)
+
+        # the agent is up, so have it flush the guest's filesystems
+        if not memory:
+            flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE
+
+    disks = chains.domain_disks(conn, dom)
+
+    snap = etree.Element('domainsnapshot')
+    etree.SubElement(snap, 'name').text = CHECKPOINT_NAME
+    etree.SubElement(snap, 'description').text = 'created by vmup'
+
+    if memory:
+        etree.SubElement(snap, 'memory', snapshot='external',
+                         file=_memory_path(disks[0][1]))
+    else:
+        flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
+
+    disks_elem = etree.SubElement(snap, 'disks')
+    for target, path in disks:
+        disk_elem = etree.SubElement(disks_elem, 'disk', name=target,
+                                     snapshot='external', type='file')
+        etree.SubElement(disk_elem, 'driver', type='qcow2')
+        etree.SubElement(disk_elem, 'source', file=_overlay_path(path))
+
+    start = time.time()
+    dom.snapshotCreateXML(etree.tostring(snap, encoding=str), flags)
+    LOG.info("Checkpointed '%s' in %.2fs" % (dom.name(),
+                                             time.time() - start))
+
+
+def reset(conn, dom):
+    # Throw away everything since the checkpoint, by swapping in fresh
+    # overlays (and restoring the saved memory, if any).  Returns the
+    # time taken.
+    snap = _lookup(dom)
+    if snap is None:
+        raise ValueError("VM '%s' has no checkpoint (see 'vmup "
+                         "checkpoint')" % dom.name())
+
+    desc = etree.fromstring(snap.getXMLDesc())
+    overlays = [source.get('file')
+                for source in desc.findall('disks/disk/source')]
+    memory = desc.find('memory')
+    memory_file = memory.get('file') if memory is not None else None
+
+    start = time.time()
+    if dom.isActive():
+        dom.destroy()
+
+    for overlay in overlays:
+        info = disk_helper.image_info(overlay)
+        disk_helper.make_overlay(overlay, info['full-backing-filename'],
+                                 info.get('backing-filename-format',
+                                          'qcow2'))
+
+    if memory_file is not None:
+        # NB: the saved config points at the same overlay paths, which
+        # now hold nothing but the checkpoint
+        conn.restoreFlags(memory_file,
+                          dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE |
+                                      libvirt.VIR_DOMAIN_XML_SECURE),
+                          libvirt.VIR_DOMAIN_SAVE_RUNNING)
+    else:
+        dom.create()
+
+    elapsed = time.time() - start
+    LOG.info("Reset '%s' to its checkpoint in %.2fs" % (dom.name(),
+                                                      elapsed))
+    return elapsed
@@ -0,0 +1,365 @@
+import collections
+from concurrent import futures
+import fnmatch
+import logging
+import os
+import re
+import shutil
+import time
+
+import libvirt
+
+from vmup import builder
+from vmup import chains
+from vmup import disk as disk_helper
+from vmup import images as image_sync
+from vmup import ipam
+from vmup import kernelboot
+from vmup import peers
+from vmup import seedserver
+from vmup import virxml as vx
+
+LOG = logging.getLogger(__name__)
+
+# the names vmup gives to the disks (VM-NAME.FMT) and seeds it creates
+# (plus the memory saved by 'vmup checkpoint')
+_DISK_NAME_RE = re.compile(r'^(.+)-([\w-]+)\.(qcow2|raw|mem)$')
+_SEED_NAME_RE = re.compile(r'^(.+)-cidata\.iso$')
+
+# how long an ephemeral VM gets to go from scratch dir to running
+_SCRATCH_GRACE = 60 * 60
+
+StoredImage = collections.namedtuple('StoredImage', ['name', 'path', 'size',
+                                                     'backing_file',
+                                                     'delete'])
+
+
+def list_images(loc_type, loc):
+    # everything in the image dir or pool, with the space it uses
+    images = []
+    if loc_type == 'pool':
+        loc.refresh()
+        for vol in loc.listAllVolumes():
+            desc = vx.Volume(vol.XMLDesc())
+            images.append(StoredImage(vol.name(), vol.path(), vol.info()[2],
+                                      desc.backing_file, vol.delete))
+    else:
+        for name in os.listdir(loc):
+            path = os.path.join(loc, name)
+            if not os.path.isfile(path):
+                continue
+
+            backing_file = None
+            if name.endswith('.qcow2'):
+                backing_file = disk_helper.image_info(path).get(
+                    'full-backing-filename')
+
+            images.append(StoredImage(name, path,
+                                      os.stat(path).st_blocks * 512,
+                                      backing_file,
+                                      lambda path=path: os.remove(path)))
+
+    return images
+
+
+def domain_disk_paths(conn, dom):
+    # the paths of all the disks the domain uses, whatever their type
+    paths = []
+    desc = vx.Domain(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    for disk in desc.disks:
+        dev_type = disk.device_type.split(':')[0]
+        if dev_type == 'file' and disk.source_file is not None:
+            paths.append(disk.source_file)
+        elif dev_type == 'volume':
+            pool_name, vol_name = disk.source_vol.split(':', 1)
+            try:
+                pool = conn.storagePoolLookupByName(pool_name)
+                paths.append(pool.storageVolLookupByName(vol_name).path())
+            except libvirt.libvirtError as ex:
+                LOG.debug("Unable to find volume '%s': %s" %
+                          (disk.source_vol, ex))
+
+    return paths
+
+
+def is_protected(name, protect):
+    return any(fnmatch.fnmatch(name, pat) for pat in protect)
+
+
+def _owned_by(image_name, vm_name):
+    return (image_name == '%s-cidata.iso' % vm_name or
+            _DISK_NAME_RE.match(image_name) is not None and
+            image_name.startswith('%s-' % vm_name))
+
+
+def _delete_all(images, dry_run=False):
+    if dry_run or not images:
+        return sum(img.size for img in images)
+
+    reclaimed = 0
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        jobs = {executor.submit(img.delete): img for img in images}
+        for job in futures.as_completed(jobs):
+            img = jobs[job]
+            try:
+                job.result()
+                reclaimed += img.size
+            except Exception as ex:
+                LOG.warning("Unable to delete '%s': %s" % (img.name, ex))
+
+    return reclaimed
+
+
+def destroy(conn, names, image_dir='POOL:default', keep_disks=False,
+            dry_run=False, protect=(), scratch_dir=builder.SCRATCH_DIR):
+    # returns the list of images removed (or that would be removed),
+    # and the number of bytes reclaimed
+    loc_type, loc = builder.resolve_image_dir(conn, image_dir)
+    images = list_images(loc_type, loc)
+
+    for name in names:
+        if is_protected(name, protect):
+            raise ValueError("VM '%s' is protected" % name)
+
+    doms = []
+    for name in names:
+        try:
+            doms.append(builder.lookup_domain(conn, name))
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                raise ValueError("No such VM '%s'" % name)
+            else:
+                raise
+
+    # NB: an ephemeral VM's disks live in its scratch dir, which goes
+    #     away with it no matter what
+    if keep_disks:
+        for dom in doms:
+            if not dom.isPersistent():
+                raise ValueError("VM '%s' is ephemeral, so its disks "
+                                 "can't be kept" % dom.name())
+
+    # never touch anything another VM uses, or that looks like it belongs
+    # to another VM (e.g. 'foo-bar-main.qcow2' when destroying 'foo')
+    uuids = set(dom.UUIDString() for dom in doms)
+    others = [dom for dom in conn.listAllDomains()
+              if dom.UUIDString() not in uuids]
+    # NB: the VMs' own overlays (e.g. from 'vmup checkpoint') don't count
+    other_paths = set(img.backing_file for img in images
+                      if not any(_owned_by(img.name, name)
+                                 for name in names))
+    for dom in others:
+        other_paths.update(domain_disk_paths(conn, dom))
+
+    doomed = []
+    if not keep_disks:
+        paths = set()
+        for dom in doms:
+            paths.update(domain_disk_paths(conn, dom))
+
+        for img in images:
+            if img.path in other_paths or is_protected(img.name, protect):
+                continue
+
+            if any(_owned_by(img.name, dom.name()) for dom in others):
+                continue
+
+            if (img.path in paths or
+                    any(_owned_by(img.name, name) for name in names)):
+                doomed.append(img)
+
+    if not dry_run:
+        for dom in doms:
+            if not dom.isPersistent():
+                # ephemeral VMs only need stopping, and their scratch dir
+                # takes everything else with it
+                LOG.info("Stopping ephemeral VM '%s'..." % dom.name())
+                dom.destroy()
+                remove_scratch(conn, dom.name(), scratch_dir)
+                continue
+
+            _release_addresses(conn, vx.Domain(
+                dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)))
+
+            if dom.isActive():
+                LOG.info("Stopping VM '%s'..." % dom.name())
+                dom.destroy()
+
+            LOG.info("Undefining VM '%s'..." % dom.name())
+            dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+                              libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+
+            # drop any seed served over HTTP (see 'vmup --http-seed')
+            seedserver.remove_seed(dom.name())
+
+    return doomed, _delete_all(doomed, dry_run=dry_run)
+
+
+def _release_addresses(conn, desc):
+    for iface in desc.interfaces:
+        if iface.iface_type != 'network':
+            continue
+
+        try:
+            allocator = ipam.IPAllocator(conn, iface.source['network'])
+            allocator.release(iface.mac_address)
+            allocator.commit()
+        except (libvirt.libvirtError, ValueError) as ex:
+            LOG.debug("Unable to release the address for %s: %s" %
+                      (iface.mac_address, ex))
+
+
+def remove_scratch(conn, name, scratch_dir=builder.SCRATCH_DIR):
+    # drop everything an ephemeral VM left behind (see
+    # VM.make_ephemeral), once it's no longer running
+    path = builder.scratch_path(name, scratch_dir)
+    xml_path = os.path.join(path, 'domain.xml')
+    if os.path.exists(xml_path):
+        with open(xml_path) as xml_file:
+            _release_addresses(conn, vx.Domain(xml_file.read()))
+
+    shutil.rmtree(path, ignore_errors=True)
+
+    seedserver.remove_seed(name)
+
+
+def _launched(path):
+    # NB: without a domain.xml, the VM may still be getting provisioned,
+    #     so only give up on it after a while
+    return (os.path.exists(os.path.join(path, 'domain.xml')) or
+            time.time() - os.stat(path).st_mtime > _SCRATCH_GRACE)
+
+
+def reap_ephemeral(conn, scratch_dir=builder.SCRATCH_DIR, dry_run=False):
+    # clean up after ephemeral VMs that stopped with nothing watching,
+    # returning their names
+    if not os.path.isdir(scratch_dir):
+        return []
+
+    running = set(dom.name() for dom in conn.listAllDomains())
+    gone = [name for name in sorted(os.listdir(scratch_dir))
+            if name not in running and
+            _launched(os.path.join(scratch_dir, name))]
+
+    if not dry_run:
+        for name in gone:
+            LOG.info("Cleaning up after ephemeral VM '%s'..." % name)
+            remove_scratch(conn, name, scratch_dir)
+
+    return gone
+
+
+def find_orphans(conn, image_dir='POOL:default', protect=()):
+    loc_type, loc = builder.resolve_image_dir(conn, image_dir)
+    images = list_images(loc_type, loc)
+
+    doms = conn.listAllDomains()
+    dom_names = [dom.name() for dom in doms]
+
+    in_use = set()
+    for dom in doms:
+        in_use.update(domain_disk_paths(conn, dom))
+
+    # anything another image is layered on top of is also in use
+    in_use.update(img.backing_file for img in images if img.backing_file)
+
+    orphans = []
+    for img in images:
+        if img.path in in_use or is_protected(img.name, protect):
+            continue
+
+        if not (_SEED_NAME_RE.match(img.name) or
+                _DISK_NAME_RE.match(img.name)):
+            continue
+
+        # the disks of defined VMs aren't orphans, even if detached
+        if any(_owned_by(img.name, name) for name in dom_names):
+            continue
+
+        orphans.append(img)
+
+    return orphans
+
+
+def gc(conn, image_dir='POOL:default', dry_run=False, protect=()):
+    orphans = find_orphans(conn, image_dir, protect=protect)
+    return orphans, _delete_all(orphans, dry_run=dry_run)
+
+
+def base_image_refs(conn, images):
+    # Every path some VM disk is layered on, however deep.  Other images'
+    # backing files count too, so that overlays outside of any VM (e.g.
+    # the ones left by 'vmup destroy --keep-disks') keep their bases.
+    refs = set(os.path.realpath(img.backing_file)
+               for img in images if img.backing_file)
+    for disk_chain in chains.domain_chains(conn):
+        refs.update(os.path.realpath(link.path) for link in disk_chain.chain)
+
+    return refs
+
+
+def find_evictable(conn, image_dir='POOL:default', max_size=None,
+                   max_count=None, protect=()):
+    # The downloaded base images to drop to get under the budget, least
+    # recently used first.  Returns those, plus the base images' total
+    # size afterwards.  Referenced images are never picked, so the
+    # budget can still end up exceeded.
+    loc_type, loc = builder.resolve_image_dir(conn, image_dir)
+    images = list_images(loc_type, loc)
+    bases = [img for img in images if disk_helper.is_fetched_image(img.name)]
+
+    refs = base_image_refs(conn, images)
+
+    # keep the latest image of each synced alias, since the next VM would
+    # just have to fetch it again
+    keep = set(entry['local'] for entry in image_sync.load_state().values())
+
+    usage = image_sync.last_used()
+
+    def _last_used(img):
+        # NB: images never used to create a VM go by when they arrived
+        try:
+            return usage.get(img.name, os.stat(img.path).st_mtime)
+        except OSError:
+            return 0
+
+    total = sum(img.size for img in bases)
+    count = len(bases)
+
+    def _over():
+        return ((max_size is not None and total > max_size) or
+                (max_count is not None and count > max_count))
+
+    candidates = [img for img in bases
+                  if os.path.realpath(img.path) not in refs and
+                  img.name not in keep and
+                  not is_protected(img.name, protect)]
+
+    evictable = []
+    for img in sorted(candidates, key=_last_used):
+        if not _over():
+            break
+
+        evictable.append(img)
+        total -= img.size
+        count -= 1
+
+    if _over():
+        LOG.warning("Base images still use %s bytes in %s images after "
+                    "eviction (the rest are in use or kept)" % (total, count))
+
+    return evictable, total
+
+
+def evict(conn, image_dir='POOL:default', max_size=None, max_count=None,
+          dry_run=False, protect=()):
+    evictable, _ = find_evictable(conn, image_dir, max_size, max_count,
+                                  protect=protect)
+    reclaimed = _delete_all(evictable, dry_run=dry_run)
+    if not dry_run:
+        image_sync.forget(img.name for img in evictable)
+        for img in evictable:
+            kernelboot.forget(img.path)
+            peers.forget_checksum(img.path)
+
+    return evictable, reclaimed
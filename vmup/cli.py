@@ -0,0 +1,1384 @@
+import argparse
+import json
+import logging
+import os
+import shlex
+import socket
+import sys
+
+
+LOG = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(prog="vmup")
+
+parser.add_argument("name", help="the name (and hostname) of the VM")
+
+img_group = parser.add_argument_group("image")
+img_group.add_argument("--image-dir",
+                       help=("the directory in which to store the images"
+                             "(defaults: /var/lib/libvirt/images)"),
+                       default="POOL:default")
+img_group.add_argument("--base-image", metavar="PATH_OR_ALIAS",
+                       help=("base image to create the main disk from"
+                             "(should be a full path or a name, such as "
+                             "'fedora', 'fedora-atomic', or 'fedora-23', "
+                             "default: fedora"),
+                       default='fedora')
+img_group.add_argument('--always-fetch',
+                       help=("warn if the local image for an alias isn't "
+                             "the latest one seen by 'vmup images sync', "
+                             "or the last sync was too long ago (default: "
+                             "False)"),
+                       action='store_true', default=False)
+img_group.add_argument('--flatten',
+                       help=("make disks full copies of their base images "
+                             "(using reflinks when the filesystem supports "
+                             "them) instead of overlays on top of them"),
+                       action='store_true', default=False)
+img_group.add_argument('--import-format', choices=['qcow2', 'raw', 'none'],
+                       help=("convert newly downloaded images into this "
+                             "format before use, or 'none' to use them "
+                             "exactly as downloaded (default: qcow2)"),
+                       default='qcow2')
+img_group.add_argument('--import-cluster-size', metavar='SIZE',
+                       help=("the cluster size for imported qcow2 images "
+                             "(default: 2M)"), default='2M')
+img_group.add_argument('--import-prealloc', choices=['off', 'metadata'],
+                       help=("preallocation mode for imported qcow2 images "
+                             "(default: off)"), default='off')
+img_group.add_argument('--direct-kernel-boot',
+                       help=("boot the base image's kernel directly, "
+                             "skipping the firmware and boot loader (the "
+                             "kernel gets extracted once per image, which "
+                             "needs libguestfs)"),
+                       action='store_true', default=False)
+img_group.add_argument('--image-peer', metavar='URL',
+                       help=("before downloading a base image from the "
+                             "internet, try this vmup host (see 'vmup "
+                             "images serve'), may be given multiple times"),
+                       action='append', default=[])
+img_group.add_argument('--image-budget', metavar='SIZE',
+                       help=("once the VM is up, remove the least recently "
+                             "used downloaded base images that no VM "
+                             "depends on, until they fit in SIZE"))
+img_group.add_argument('--image-budget-count', metavar='N', type=int,
+                       help=("like --image-budget, but keep at most N "
+                             "downloaded base images"))
+
+size_group = parser.add_argument_group("VM size")
+# TODO: unify the unit suffix forms (e.g. G vs GiB)
+size_group.add_argument("--size",
+                        help="size of the main disk (default: 20 GiB)",
+                        default="20 GiB")
+size_group.add_argument("--disk", metavar="NAME:SIZE[:BACKING][:OPTS]",
+                        help=("add an extra disk with the given name and "
+                              "size (e.g. 'data:100GiB'), optionally backed "
+                              "by an image path or alias.  OPTS may contain "
+                              "'fmt', 'cache', 'io', and 'discard' (e.g. "
+                              "'scratch:50G::fmt=raw,cache=none')"),
+                        action="append", default=[])
+size_group.add_argument("--memory",
+                        help=("amount of memory to give the VM"
+                              "(default: 3 GiB)"), default="3 GiB")
+size_group.add_argument("--cpus",
+                        help="number of CPUs to give the VM (default: 2)",
+                        default="2", type=int)
+size_group.add_argument("--free-page-reporting",
+                        help=("have the guest hand memory it frees back to "
+                              "the host through the balloon"),
+                        action='store_true', default=False)
+size_group.add_argument("--balloon-stats-period", metavar="SECS", type=int,
+                        help=("have the guest report its memory usage every "
+                              "SECS seconds (see 'vmup mem-stats')"),
+                        default=None)
+size_group.add_argument("--autodeflate",
+                        help="deflate the balloon when the guest is OOM",
+                        action='store_true', default=False)
+size_group.add_argument("--no-ksm",
+                        help="keep the VM's memory from being shared by KSM",
+                        action='store_true', default=False)
+size_group.add_argument("--memory-discard",
+                        help=("discard the VM's memory on shutdown instead "
+                              "of keeping it around"),
+                        action='store_true', default=False)
+
+dev_group = parser.add_argument_group("devices")
+dev_group.add_argument('--net', metavar="TYPE[:arg1=v1,arg2=v2,...]",
+                       help=("Configure the type of networking (default, ovs, "
+                             "or none).  Arguments such as 'ip=a.b.c.d' may "
+                             "be specified to control networking setup "
+                             "('ip=auto' reserves an address from the "
+                             "libvirt network's DHCP range).  The "
+                             "virtio-net device may be tuned with 'driver', "
+                             "'queues' (default: number of CPUs), 'mtu', "
+                             "'rx-queue-size', 'tx-queue-size', and offload "
+                             "toggles like 'host-tso4=off' or "
+                             "'guest-csum=on'."),
+                       default="default")
+
+auth_group = parser.add_argument_group("auth")
+auth_group.add_argument("--password", help="password for the user",
+                        default=None)
+auth_group.add_argument("--password-hash", help="password hash for the user",
+                        default=None)
+auth_group.add_argument("--ssh-key", metavar="PATH",
+                        help=("add an SSH key from a path to the default user "
+                              "(default: ~/.ssh/id_rsa.pub)"),
+                        action="append",
+                        default=[os.path.expanduser("~/.ssh/id_rsa.pub")])
+auth_group.add_argument("--user", metavar="NAME",
+                        help="set up a custom user instead of the default",
+                        default=None)
+
+cmd_group = parser.add_argument_group("files and commands")
+cmd_group.add_argument("--share", metavar="HOSTPATH:VMPATH",
+                       help="share a directory from the host to the VM",
+                       action="append", default=[])
+cmd_group.add_argument("--add-file", metavar="SOURCE:DEST[:PERM]",
+                       help=("inject a file at the specified path"
+                             "(optionally with the given octal permissions)."
+                             "If 'SYM:' is prepended, this will create symlink"
+                             "inside the VM instead.  If 'DEST' is 'RUN', "
+                             "this will insert the file in /tmp and then run "
+                             "it with appropriate permissions"),
+                       action="append", default=[])
+cmd_group.add_argument("--run-cmd", metavar="CMD",
+                       help=("run a command after boot"), action="append",
+                       default=[])
+cmd_group.add_argument("--add-packages", metavar="PKGS", default=[], nargs='+',
+                       action='append',
+                       help="install the given package in the VM (multiple "
+                            "packages may be installed by listing multiple "
+                            "space-separated packages)")
+cmd_group.add_argument("--add-repo", metavar="REPO_FILE_OR_URL",
+                       action="append", default=[],
+                       help="add the given YUM repos to the VM")
+cmd_group.add_argument("--pkg-cache", metavar="URL", default=None,
+                       help=("fetch packages from the added repos through "
+                             "this host package cache, as seen from the VM "
+                             "(e.g. http://192.168.122.1:3142, see "
+                             "'vmup pkg-cache')"))
+cmd_group.add_argument("--boot-profile",
+                       choices=['minimal', 'default', 'full'],
+                       help=("which cloud-init modules to run: only those "
+                             "the requested features need (minimal), those "
+                             "plus a few common extras (default), or all "
+                             "of vmup's usual modules (full)"),
+                       default='default')
+cmd_group.add_argument("--guest-agent",
+                       help=("add a channel for the QEMU guest agent (the "
+                             "image needs to have qemu-guest-agent)"),
+                       default=False, action='store_true')
+cmd_group.add_argument("--http-seed",
+                       help=("serve the cloud-init seed from vmupd over "
+                             "HTTP instead of attaching an ISO (needs vmupd "
+                             "running with --seed-server, so it doesn't "
+                             "work with --no-daemon, and the VM needs DHCP, "
+                             "so no static ip=)"),
+                       default=False, action='store_true')
+
+misc_group = parser.add_argument_group("misc")
+misc_group.add_argument("--conn", metavar="URI",
+                        help="the libvirt connection to use",
+                        default="qemu:///system")
+misc_group.add_argument("--place-on", metavar="URI",
+                        help=("pick the libvirt connection with the most "
+                              "suitable free capacity from these (may be "
+                              "given more than once, overrides --conn)"),
+                        action="append", default=[])
+misc_group.add_argument("--placement", choices=['spread', 'pack'],
+                        help=("how to pick a host with --place-on: spread "
+                              "VMs out, or pack them onto as few hosts as "
+                              "possible (default: spread)"),
+                        default='spread')
+misc_group.add_argument("--new-ci-data",
+                        help="overwrite existing cloud-init data",
+                        action="store_true", default=False)
+misc_group.add_argument("--burn",
+                        help="overwrite everything, stopping the existing VM "
+                             "(if present) in the process", default=False,
+                             action='store_true')
+misc_group.add_argument("--halt-existing",
+                        help="stop the existing VM if needed",
+                        default=False, action='store_true')
+misc_group.add_argument("--plan",
+                        help=("show what would change on the existing VM, "
+                              "without changing anything"),
+                        default=False, action='store_true')
+misc_group.add_argument("--apply",
+                        help=("update the existing VM in place, making "
+                              "only the changes shown by --plan"),
+                        default=False, action='store_true')
+misc_group.add_argument("--warm-class", metavar="CLASS",
+                        help=("claim a pre-provisioned VM from the given "
+                              "warm pool class, if one is available "
+                              "(see 'vmup warm-pool')"),
+                        default=None)
+misc_group.add_argument("--ephemeral",
+                        help=("run a throwaway VM: keep its disks and seed "
+                              "in the scratch dir instead of the image dir, "
+                              "and don't define it, so that it's all gone "
+                              "once it stops (cleaned up by vmupd with "
+                              "--reap-ephemeral, or 'vmup gc')"),
+                        default=False, action='store_true')
+misc_group.add_argument("--scratch-dir", metavar="PATH",
+                        help=("where ephemeral VMs keep their disks "
+                              "(default: /dev/shm/vmup, which is in memory)"),
+                        default=None)
+misc_group.add_argument("--no-daemon",
+                        help="don't hand the request off to a running vmupd",
+                        default=False, action='store_true')
+misc_group.add_argument("-v", metavar="LEVEL", default='INFO',
+                        help="set the logging verbosity (may be debug, info, "
+                             "warning, error, or critical, default: info)")
+
+
+def read_args(argv=None):
+    # defaults come from ~/.vmuprc, then ./.vmup, then the command line
+    raw_args = []
+
+    dotrc_path = os.path.expanduser('~/.vmuprc')
+    if os.path.exists(dotrc_path):
+        with open(dotrc_path) as dotrc:
+            raw_args.extend(shlex.split(dotrc.read(), comments=True))
+
+    dotfile_path = os.path.join(os.getcwd(), '.vmup')
+    if os.path.exists(dotfile_path):
+        with open(dotfile_path) as dotfile:
+            raw_args.extend(shlex.split(dotfile.read(), comments=True))
+
+    # TODO: manually expanduser on the raw_args arguments?
+    if argv is None:
+        argv = sys.argv[1:]
+
+    raw_args.extend(argv)
+
+    return raw_args
+
+
+def parse_args(raw_args):
+    args = parser.parse_args(raw_args)
+
+    # --burn implies the other overwrite options
+    if args.burn:
+        args.new_ci_data = True
+        args.halt_existing = True
+
+    args.v = args.v.upper()
+    if args.v not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        sys.exit('Invalid verbosity %s' % args.v)
+
+    if args.ephemeral and (args.plan or args.apply or args.warm_class):
+        sys.exit("Ephemeral VMs can't be reconciled or come from a warm "
+                 "pool")
+
+    return args
+
+
+def provision(args):
+    # NB: these are imported here so that handing off to the daemon
+    #     doesn't pay for loading libvirt and friends
+    import requests
+
+    from vmup import builder
+    from vmup import disk as disk_helper
+    from vmup import web
+
+    # pick a host for the VM, if we were given several to choose from
+    if args.place_on:
+        from vmup import placement
+
+        try:
+            req = placement.make_request(args.name, args.memory, args.cpus,
+                                         args.size)
+            args.conn = placement.choose(args.place_on, req,
+                                         policy=args.placement,
+                                         image_dir=args.image_dir)
+        except ValueError as ex:
+            sys.exit(str(ex))
+
+        LOG.info("Placing VM on '%s'" % args.conn)
+
+    # begin configuration of the VM
+    vm = builder.VM(args.name, image_dir=args.image_dir,
+                    conn_uri=args.conn)
+
+    if args.ephemeral:
+        try:
+            vm.make_ephemeral(args.scratch_dir or builder.SCRATCH_DIR)
+        except ValueError as ex:
+            sys.exit(str(ex))
+
+    # running VMs get updated in place when reconciling
+    reconciling = args.plan or args.apply
+    if (vm.load_existing(halt=args.halt_existing and not reconciling) and
+            not reconciling):
+        sys.exit("Cowardly refusing to overwrite a running VM.  Try running "
+                 "with --halt-existing")
+
+    # set the sizes
+    vm.memory = args.memory
+    vm.cpus = args.cpus
+    vm.configure_memory(free_page_reporting=args.free_page_reporting,
+                        stats_period=args.balloon_stats_period,
+                        autodeflate=args.autodeflate,
+                        share_pages=not args.no_ksm,
+                        discard=args.memory_discard)
+
+    # set up 9p shared images
+    for arg in (arg.split(':') for arg in args.share):
+        writable = False
+        mode = None
+
+        if len(arg) > 2:
+            mode_args = arg[2].split('-')
+            writable = (mode_args[0] == 'rw')
+            if len(mode_args) > 1:
+                mode = mode_args[1]
+
+        vm.share_directory(os.path.abspath(arg[0]),
+                           arg[1], writable=writable, mode=mode)
+
+    # inject files
+    for arg in (arg.split(':') for arg in args.add_file):
+        permissions = None
+        if len(arg) > 2 and arg[0] == 'SYM':
+            if len(arg) > 3:
+                permissions = arg[3]
+
+            permissions = arg[3]
+            vm.add_symlink(arg[1], arg[2], permissions=permissions)
+        else:
+            if len(arg) > 2:
+                permissions = arg[2]
+
+            dest = arg[1]
+            if arg[1] == 'RUN':
+                dest = os.path.join('/tmp', os.path.basename(arg[1]))
+                if permissions is None:
+                    permissions = '0500'
+
+            with open(arg[0], 'rb') as src:
+                vm.inject_file(dest, content=src.read(),
+                               permissions=permissions)
+
+            if arg[1] == 'RUN':
+                vm.run_command(dest)
+                vm.run_command(['rm', dest])
+
+    # run commands
+    for cmd in args.run_cmd:
+        vm.run_command(cmd)
+
+    # load authorized SSH keys
+    authorized_keys = [open(f).read() for f in args.ssh_key]
+
+    # decide on groups
+    if args.base_image is None or 'fedora' in args.base_image.lower():
+        groups = ['wheel', 'adm', 'systemd-journal']
+    else:
+        groups = ['wheel']
+
+    # configure user
+    vm.configure_user(args.user, args.password, groups, authorized_keys,
+                      password_hash=args.password_hash)
+
+    vm.userdata.set_boot_profile(args.boot_profile)
+    if args.guest_agent:
+        vm.add_agent_channel()
+
+    # set up the networking
+    net_parts = args.net.split(':')
+    net_type = net_parts[0]
+    net_args = {}
+    if len(net_parts) > 1:
+        net_args = {v[0]: v[1] for v in
+                    (kv.split('=') for kv in net_parts[1].split(','))}
+    vm.configure_networking(net_type, **net_args)
+
+    if args.pkg_cache is not None:
+        vm.use_package_cache(args.pkg_cache)
+
+    if args.http_seed:
+        from vmup import seedserver
+
+        server = seedserver.active_server()
+        if server is None:
+            sys.exit("--http-seed needs vmupd running with --seed-server")
+
+        # NB: the guest has to reach the seed server before it's seen its
+        #     network config, so it has to come up with DHCP
+        if net_args.get('ip', 'auto') != 'auto':
+            sys.exit("--http-seed can't be used with a static ip=, since "
+                     "the guest needs DHCP to fetch its seed")
+
+        vm.use_seed_server(server)
+
+    # configure YUM repos (fetching any remote ones all at once)
+    remote_repos = [repo for repo in args.add_repo
+                    if repo.startswith('http://') or
+                    repo.startswith('https://')]
+    try:
+        fetched_repos = dict(zip(remote_repos,
+                                 web.get_all_cached(remote_repos)))
+    except requests.RequestException as ex:
+        sys.exit("Unable to fetch repo file: %s" % ex)
+
+    for repo in args.add_repo:
+        if repo in fetched_repos:
+            repo_file_contents = fetched_repos[repo]
+        else:
+            with open(repo) as repo_file:
+                repo_file_contents = repo_file.read()
+
+        vm.use_repo(repo_file_contents)
+
+    # NB: sross Fedora seems to have some AVC issues with doing an upgrade
+    # vm.upgrade_all_packages()
+    # install packages
+    for pkg in (pkg for pkglist in args.add_packages for pkg in pkglist):
+        vm.install_package(*pkg.split('-', 1))
+
+    # try to take over a pre-provisioned VM from the warm pool
+    # NB: spares only ever have the one (overlay) disk, and boot through
+    #     their firmware
+    if (args.warm_class is not None and not reconciling and
+            (args.disk or args.flatten or args.direct_kernel_boot)):
+        LOG.info("Not using the warm pool, since its spares can't have "
+                 "extra, flattened, or directly booted disks")
+    elif args.warm_class is not None and not reconciling:
+        from vmup import warmpool
+
+        pool = warmpool.WarmPool(conn_uri=args.conn,
+                                 image_dir=args.image_dir)
+        if pool.claim(vm, args.warm_class, args.size, args.base_image):
+            return
+
+    # newly downloaded images get imported into a host-friendly format
+    normalize = None
+    if args.import_format != 'none':
+        normalize = dict(fmt=args.import_format,
+                         cluster_size=args.import_cluster_size)
+        if args.import_prealloc != 'off':
+            normalize['preallocation'] = args.import_prealloc
+
+    image_budget = _parse_budget(args.image_budget)
+
+    backing_file = vm.fetch_base_image(args.base_image, args.always_fetch,
+                                       normalize=normalize,
+                                       peers=args.image_peer)
+
+    if args.direct_kernel_boot:
+        try:
+            vm.use_direct_kernel_boot(backing_file)
+        except Exception as ex:
+            sys.exit("Unable to set up direct kernel boot: %s" % ex)
+
+    # provision the disks
+    disks = [dict(name='main', size=args.size, backing_file=backing_file,
+                  flatten=args.flatten)]
+    for arg in (arg.split(':') for arg in args.disk):
+        if len(arg) < 2:
+            sys.exit("Invalid disk specification '%s'" % ':'.join(arg))
+
+        try:
+            disk = dict(name=arg[0], size=disk_helper.normalize_size(arg[1]))
+        except ValueError as ex:
+            sys.exit(str(ex))
+
+        if len(arg) > 2 and arg[2]:
+            disk['backing_file'] = vm.fetch_base_image(
+                arg[2], args.always_fetch, normalize=normalize,
+                peers=args.image_peer)
+            disk['flatten'] = args.flatten
+
+        if len(arg) > 3 and arg[3]:
+            opts = [kv.split('=', 1) for kv in arg[3].split(',')]
+            for opt in opts:
+                if len(opt) != 2 or opt[0] not in builder.DISK_OPTS:
+                    sys.exit("Invalid disk option '%s' (may be %s)" %
+                             ('='.join(opt), ', '.join(builder.DISK_OPTS)))
+
+            disk.update(opts)
+
+        disks.append(disk)
+
+    # only make the changes needed to bring the existing VM up to date
+    if reconciling:
+        from vmup import reconcile
+
+        changes = reconcile.plan(vm, disks)
+        # NB: this goes through LOG, so that vmupd clients see it too
+        if not changes:
+            LOG.info("VM '%s' is up to date" % vm.name)
+
+        for change in changes:
+            LOG.info(change.summary)
+
+        if args.apply:
+            reconcile.apply(changes, vm)
+
+        return
+
+    vm.provision_disks(disks, overwrite=args.burn)
+
+    # write out any remaining data
+    vm.finalize(recreate_ci=args.new_ci_data)
+
+    # define the VM and launch it
+    vm.launch(redefine=args.new_ci_data)
+
+    # NB: this waits until the VM is defined, so that its own base image
+    #     counts as in use (and the VM is up either way, so failing to
+    #     evict shouldn't fail the provision)
+    if args.image_budget is not None or args.image_budget_count is not None:
+        from vmup import cleanup
+
+        try:
+            removed, _ = cleanup.evict(builder.get_connection(args.conn),
+                                       image_dir=args.image_dir,
+                                       max_size=image_budget,
+                                       max_count=args.image_budget_count)
+        except Exception as ex:
+            LOG.warning("Unable to evict base images: %s" % ex)
+            return
+
+        for img in removed:
+            LOG.info("Evicted base image '%s'" % img.name)
+
+
+def socket_path():
+    if os.environ.get('VMUP_SOCKET'):
+        return os.environ['VMUP_SOCKET']
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'vmup.sock')
+
+    return os.path.expanduser('~/.vmup.sock')
+
+
+def call_daemon(raw_args, path=None):
+    # returns None if there's no daemon to talk to, otherwise
+    # the exit status of the request
+    if path is None:
+        path = socket_path()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    LOG.debug("Handing request off to vmupd at '%s'..." % path)
+
+    with sock, sock.makefile('rw') as conn:
+        req = {'argv': raw_args, 'cwd': os.getcwd()}
+        conn.write(json.dumps(req) + '\n')
+        conn.flush()
+
+        # the daemon streams back log lines, then a final status
+        for line in conn:
+            msg = json.loads(line)
+            if 'log' in msg:
+                print(msg['log'], file=sys.stderr)
+            else:
+                if msg.get('error'):
+                    print(msg['error'], file=sys.stderr)
+
+                return msg['status']
+
+    raise Exception("vmupd closed the connection unexpectedly")
+
+
+def _parse_command_args(cmd_parser, argv):
+    # the options shared by all the commands
+    cmd_parser.add_argument("--image-dir", default="POOL:default",
+                            help=("the directory or pool in which images "
+                                  "are stored (default: POOL:default)"))
+    cmd_parser.add_argument("--conn", metavar="URI", default="qemu:///system",
+                            help="the libvirt connection to use")
+    cmd_parser.add_argument("-v", metavar="LEVEL", default='INFO',
+                            help="set the logging verbosity (default: info)")
+
+    cmd_args = cmd_parser.parse_args(argv)
+
+    level = cmd_args.v.upper()
+    if level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        sys.exit('Invalid verbosity %s' % cmd_args.v)
+
+    logging.basicConfig(level=getattr(logging, level))
+    return cmd_args
+
+
+def _fmt_bytes(num_bytes):
+    return '%.1f MiB' % (num_bytes / 2**20)
+
+
+def _print_removed(images, reclaimed, dry_run):
+    for img in images:
+        print("%s %s (%s)" % ('would remove' if dry_run else 'removed',
+                              img.name, _fmt_bytes(img.size)))
+
+    print("%s %s" % ('would reclaim' if dry_run else 'reclaimed',
+                     _fmt_bytes(reclaimed)))
+
+
+def destroy_command(argv):
+    from vmup import builder
+    from vmup import cleanup
+
+    cmd_parser = argparse.ArgumentParser(prog="vmup destroy")
+    cmd_parser.add_argument("names", nargs='+', metavar="NAME",
+                            help="the VMs to stop, undefine, and remove")
+    cmd_parser.add_argument("--keep-disks", action='store_true',
+                            default=False,
+                            help="don't remove the VMs' disks and seeds")
+    cmd_parser.add_argument("--dry-run", action='store_true', default=False,
+                            help="only list what would be removed")
+    cmd_parser.add_argument("--protect", metavar="PATTERN", action='append',
+                            default=[],
+                            help=("never remove VMs or images matching "
+                                  "this glob pattern"))
+    cmd_parser.add_argument("--scratch-dir", metavar="PATH",
+                            default=builder.SCRATCH_DIR,
+                            help=("where ephemeral VMs keep their disks "
+                                  "(default: %s)" % builder.SCRATCH_DIR))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    names = [name.replace('.', '-') for name in cmd_args.names]
+    try:
+        removed, reclaimed = cleanup.destroy(
+            conn, names, image_dir=cmd_args.image_dir,
+            keep_disks=cmd_args.keep_disks, dry_run=cmd_args.dry_run,
+            protect=cmd_args.protect, scratch_dir=cmd_args.scratch_dir)
+    except ValueError as ex:
+        sys.exit(str(ex))
+
+    _print_removed(removed, reclaimed, cmd_args.dry_run)
+
+
+def gc_command(argv):
+    from vmup import builder
+    from vmup import cleanup
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup gc", description=("remove disks and cloud-init seeds "
+                                     "left behind by VMs that no longer "
+                                     "exist"))
+    cmd_parser.add_argument("--dry-run", action='store_true', default=False,
+                            help="only list what would be removed")
+    cmd_parser.add_argument("--protect", metavar="PATTERN", action='append',
+                            default=[],
+                            help="never remove images matching this glob")
+    cmd_parser.add_argument("--scratch-dir", metavar="PATH",
+                            default=builder.SCRATCH_DIR,
+                            help=("where ephemeral VMs keep their disks "
+                                  "(default: %s)" % builder.SCRATCH_DIR))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    removed, reclaimed = cleanup.gc(conn, image_dir=cmd_args.image_dir,
+                                    dry_run=cmd_args.dry_run,
+                                    protect=cmd_args.protect)
+
+    for name in cleanup.reap_ephemeral(conn, cmd_args.scratch_dir,
+                                       dry_run=cmd_args.dry_run):
+        print("%s ephemeral VM %s" % ('would clean up' if cmd_args.dry_run
+                                      else 'cleaned up', name))
+
+    _print_removed(removed, reclaimed, cmd_args.dry_run)
+
+
+def warm_pool_command(argv):
+    from vmup import warmpool
+
+    cmd_parser = argparse.ArgumentParser(prog="vmup warm-pool")
+    cmd_parser.add_argument("action", choices=['fill', 'status'])
+    cmd_parser.add_argument("classes", nargs='*',
+                            metavar="NAME=COUNT[:IMAGE[:SIZE[:MEMORY"
+                                    "[:CPUS[:MODE]]]]]",
+                            help=("the warm pool classes to fill (MODE may "
+                                  "be defined, paused, or saved, default: "
+                                  "fedora, 20GiB, 3GiB, 2 CPUs, defined)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    try:
+        classes = [warmpool.parse_class(c) for c in cmd_args.classes]
+    except ValueError as ex:
+        sys.exit(str(ex))
+
+    pool = warmpool.WarmPool(conn_uri=cmd_args.conn,
+                             image_dir=cmd_args.image_dir)
+
+    if cmd_args.action == 'fill':
+        for cls in classes:
+            made = pool.fill(cls)
+            print("%s: created %s spare(s)" % (cls.name, made))
+
+        return
+
+    for cls in classes:
+        print("%s: %s spare(s) available" % (cls.name,
+                                             len(pool.spares(cls.name))))
+
+    stats = pool.stats()
+    claims = stats['hits'] + stats['misses']
+    print("claims: %s (%s hits, %s misses, %.0f%% hit rate)" %
+          (claims, stats['hits'], stats['misses'],
+           100.0 * stats['hits'] / claims if claims else 0))
+
+    latencies = sorted(stats['latencies'])
+    if latencies:
+        print("claim latency: %.2fs median, %.2fs max (last %s claims)" %
+              (latencies[len(latencies) // 2], latencies[-1],
+               len(latencies)))
+
+
+def _fmt_kib(kib):
+    return '-' if kib is None else '%.0f MiB' % (kib / 1024)
+
+
+def mem_stats_command(argv):
+    from vmup import builder
+    from vmup import fleet
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup mem-stats", description=("show how much memory each "
+                                             "running VM actually uses"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    usage = fleet.memory_usage(conn)
+
+    row_fmt = "%-30s %12s %12s %12s %12s"
+    print(row_fmt % ('NAME', 'ASSIGNED', 'BALLOON', 'RSS', 'UNUSED'))
+    for dom in usage:
+        print(row_fmt % (dom.name, _fmt_kib(dom.assigned),
+                         _fmt_kib(dom.balloon), _fmt_kib(dom.rss),
+                         _fmt_kib(dom.unused)))
+
+    assigned = sum(dom.assigned or 0 for dom in usage)
+    rss = sum(dom.rss or 0 for dom in usage)
+    print("total: %s assigned, %s resident" % (_fmt_kib(assigned),
+                                               _fmt_kib(rss)))
+
+    shared = fleet.ksm_shared()
+    if shared is not None:
+        print("KSM is saving %s" % _fmt_kib(shared))
+
+
+def _parse_budget(size):
+    from vmup import disk as disk_helper
+
+    if size is None:
+        return None
+
+    try:
+        return disk_helper.size_to_bytes(disk_helper.normalize_size(size))
+    except ValueError as ex:
+        sys.exit(str(ex))
+
+
+def images_command(argv):
+    from vmup import builder
+    from vmup import cleanup
+    from vmup import images
+    from vmup import peers
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup images",
+        description=("keep the base images for aliases up to date in the "
+                     "background (e.g. from a systemd timer), show how "
+                     "fresh they are, evict old ones no VM uses, or serve "
+                     "them to other hosts"))
+    cmd_parser.add_argument("action",
+                            choices=['sync', 'status', 'evict', 'serve'])
+    cmd_parser.add_argument("aliases", nargs='*', metavar="ALIAS",
+                            help=("the image aliases, like fedora or "
+                                  "fedora-29 (default: %s)" %
+                                  ', '.join(images.DEFAULT_ALIASES)))
+    cmd_parser.add_argument('--import-format',
+                            choices=['qcow2', 'raw', 'none'],
+                            default='qcow2',
+                            help=("convert new images into this format "
+                                  "(default: qcow2, see 'vmup --help')"))
+    cmd_parser.add_argument('--import-cluster-size', metavar='SIZE',
+                            default='2M',
+                            help="the cluster size for imported qcow2 images")
+    cmd_parser.add_argument('--import-prealloc', choices=['off', 'metadata'],
+                            default='off',
+                            help=("preallocation mode for imported qcow2 "
+                                  "images (default: off)"))
+    cmd_parser.add_argument('--measure-import', action='store_true',
+                            default=False,
+                            help=("compare the read throughput of new images "
+                                  "before and after importing them (reads "
+                                  "an extra 2 GiB per image)"))
+    cmd_parser.add_argument('--max-size', metavar='SIZE',
+                            help=("evict the least recently used base images "
+                                  "no VM depends on until the rest fit in "
+                                  "SIZE (also applies after a sync)"))
+    cmd_parser.add_argument('--max-count', metavar='N', type=int,
+                            help="like --max-size, but keep at most N images")
+    cmd_parser.add_argument("--dry-run", action='store_true', default=False,
+                            help="only list what would be evicted")
+    cmd_parser.add_argument("--protect", metavar="PATTERN", action='append',
+                            default=[],
+                            help="never evict images matching this glob")
+    cmd_parser.add_argument('--image-peer', metavar='URL', action='append',
+                            default=[],
+                            help=("try fetching from this vmup host first "
+                                  "(see 'vmup --help')"))
+    cmd_parser.add_argument('--extract-kernel', action='store_true',
+                            default=False,
+                            help=("also extract the kernels of synced "
+                                  "images ahead of time, for "
+                                  "'vmup --direct-kernel-boot'"))
+    cmd_parser.add_argument("--listen", metavar="ADDR[:PORT]",
+                            default="0.0.0.0:%s" % peers.DEFAULT_PORT,
+                            help=("the address to serve images on (default: "
+                                  "0.0.0.0:%s)" % peers.DEFAULT_PORT))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    max_size = _parse_budget(cmd_args.max_size)
+    budgeted = max_size is not None or cmd_args.max_count is not None
+
+    aliases = cmd_args.aliases or images.DEFAULT_ALIASES
+
+    conn = builder.get_connection(cmd_args.conn)
+    loc_type, loc = builder.resolve_image_dir(conn, cmd_args.image_dir)
+    img_dir, pool = (None, loc) if loc_type == 'pool' else (loc, None)
+
+    if cmd_args.action == 'sync':
+        normalize = None
+        if cmd_args.import_format != 'none':
+            normalize = dict(fmt=cmd_args.import_format,
+                             cluster_size=cmd_args.import_cluster_size)
+            if cmd_args.import_prealloc != 'off':
+                normalize['preallocation'] = cmd_args.import_prealloc
+            if cmd_args.measure_import:
+                normalize['measure'] = True
+
+        try:
+            results = images.sync(aliases, img_dir=img_dir, pool=pool,
+                                  normalize=normalize,
+                                  peers=cmd_args.image_peer)
+        except ValueError as ex:
+            sys.exit(str(ex))
+
+        for res in results:
+            if res.error is not None:
+                print("%s: failed: %s" % (res.alias, res.error))
+            else:
+                print("%s: %s (%s)" % (res.alias, res.image,
+                                       'fetched' if res.fetched
+                                       else 'up to date'))
+
+        if cmd_args.extract_kernel:
+            from vmup import kernelboot
+
+            for res in results:
+                if res.error is not None:
+                    continue
+
+                if pool is not None:
+                    path = pool.storageVolLookupByName(res.image).path()
+                else:
+                    path = os.path.join(img_dir, res.image)
+
+                try:
+                    kernelboot.boot_files(path)
+                except Exception as ex:
+                    print("%s: unable to extract the kernel: %s" %
+                          (res.alias, ex))
+
+        if budgeted:
+            removed, reclaimed = cleanup.evict(
+                conn, image_dir=cmd_args.image_dir, max_size=max_size,
+                max_count=cmd_args.max_count, dry_run=cmd_args.dry_run,
+                protect=cmd_args.protect)
+            _print_removed(removed, reclaimed, cmd_args.dry_run)
+
+        if any(res.error is not None for res in results):
+            sys.exit(1)
+
+        return
+    elif cmd_args.action == 'serve':
+        from vmup import disk as disk_helper
+        from vmup import pkgcache
+
+        host, port = pkgcache.parse_address(cmd_args.listen,
+                                            default_port=peers.DEFAULT_PORT)
+        server = peers.ImageServer(
+            (host, port),
+            lambda name: disk_helper.shared_image_path(name, img_dir, pool))
+        LOG.info("Serving base images on %s:%s..." % (host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+        return
+    elif cmd_args.action == 'evict':
+        if not budgeted:
+            sys.exit("Give a budget with --max-size and/or --max-count")
+
+        removed, reclaimed = cleanup.evict(
+            conn, image_dir=cmd_args.image_dir, max_size=max_size,
+            max_count=cmd_args.max_count, dry_run=cmd_args.dry_run,
+            protect=cmd_args.protect)
+        _print_removed(removed, reclaimed, cmd_args.dry_run)
+        return
+
+    for alias in aliases:
+        image = images.local_image(alias, img_dir=img_dir, pool=pool)
+        if image is None:
+            print("%s: no local image" % alias)
+            continue
+
+        fresh = images.freshness(alias, image)
+        print("%s: %s (%s%s)" % (alias, image, fresh.summary,
+                                 ', stale' if fresh.stale else ''))
+
+
+def pkg_cache_command(argv):
+    from vmup import pkgcache
+    from vmup import web
+
+    cmd_parser = argparse.ArgumentParser(prog="vmup pkg-cache")
+    cmd_parser.add_argument("action", choices=['serve', 'stats'])
+    cmd_parser.add_argument("--listen", metavar="ADDR[:PORT]",
+                            default="192.168.122.1:3142",
+                            help=("the address to serve on, which should be "
+                                  "reachable from the VMs (default: "
+                                  "192.168.122.1:3142)"))
+    cmd_parser.add_argument("--cache-dir", default=pkgcache.CACHE_DIR,
+                            help=("where to store cached packages (default: "
+                                  "%s)" % pkgcache.CACHE_DIR))
+    cmd_parser.add_argument("--allow", metavar="HOST|URL", action='append',
+                            default=[],
+                            help=("only fetch from the given upstream host "
+                                  "(or that of the given repo baseurl); may "
+                                  "be given multiple times (default: any "
+                                  "host but the local one)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    host, port = pkgcache.parse_address(cmd_args.listen)
+
+    if cmd_args.action == 'stats':
+        url = 'http://%s:%s/_stats' % (host, port)
+        stats = web.session().get(url, timeout=web.DEFAULT_TIMEOUT).json()
+    else:
+        cache = pkgcache.PackageCache(cmd_args.cache_dir)
+        server = pkgcache.CacheServer((host, port), cache,
+                                      allowed_hosts=cmd_args.allow or None)
+        LOG.info("Serving package cache on %s:%s..." % (host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+        stats = cache.stats
+
+    requests_served = stats['hits'] + stats['misses']
+    print("%s hits, %s misses (%.0f%% hit rate)" %
+          (stats['hits'], stats['misses'],
+           100.0 * stats['hits'] / requests_served
+           if requests_served else 0))
+    print("%s served, %s fetched" % (_fmt_bytes(stats['bytes_served']),
+                                     _fmt_bytes(stats['bytes_fetched'])))
+
+
+def chains_command(argv):
+    from vmup import builder
+    from vmup import chains
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup chains", description=("show the backing chain of each "
+                                         "VM disk, and which VMs depend on "
+                                         "which base images"))
+    cmd_parser.add_argument("names", nargs='*', metavar="NAME",
+                            help="the VMs to show (default: all of them)")
+    cmd_parser.add_argument("--by-base", action='store_true', default=False,
+                            help="group the disks by the base images they "
+                                 "use")
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    doms = None
+    if cmd_args.names:
+        doms = [builder.lookup_domain(conn, name.replace('.', '-'))
+                for name in cmd_args.names]
+
+    disk_chains = chains.domain_chains(conn, doms)
+
+    if cmd_args.by_base:
+        deps = chains.dependents(disk_chains)
+        for base in sorted(deps):
+            print(base)
+            for dep in deps[base]:
+                print("  %s (%s)" % (dep.domain, dep.target))
+
+        return
+
+    for dep in disk_chains:
+        print("%s (%s): depth %s" % (dep.domain, dep.target,
+                                     len(dep.chain) - 1))
+        for depth, link in enumerate(dep.chain):
+            print("%s%s [%s]" % ('  ' * (depth + 1), link.path, link.fmt))
+
+
+def collapse_command(argv):
+    from vmup import builder
+    from vmup import chains
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup collapse", description=("shorten a running VM's backing "
+                                           "chain with a block job, without "
+                                           "stopping it"))
+    cmd_parser.add_argument("name", metavar="NAME")
+    cmd_parser.add_argument("--disk", metavar="TARGET",
+                            help=("the disk to collapse, like vda "
+                                  "(default: all of them)"))
+    cmd_parser.add_argument("--commit", action='store_true', default=False,
+                            help=("merge the disk down into its base "
+                                  "instead of pulling the base up into the "
+                                  "disk (only if no other VM uses the "
+                                  "base)"))
+    cmd_parser.add_argument("--force", action='store_true', default=False,
+                            help=("with --commit, merge into the base even "
+                                  "if it's a fetched base image"))
+    cmd_parser.add_argument("--base", metavar="PATH",
+                            help=("stop at this image in the chain, instead "
+                                  "of collapsing all of it"))
+    cmd_parser.add_argument("--bandwidth", metavar="MIB/S", type=int,
+                            default=50,
+                            help=("throttle the job to this many MiB/s, or "
+                                  "0 for unlimited (default: 50)"))
+    cmd_parser.add_argument("--no-wait", action='store_true', default=False,
+                            help=("leave the job running in the background "
+                                  "(--commit always waits, to switch the "
+                                  "VM over at the end)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    dom = builder.lookup_domain(conn, cmd_args.name.replace('.', '-'))
+
+    targets = [cmd_args.disk]
+    if cmd_args.disk is None:
+        targets = [target for target, path in chains.domain_disks(conn, dom)]
+
+    bases = set()
+    for disk_chain in chains.domain_chains(conn, [dom]):
+        bases.update(link.path for link in disk_chain.chain[1:])
+
+    try:
+        # NB: check every disk first, so that nothing gets started when
+        #     one of them can't be committed
+        if cmd_args.commit:
+            for target in targets:
+                chains.check_commit(conn, dom, target, base=cmd_args.base,
+                                    force=cmd_args.force)
+
+        for target in targets:
+            if cmd_args.commit:
+                chains.commit(conn, dom, target, base=cmd_args.base,
+                              bandwidth=cmd_args.bandwidth,
+                              force=cmd_args.force)
+            else:
+                chains.pull(dom, target, base=cmd_args.base,
+                            bandwidth=cmd_args.bandwidth)
+    except ValueError as ex:
+        sys.exit(str(ex))
+
+    if cmd_args.no_wait and not cmd_args.commit:
+        return
+
+    for target in targets:
+        chains.wait(dom, target)
+
+    # report the bases that nothing needs anymore, so they can be removed
+    in_use = chains.dependents(chains.domain_chains(conn))
+    for base in sorted(bases - set(in_use)):
+        print("no longer used: %s" % base)
+
+
+def checkpoint_command(argv):
+    from vmup import builder
+    from vmup import checkpoint
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup checkpoint", description=("save a provisioned VM's "
+                                             "disks (and optionally "
+                                             "memory), to quickly go back "
+                                             "to with 'vmup reset'"))
+    cmd_parser.add_argument("name", metavar="NAME")
+    cmd_parser.add_argument("--memory", action='store_true', default=False,
+                            help=("save the VM's memory too, so that reset "
+                                  "skips booting entirely"))
+    cmd_parser.add_argument("--no-wait", action='store_true', default=False,
+                            help=("don't wait for cloud-init to finish "
+                                  "first (which needs the guest agent)"))
+    cmd_parser.add_argument("--timeout", type=int, default=600,
+                            help=("how long to wait for cloud-init, in "
+                                  "seconds (default: 600)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    dom = builder.lookup_domain(conn, cmd_args.name.replace('.', '-'))
+    try:
+        checkpoint.checkpoint(conn, dom, memory=cmd_args.memory,
+                              wait=not cmd_args.no_wait,
+                              timeout=cmd_args.timeout)
+    except ValueError as ex:
+        sys.exit(str(ex))
+
+
+def reset_command(argv):
+    from vmup import builder
+    from vmup import checkpoint
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup reset", description=("throw away all changes to VMs "
+                                        "since their checkpoints"))
+    cmd_parser.add_argument("names", nargs='+', metavar="NAME")
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    for name in cmd_args.names:
+        dom = builder.lookup_domain(conn, name.replace('.', '-'))
+        try:
+            elapsed = checkpoint.reset(conn, dom)
+        except ValueError as ex:
+            sys.exit(str(ex))
+
+        print("%s: reset in %.2fs" % (dom.name(), elapsed))
+
+
+def _print_results(results):
+    failed = False
+    for res in results:
+        if res.error is not None:
+            print("%s: failed: %s" % (res.name, res.error))
+            failed = True
+        else:
+            print("%s: %s (%.2fs)" % (res.name, res.action, res.elapsed))
+
+    if failed:
+        sys.exit(1)
+
+
+def suspend_command(argv):
+    from vmup import builder
+    from vmup import power
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup suspend", description=("save running VMs to disk, to "
+                                          "pick up where they left off "
+                                          "with 'vmup resume'"))
+    cmd_parser.add_argument("names", nargs='*', metavar="NAME")
+    cmd_parser.add_argument("--all", action='store_true', default=False,
+                            help="suspend all running VMs")
+    cmd_parser.add_argument("--compress", metavar="FORMAT",
+                            choices=power.SAVE_FORMATS,
+                            help=("compress the save images (one of %s, "
+                                  "needs a recent libvirt)" %
+                                  ', '.join(power.SAVE_FORMATS)))
+    cmd_parser.add_argument("--parallel", type=int, default=4,
+                            help=("how many VMs to save at once "
+                                  "(default: 4)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    if cmd_args.all:
+        doms = power.running_domains(conn)
+    else:
+        doms = [builder.lookup_domain(conn, name.replace('.', '-'))
+                for name in cmd_args.names]
+
+    _print_results(power.suspend(doms, image_format=cmd_args.compress,
+                                 max_workers=cmd_args.parallel))
+
+
+def resume_command(argv):
+    from vmup import builder
+    from vmup import power
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup resume", description="restore suspended VMs")
+    cmd_parser.add_argument("names", nargs='*', metavar="NAME")
+    cmd_parser.add_argument("--all", action='store_true', default=False,
+                            help="resume all suspended VMs")
+    cmd_parser.add_argument("--parallel", type=int, default=4,
+                            help=("how many VMs to restore at once "
+                                  "(default: 4)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    conn = builder.get_connection(cmd_args.conn)
+    if cmd_args.all:
+        doms = power.saved_domains(conn)
+    else:
+        doms = [builder.lookup_domain(conn, name.replace('.', '-'))
+                for name in cmd_args.names]
+
+    _print_results(power.resume(doms, max_workers=cmd_args.parallel))
+
+
+def place_command(argv):
+    from vmup import placement
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup place", description=("decide which hosts a set of VMs "
+                                        "should go on, based on their free "
+                                        "capacity"))
+    cmd_parser.add_argument("vms", nargs='*',
+                            metavar="NAME[:MEMORY[:CPUS[:SIZE]]]",
+                            help=("the VMs to place (default: 3GiB, 2 CPUs, "
+                                  "20GiB)"))
+    cmd_parser.add_argument("--host", metavar="URI", action='append',
+                            required=True,
+                            help="a host to consider (may be repeated)")
+    cmd_parser.add_argument("--manifest", metavar="FILE",
+                            help=("a YAML list of VMs to place, each with a "
+                                  "name, and optionally memory, cpus, and "
+                                  "size"))
+    cmd_parser.add_argument("--policy", choices=sorted(placement.POLICIES),
+                            default='spread',
+                            help="the placement policy (default: spread)")
+    cmd_parser.add_argument("--mem-overcommit", type=float, default=1.0,
+                            help=("how far to overcommit host memory "
+                                  "(default: 1.0, i.e. not at all)"))
+    cmd_parser.add_argument("--cpu-overcommit", type=float, default=4.0,
+                            help=("how many vCPUs to allow per host CPU "
+                                  "(default: 4.0)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    try:
+        reqs = []
+        if cmd_args.manifest is not None:
+            reqs.extend(placement.load_manifest(cmd_args.manifest))
+
+        for spec in cmd_args.vms:
+            parts = spec.split(':')
+            opts = dict(zip(('memory', 'cpus', 'size'), parts[1:]))
+            reqs.append(placement.make_request(
+                parts[0], **{k: v for k, v in opts.items() if v}))
+
+        hosts = placement.gather(cmd_args.host, cmd_args.image_dir)
+        placed = placement.place(hosts, reqs, policy=cmd_args.policy,
+                                 mem_overcommit=cmd_args.mem_overcommit,
+                                 cpu_overcommit=cmd_args.cpu_overcommit)
+    except ValueError as ex:
+        sys.exit(str(ex))
+
+    for host in hosts:
+        print("%s: %s CPUs (%s committed), %s memory (%s committed)" %
+              (host.uri, host.cpus, host.committed_cpus,
+               _fmt_kib(host.memory), _fmt_kib(host.committed_memory)))
+
+    for req in reqs:
+        print("%s -> %s" % (req.name, placed[req.name]))
+
+
+def boot_bench_command(argv):
+    import time
+
+    from vmup import agent
+    from vmup import builder
+    from vmup import cleanup
+
+    cmd_parser = argparse.ArgumentParser(
+        prog="vmup boot-bench",
+        description=("measure how long VMs take to finish cloud-init with "
+                     "each boot profile (the image needs to have "
+                     "qemu-guest-agent)"))
+    cmd_parser.add_argument("--profile", action='append',
+                            choices=['minimal', 'default', 'full'],
+                            help="a profile to measure (default: all)")
+    cmd_parser.add_argument("--runs", type=int, default=3,
+                            help="how many VMs to boot per profile")
+    cmd_parser.add_argument("--timeout", type=int, default=600,
+                            help=("how long to wait for each VM, in "
+                                  "seconds (default: 600)"))
+    cmd_parser.add_argument("vmup_args", nargs=argparse.REMAINDER,
+                            help=("extra options for provisioning the VMs "
+                                  "(e.g. -- --base-image fedora-29)"))
+    cmd_args = _parse_command_args(cmd_parser, argv)
+
+    profiles = cmd_args.profile or ['minimal', 'default', 'full']
+    extra_args = [arg for arg in cmd_args.vmup_args if arg != '--']
+
+    conn = builder.get_connection(cmd_args.conn)
+    for profile in profiles:
+        times = []
+        for run in range(cmd_args.runs):
+            name = 'vmup-bench-%s-%s' % (profile, run)
+            args = parse_args([name, '--boot-profile', profile,
+                               '--guest-agent', '--burn', '--no-daemon',
+                               '--conn', cmd_args.conn,
+                               '--image-dir', cmd_args.image_dir] +
+                              extra_args)
+
+            start = time.time()
+            try:
+                provision(args)
+                agent.wait_for_cloud_init(conn.lookupByName(name),
+                                          cmd_args.timeout)
+                times.append(time.time() - start)
+            finally:
+                # NB: provisioning may have failed before defining the VM
+                if name in (dom.name() for dom in conn.listAllDomains()):
+                    cleanup.destroy(conn, [name],
+                                    image_dir=cmd_args.image_dir)
+
+        if not times:
+            print("%s: no runs" % profile)
+            continue
+
+        times.sort()
+        print("%s: %.1fs median, %.1fs min, %.1fs max (%s runs)" %
+              (profile, times[len(times) // 2], times[0], times[-1],
+               len(times)))
+
+
+# commands other than bringing up a VM, which is the default
+COMMANDS = {
+    'boot-bench': boot_bench_command,
+    'chains': chains_command,
+    'checkpoint': checkpoint_command,
+    'collapse': collapse_command,
+    'destroy': destroy_command,
+    'gc': gc_command,
+    'images': images_command,
+    'mem-stats': mem_stats_command,
+    'pkg-cache': pkg_cache_command,
+    'place': place_command,
+    'reset': reset_command,
+    'resume': resume_command,
+    'suspend': suspend_command,
+    'warm-pool': warm_pool_command,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    raw_args = read_args(argv)
+    args = parse_args(raw_args)
+
+    logging.basicConfig(level=getattr(logging, args.v))
+
+    if not args.no_daemon:
+        status = call_daemon(raw_args)
+        if status is not None:
+            sys.exit(status)
+
+    LOG.debug('All arguments: %s' % raw_args)
+    provision(args)
@@ -0,0 +1,254 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import traceback
+
+from vmup import cli
+
+# NB: load these up front, so that requests don't pay for the imports
+from vmup import builder
+from vmup import disk
+
+
+LOG = logging.getLogger(__name__)
+
+
+class _ClientLogHandler(logging.Handler):
+    # streams log records back to the client as they happen
+    # NB: this only passes on records from the thread handling the
+    #     request, and not from background ones (e.g. the warm pool
+    #     refill, or the servers)
+    def __init__(self, conn, level=logging.NOTSET):
+        super(_ClientLogHandler, self).__init__(level)
+        self._conn = conn
+        self.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+        thread = threading.get_ident()
+        self.addFilter(lambda record: record.thread == thread)
+
+    def emit(self, record):
+        try:
+            self._conn.write(json.dumps({'log': self.format(record)}) + '\n')
+            self._conn.flush()
+        except OSError:
+            # the client went away, but we still want to finish
+            pass
+
+
+def _send_status(conn, status, error=None):
+    conn.write(json.dumps({'status': status, 'error': error}) + '\n')
+    conn.flush()
+
+
+def handle_request(conn, req):
+    # NB: relative paths (shares, files, templates, .vmup) are relative to
+    #     the client, so requests have to be handled one at a time
+    try:
+        os.chdir(req['cwd'])
+    except OSError as ex:
+        _send_status(conn, 1, "Unable to use the working directory "
+                              "'%s': %s" % (req['cwd'], ex))
+        return
+
+    try:
+        args = cli.parse_args(req['argv'])
+    except SystemExit as ex:
+        _send_status(conn, 2, "Invalid arguments: %s" % ex.code)
+        return
+
+    handler = _ClientLogHandler(conn, getattr(logging, args.v))
+    root_log = logging.getLogger()
+    root_log.addHandler(handler)
+
+    status = 0
+    error = None
+    try:
+        cli.provision(args)
+    except SystemExit as ex:
+        if isinstance(ex.code, str):
+            status, error = 1, ex.code
+        else:
+            status = ex.code or 0
+    except Exception:
+        status, error = 1, traceback.format_exc()
+    finally:
+        root_log.removeHandler(handler)
+
+    LOG.info("Request for '%s' finished with status %s" % (args.name, status))
+    _send_status(conn, status, error)
+
+
+def serve(path):
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            LOG.debug("Removing stale socket '%s'..." % path)
+            os.remove(path)
+        else:
+            raise ValueError("vmupd is already listening on '%s'" % path)
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # only the current user should be able to submit requests
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+
+    sock.listen()
+    LOG.info("Listening on '%s'..." % path)
+
+    try:
+        while True:
+            client, _ = sock.accept()
+            with client, client.makefile('rw') as conn:
+                try:
+                    line = conn.readline()
+                    if not line:
+                        continue
+
+                    handle_request(conn, json.loads(line))
+                except (OSError, ValueError, KeyError) as ex:
+                    LOG.warning("Dropping bad request: %s" % ex)
+    finally:
+        sock.close()
+        os.remove(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="vmupd")
+    parser.add_argument("--socket", metavar="PATH",
+                        help=("the socket to listen on (default: "
+                              "$VMUP_SOCKET, or vmup.sock in "
+                              "$XDG_RUNTIME_DIR)"),
+                        default=cli.socket_path())
+    parser.add_argument("--warm-pool", metavar="NAME=COUNT[:...]",
+                        help=("keep the given warm pool class filled in the "
+                              "background (see 'vmup warm-pool')"),
+                        action="append", default=[])
+    parser.add_argument("--pkg-cache", metavar="ADDR[:PORT]", default=None,
+                        help=("also serve a host package cache on the "
+                              "given address (see 'vmup pkg-cache')"))
+    parser.add_argument("--pkg-cache-allow", metavar="HOST|URL",
+                        action="append", default=[],
+                        help=("only let the package cache fetch from the "
+                              "given upstream host (or that of the given "
+                              "repo baseurl)"))
+    parser.add_argument("--seed-server", metavar="ADDR[:PORT]",
+                        default=None,
+                        help=("serve cloud-init seeds over HTTP on the given "
+                              "address, which should be reachable from the "
+                              "VMs (see 'vmup --http-seed')"))
+    parser.add_argument("--seed-advertise", metavar="ADDR", default=None,
+                        help=("the address the VMs should fetch their "
+                              "seeds from (required if --seed-server "
+                              "binds to a wildcard address)"))
+    parser.add_argument("--serve-images", metavar="ADDR[:PORT]",
+                        default=None,
+                        help=("serve downloaded base images to other vmup "
+                              "hosts on the given address (see 'vmup "
+                              "--image-peer')"))
+    parser.add_argument("--reap-ephemeral", action='store_true',
+                        default=False,
+                        help=("clean up after ephemeral VMs as soon as "
+                              "they stop (see 'vmup --ephemeral')"))
+    parser.add_argument("--scratch-dir", metavar="PATH", default=None,
+                        help=("where ephemeral VMs keep their disks "
+                              "(default: /dev/shm/vmup)"))
+    parser.add_argument("--conn", metavar="URI", default="qemu:///system",
+                        help=("the libvirt connection for the warm pool "
+                              "and the ephemeral VM reaper"))
+    parser.add_argument("--image-dir", default="POOL:default",
+                        help=("the directory or pool for the warm pool "
+                              "and served images"))
+    parser.add_argument("-v", metavar="LEVEL", default='INFO',
+                        help="set the logging verbosity (may be debug, info, "
+                             "warning, error, or critical, default: info)")
+
+    args = parser.parse_args(argv)
+
+    level = args.v.upper()
+    if level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        sys.exit('Invalid verbosity %s' % args.v)
+
+    # let everything through to the handlers, which each
+    # have their own level (ours, or the client's)
+    handler = logging.StreamHandler()
+    handler.setLevel(getattr(logging, level))
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    if args.warm_pool:
+        from vmup import warmpool
+
+        try:
+            classes = [warmpool.parse_class(c) for c in args.warm_pool]
+        except ValueError as ex:
+            sys.exit(str(ex))
+
+        pool = warmpool.WarmPool(conn_uri=args.conn,
+                                 image_dir=args.image_dir)
+        pool.start_refill(classes)
+
+    if args.pkg_cache is not None:
+        from vmup import pkgcache
+
+        server = pkgcache.CacheServer(
+            pkgcache.parse_address(args.pkg_cache), pkgcache.PackageCache(),
+            allowed_hosts=args.pkg_cache_allow or None)
+        server.start()
+
+    if args.seed_server is not None:
+        from vmup import pkgcache
+        from vmup import seedserver
+
+        host, port = pkgcache.parse_address(args.seed_server,
+                                            default_port=8642)
+        try:
+            server = seedserver.SeedServer((host, port),
+                                           seedserver.SeedStore(),
+                                           advertise=args.seed_advertise)
+        except ValueError as ex:
+            sys.exit(str(ex))
+
+        server.start()
+        LOG.info("Serving cloud-init seeds on %s:%s (as %s)..."
+                 % (host, port, server.advertise))
+
+    if args.serve_images is not None:
+        from vmup import peers
+        from vmup import pkgcache
+
+        host, port = pkgcache.parse_address(args.serve_images,
+                                            default_port=peers.DEFAULT_PORT)
+        loc_type, loc = builder.resolve_image_dir(
+            builder.get_connection(args.conn), args.image_dir)
+        img_dir, pool = (None, loc) if loc_type == 'pool' else (loc, None)
+
+        server = peers.ImageServer(
+            (host, port),
+            lambda name: disk.shared_image_path(name, img_dir, pool))
+        server.start()
+        LOG.info("Serving base images on %s:%s..." % (host, port))
+
+    if args.reap_ephemeral:
+        from vmup import builder
+        from vmup import ephemeral
+
+        ephemeral.watch(args.conn, args.scratch_dir or builder.SCRATCH_DIR)
+        LOG.info("Cleaning up after ephemeral VMs...")
+
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        pass
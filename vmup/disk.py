@@ -1,21 +1,49 @@
 import collections
+import contextlib
+import errno
+import fcntl
 import ftplib
+import json
 import logging
 import os
 import re
 import requests
 import subprocess
+import time
 import urllib.parse as urlparse
 
 import libvirt
 
+from vmup import peers as peer_helper
 from vmup import virxml as vx
+from vmup import web
 
 LOG = logging.getLogger(__name__)
 
 ImageInfo = collections.namedtuple('ImageInfo', ['full_name', 'version',
                                                  'fmt', 'compression'])
 
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+# the errors that mean "this filesystem can't do that", rather than
+# "something went wrong"
+_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                       errno.EINVAL, errno.ENOSYS)
+
+# how long to trust mirror and release listings (in seconds) before
+# asking again -- this mainly matters for long-running users like vmupd
+LISTING_TTL = 600
+
+
+@contextlib.contextmanager
+def _fetch_lock(out_path):
+    lock_path = os.path.join(os.path.dirname(out_path),
+                             '.%s.lock' % os.path.basename(out_path))
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
 
 # HACKY STUFF TO GET THE LATEST RELEASE (THERE MUST BE A BETTER WAY TO DO THIS)
 class FedoraImageFetcher(object):
@@ -23,16 +51,40 @@ class FedoraImageFetcher(object):
     BASE_URL = ("https://download.fedoraproject.org/pub/fedora/linux/releases"
                 "/{release}/Cloud/x86_64/Images/{image}")
     MIRROR_LIST_URL = "https://mirrors.fedoraproject.org/mirrorlist"
-    NAME_RE_FORMAT = (r'^Fedora-Cloud-{image_type}-(\d+)-(\d{{8}})'
+    # the metadata for every image of the current releases (see
+    # https://fedoraproject.org/wiki/Infrastructure/MirrorManager)
+    RELEASES_URL = "https://fedoraproject.org/releases.json"
+    # NB: composes used to be dates (20180101), now they're like 1.5
+    NAME_RE_FORMAT = (r'^Fedora-Cloud-{image_type}-(\d+)-(\d{{8}}|\d+\.\d+)'
                       r'.x86_64.(\w+)(.(\w+))?$')
 
-    def __init__(self, image_type='Base'):
+    def __init__(self, image_type='Base', releases_url=None):
         raw_re = self.NAME_RE_FORMAT.format(image_type=image_type)
         self.NAME_RE = re.compile(raw_re)
 
+        # (this can point at a local stand-in, for testing)
+        self._releases_url = releases_url
+
+        self._mirrors = {}
+        self._listings = {}
+        self._index = None
+        self._links = {}
+        self._checksums = {}
+
     def _get_mirror(self, proto='ftp'):
-        resp = requests.get(self.MIRROR_LIST_URL,
-                            params={'path': 'pub/fedora/linux/releases/'})
+        cached = self._mirrors.get(proto)
+        if cached is not None and time.time() - cached[0] < LISTING_TTL:
+            return cached[1]
+
+        mirror_url = self._query_mirror(proto)
+        self._mirrors[proto] = (time.time(), mirror_url)
+        return mirror_url
+
+    def _query_mirror(self, proto='ftp'):
+        resp = web.session().get(
+            self.MIRROR_LIST_URL,
+            params={'path': 'pub/fedora/linux/releases/'},
+            timeout=web.DEFAULT_TIMEOUT)
         # TODO: check resp validity
         mirror_list = [r for r in resp.text.split('\n') if r]
 
@@ -51,6 +103,79 @@ class FedoraImageFetcher(object):
         return releases_nums[-1]
 
     def get_cloud_images(self, release=None):
+        cached = self._listings.get(release)
+        if cached is not None and time.time() - cached[0] < LISTING_TTL:
+            return iter(cached[1])
+
+        try:
+            files = self._index_cloud_images(release)
+        except (requests.RequestException, ValueError) as ex:
+            # older releases only show up in the directory listings
+            LOG.debug("Unable to use the release metadata, falling back "
+                      "to listing the FTP mirror: %s" % ex)
+            files = list(self._list_cloud_images(release))
+
+        self._listings[release] = (time.time(), files)
+        return iter(files)
+
+    def _get_index(self):
+        # [(release, ImageInfo, URL, sha256)] for every image published
+        # in the release metadata, which only gets fetched once per TTL
+        if (self._index is not None and
+                time.time() - self._index[0] < LISTING_TTL):
+            return self._index[1]
+
+        # NB: $VMUP_RELEASES_URL can point every fetcher at a saved copy
+        #     (e.g. served with 'python3 -m http.server'), to check the
+        #     parsing against a known index without touching the network
+        releases_url = (self._releases_url or
+                        os.environ.get('VMUP_RELEASES_URL') or
+                        self.RELEASES_URL)
+        resp = web.session().get(releases_url, timeout=web.DEFAULT_TIMEOUT)
+        resp.raise_for_status()
+
+        entries = []
+        for entry in resp.json():
+            if entry.get('arch') != 'x86_64' or not entry.get('link'):
+                continue
+
+            name = entry['link'].rsplit('/', 1)[-1]
+            m = self.NAME_RE.match(name)
+            if not m:
+                continue
+
+            entries.append((m.group(1),
+                            ImageInfo(name, (m.group(1), m.group(2)),
+                                      m.group(3), m.group(5)),
+                            entry['link'], entry.get('sha256')))
+
+        self._index = (time.time(), entries)
+        return entries
+
+    def _index_cloud_images(self, release=None):
+        entries = self._get_index()
+        if not entries:
+            raise ValueError("No %s images in the release metadata" %
+                             self.NAME_RE.pattern)
+
+        if release is None:
+            release = max(int(entry[0]) for entry in entries)
+
+        files = []
+        for entry_release, img_info, link, checksum in entries:
+            if entry_release == str(release):
+                files.append(img_info)
+                self._links[img_info.full_name] = link
+                if checksum is not None:
+                    self._checksums[img_info.full_name] = checksum
+
+        if not files:
+            raise ValueError("Release %s isn't in the release metadata" %
+                             release)
+
+        return files
+
+    def _list_cloud_images(self, release=None):
         mirror_url = self._get_mirror('ftp')
         ftp = ftplib.FTP(mirror_url.netloc)
         ftp.login()
@@ -95,36 +220,93 @@ class FedoraImageFetcher(object):
 
         return (desc.target.owner == os.getuid(), existing)
 
-    def fetch(self, image, release, img_dir=None, pool=None):
+    def fetch(self, image, release, img_dir=None, pool=None, normalize=None,
+              peers=()):
+        local_image = image
+        if normalize is not None:
+            local_image = normalized_name(image, normalize.get('fmt'))
+
         if pool is not None:
             pool.refresh()
-            perms, vol = self._init_img_vol(pool, image)
+            perms, vol = self._init_img_vol(pool, local_image)
             if not perms:
                 return vol.path()
 
             out_path = vol.path()
         else:
-            out_path = os.path.join(img_dir, image)
-
-        img_url = self.BASE_URL.format(release=release, image=image)
-
-        command = ['wget', '--no-verbose', '--show-progress',
-                   '--continue', img_url, '-O', out_path]
-
-        # TODO: print stdout/stderr on err
-        LOG.debug("Running command %s to fetch image..." % ['wget', img_url])
-        try:
-            # TODO: figure out a good way to show a progress bar w/o
-            #       writing directly to stdout
-            subprocess.check_call(command, cwd=img_dir,
-                                  universal_newlines=True)
-        except subprocess.CalledProcessError as ex:
-            # the CalledProcessError gets put in __cause__
-            # stdout/stderr are printed above
-            raise Exception("Image fetching failed: "
-                            "exit code %s" % ex.returncode)
-
-        return out_path
+            out_path = os.path.join(img_dir, local_image)
+
+        if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
+            LOG.info("Image '%s' is already present, not fetching "
+                     "again..." % local_image)
+            return out_path
+
+        # NB: only one process may download an image at a time, since
+        #     they'd all be resuming into the same temporary file
+        with _fetch_lock(out_path):
+            # ...and whoever held the lock may have fetched it already
+            if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
+                return out_path
+
+            # download to a temporary file first, and only put the image
+            # in place once it's complete, so nothing ever sees a partial
+            # image
+            dl_path = os.path.join(os.path.dirname(out_path),
+                                   '.tmp-%s' % image)
+
+            # other hosts will usually have imported the image the same
+            # way, so ask them for the finished product (which can only be
+            # checked against the upstream checksum if it wasn't converted)
+            if peers:
+                peer_path = os.path.join(os.path.dirname(out_path),
+                                         '.tmp-%s' % local_image)
+                checksum = None
+                if normalize is None:
+                    checksum = self._checksums.get(image)
+
+                if peer_helper.fetch(peers, local_image, peer_path,
+                                     checksum):
+                    os.rename(peer_path, out_path)
+                    peer_helper.record_checksum(out_path)
+                    if pool is not None:
+                        pool.refresh()
+
+                    return out_path
+
+            img_url = self._links.get(image)
+            if img_url is None:
+                img_url = self.BASE_URL.format(release=release, image=image)
+
+            command = ['wget', '--no-verbose', '--show-progress',
+                       '--continue', img_url, '-O', dl_path]
+
+            # TODO: print stdout/stderr on err
+            LOG.debug("Running command %s to fetch image..." %
+                      ['wget', img_url])
+            try:
+                # TODO: figure out a good way to show a progress bar w/o
+                #       writing directly to stdout
+                subprocess.check_call(command, cwd=img_dir,
+                                      universal_newlines=True)
+            except subprocess.CalledProcessError as ex:
+                # the CalledProcessError gets put in __cause__
+                # stdout/stderr are printed above
+                raise Exception("Image fetching failed: "
+                                "exit code %s" % ex.returncode)
+
+            if normalize is not None:
+                import_image(dl_path, out_path, **normalize)
+                os.remove(dl_path)
+            else:
+                os.rename(dl_path, out_path)
+
+            # for serving the image to other hosts (see 'vmup images serve')
+            peer_helper.record_checksum(out_path)
+
+            if pool is not None:
+                pool.refresh()
+
+            return out_path
 
     def find_local_images(self, img_dir=None, pool=None):
         if pool is not None:
@@ -139,7 +321,10 @@ class FedoraImageFetcher(object):
                                m.group(3), m.group(5))
                      for img, m in matches if m)
 
-        return img_files
+        # skip the placeholders for images that are still downloading
+        # (or whose download failed)
+        return (img for img in img_files
+                if image_present(img.full_name, img_dir, pool))
 
     def find_local_image(self, img_dir=None, pool=None,
                          version=None, fmt=None, compression=False):
@@ -170,7 +355,8 @@ class FedoraImageFetcher(object):
                             if img_info.version[1] == str(compose))
 
         res_imgs = sorted(res_imgs,
-                          key=lambda info: (info.version[0], info.version[1],
+                          key=lambda info: (int(info.version[0]),
+                                            _compose_key(info.version[1]),
                                             info.compression is None))
         if len(res_imgs) == 0:
             return None
@@ -179,51 +365,354 @@ class FedoraImageFetcher(object):
             return img
 
 
+def _compose_key(compose):
+    # so that compose 1.10 sorts after 1.9
+    return [int(part) for part in compose.split('.')]
+
+
+def image_present(name, img_dir=None, pool=None):
+    # whether the image exists, and isn't just an empty placeholder
+    if pool is not None:
+        try:
+            return pool.storageVolLookupByName(name).info()[1] > 0
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                raise
+
+            return False
+    else:
+        path = os.path.join(img_dir, name)
+        return os.path.exists(path) and os.path.getsize(path) > 0
+
+
 _IMAGE_FETCHERS = {'fedora': FedoraImageFetcher('Base'),
                    'fedora-atomic': FedoraImageFetcher('Atomic')}
 
 
-def fetch_image(name, img_dir=None, pool=None, check_local=True):
-    if name.startswith('/'):
-        ext = os.path.splitext(name)[1]
-        return ext, name
+def is_fetched_image(name):
+    # whether this looks like an image fetched for one of the aliases
+    return any(fetcher.NAME_RE.match(name)
+               for fetcher in _IMAGE_FETCHERS.values())
+
+
+def shared_image_path(name, img_dir=None, pool=None):
+    # the path of a base image other hosts may fetch from this one (see
+    # 'vmup images serve'), or None -- VM disks are never shared
+    if not is_fetched_image(name) or not image_present(name, img_dir, pool):
+        return None
 
-    parts = name.split('-')
-    image_type = parts[0]
-    version = None
-    if len(parts) > 1:
-        version = parts[1:]
+    if pool is not None:
+        return pool.storageVolLookupByName(name).path()
 
-    if _IMAGE_FETCHERS.get(image_type, None) is not None:
-        fetcher = _IMAGE_FETCHERS[image_type]
+    return os.path.join(img_dir, name)
 
-        if check_local:
-            img_info = fetcher.find_local_image(img_dir=img_dir, pool=pool,
-                                                version=version)
-            if img_info is not None:
-                if img_info.compression is not None:
-                    # TODO: warn and fall back to downloading?
-                    raise NotImplementedError("Unable to handle compressed "
-                                              "image %s" % img_info.full_name)
 
-                if pool is not None:
-                    res_img = img_info.full_name
-                else:
-                    res_img = os.path.join(img_dir, img_info.full_name)
+def parse_alias(name):
+    # 'fedora-29' --> the fetcher for 'fedora', and ['29'] (the longest
+    # alias wins, so that 'fedora-atomic-29' is Atomic, release 29)
+    for alias in sorted(_IMAGE_FETCHERS, key=len, reverse=True):
+        if name == alias:
+            return _IMAGE_FETCHERS[alias], None
+        elif name.startswith(alias + '-'):
+            return (_IMAGE_FETCHERS[alias],
+                    name[len(alias) + 1:].split('-'))
 
-                return (img_info.fmt, res_img)
+    raise ValueError("Unknown image alias '%s'" % name)
 
-        img_info = fetcher.get_image(version)
 
+def fetch_image(name, img_dir=None, pool=None, normalize=None, peers=()):
+    # NB: images always come from what's already local when possible,
+    #     so keeping them up to date is the job of 'vmup images sync',
+    #     and not something done on every VM's critical path
+    if name.startswith('/'):
+        ext = os.path.splitext(name)[1]
+        return ext, name
+
+    fetcher, version = parse_alias(name)
+
+    img_info = fetcher.find_local_image(img_dir=img_dir, pool=pool,
+                                        version=version)
+    if img_info is not None:
         if img_info.compression is not None:
+            # TODO: warn and fall back to downloading?
             raise NotImplementedError("Unable to handle compressed "
                                       "image %s" % img_info.full_name)
 
-        return (img_info.fmt, fetcher.fetch(img_info.full_name,
-                                            img_info.version[0],
-                                            img_dir=img_dir, pool=pool))
-    else:
-        raise ValueError("Unknown image alias '%s'" % name)
+        if pool is not None:
+            res_img = img_info.full_name
+        else:
+            res_img = os.path.join(img_dir, img_info.full_name)
+
+        return (img_info.fmt, res_img)
+
+    LOG.info("No local image for '%s', fetching one..." % name)
+    img_info = fetcher.get_image(version)
+
+    if img_info.compression is not None:
+        raise NotImplementedError("Unable to handle compressed "
+                                  "image %s" % img_info.full_name)
+
+    fmt = img_info.fmt
+    if normalize is not None:
+        fmt = normalize.get('fmt') or fmt
+
+    return (fmt, fetcher.fetch(img_info.full_name, img_info.version[0],
+                               img_dir=img_dir, pool=pool,
+                               normalize=normalize, peers=peers))
+
+
+def normalize_size(size):
+    # convert '100GiB' or '100 GiB' into the libvirt-style '100 GiB'
+    size_match = re.match(r'^(\d+)\s*(\w*)$', size.strip())
+    if size_match is None:
+        raise ValueError("Invalid size '%s'" % size)
+
+    return ' '.join(p for p in size_match.groups() if p)
+
+
+def size_to_bytes(size):
+    # follows libvirt's units: 'K' and 'KiB' are powers of 1024,
+    # while 'KB' is a power of 1000
+    amount, _, unit = size.strip().partition(' ')
+    unit = unit.lower()
+    if unit in ('', 'b', 'bytes'):
+        return int(amount)
+
+    base = 1000 if len(unit) == 2 and unit[1] == 'b' else 1024
+    return int(amount) * base ** 'bkmgtpe'.index(unit[0])
+
+
+def image_info(path):
+    # NB: -U lets us read images that a running VM has open
+    command = ['qemu-img', 'info', '--output=json', '-U', path]
+    try:
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+    except subprocess.CalledProcessError as ex:
+        # the CalledProcessError gets put in __cause__
+        raise Exception("Unable to inspect image '%s': %s" %
+                        (path, ex.stderr))
+
+    return json.loads(res.stdout)
+
+
+def image_chain(path):
+    # the info for the image and everything underneath it, top first
+    command = ['qemu-img', 'info', '--output=json', '--backing-chain',
+               '-U', path]
+    try:
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+    except subprocess.CalledProcessError as ex:
+        raise Exception("Unable to inspect image '%s': %s" %
+                        (path, ex.stderr))
+
+    return json.loads(res.stdout)
+
+
+def _reflink(src, dest):
+    fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+
+
+def _copy_range(src, dest):
+    # only copy the parts of the file that have data, leaving the holes
+    # as holes (copy_file_range alone would fill them in)
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    while offset < size:
+        try:
+            data_start = os.lseek(src.fileno(), offset, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                # nothing but a hole left
+                break
+            raise
+
+        data_end = os.lseek(src.fileno(), data_start, os.SEEK_HOLE)
+
+        pos = data_start
+        while pos < data_end:
+            copied = os.copy_file_range(src.fileno(), dest.fileno(),
+                                        data_end - pos, pos, pos)
+            if copied == 0:
+                break
+            pos += copied
+
+        offset = data_end
+
+    os.ftruncate(dest.fileno(), size)
+
+
+def clone_image(src_path, dest_path, fmt=None):
+    # make an independent copy of an image as quickly as the filesystem
+    # allows, returning the method used: a reflink (btrfs, XFS), then a
+    # sparse in-kernel copy, then qemu-img as a last resort
+    for method, copy_func in (('reflink', _reflink),
+                              ('copy_file_range', _copy_range)):
+        try:
+            with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+                copy_func(src, dest)
+
+            return method
+        except OSError as ex:
+            if ex.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+            LOG.debug("Unable to clone '%s' with %s: %s" %
+                      (src_path, method, ex))
+
+    command = ['qemu-img', 'convert', src_path, dest_path]
+    if fmt is not None:
+        command[2:2] = ['-O', fmt]
+
+    LOG.debug("Running command %s to clone image..." % command)
+    try:
+        subprocess.check_call(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    except subprocess.CalledProcessError as ex:
+        # the CalledProcessError gets put in __cause__
+        raise Exception("Image clone command failed: %s" % ex.stderr)
+
+    return 'qemu-img'
+
+
+def make_flat_disk(path, size, source_path, fmt='qcow2', overwrite=False):
+    # like make_disk_file, but the disk is a full copy of the source,
+    # instead of an overlay that depends on it
+    if os.path.exists(path):
+        if not overwrite:
+            LOG.info("Disk file '%s' exists, not recreating..." % path)
+            return None
+
+        LOG.info("Disk file '%s' exists, deleting to "
+                 "recreate..." % path)
+        os.remove(path)
+
+    start = time.time()
+    method = clone_image(source_path, path, fmt)
+
+    # grow the copy to the requested size, but never shrink it
+    new_size = size_to_bytes(size)
+    if new_size > image_info(path)['virtual-size']:
+        resize_disk_file(path, new_size)
+
+    LOG.info("Flattened disk '%s' using %s in %.2fs" %
+             (os.path.basename(path), method, time.time() - start))
+
+    return method
+
+
+def resize_disk_file(path, size):
+    command = ['qemu-img', 'resize', path, str(size)]
+
+    LOG.debug("Running command %s to resize disk..." % command)
+    try:
+        subprocess.check_call(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    except subprocess.CalledProcessError as ex:
+        # the CalledProcessError gets put in __cause__
+        raise Exception("Disk resize command failed: %s" % ex.stderr)
+
+
+def normalized_name(image, fmt=None):
+    # the format is part of the image name, so converting to
+    # raw means the image gets a new name
+    if fmt is None or fmt == 'qcow2':
+        return image
+
+    base, _ = os.path.splitext(image)
+    return '%s.%s' % (base, fmt)
+
+
+def measure_read_throughput(path, fmt=None, count=1024,
+                            buf_size=1024 * 1024):
+    # have qemu read the image the same way a guest would, through
+    # whatever format layer (compression, clusters, etc) it has
+    command = ['qemu-img', 'bench', '-c', str(count),
+               '-s', str(buf_size)]
+    if fmt is not None:
+        command.extend(['-f', fmt])
+
+    command.append(path)
+
+    LOG.debug("Running command %s to measure read throughput..." % command)
+    try:
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+    except (subprocess.CalledProcessError, OSError) as ex:
+        LOG.debug("Unable to measure read throughput of '%s': %s" %
+                  (path, ex))
+        return None
+
+    match = re.search(r'Run completed in ([0-9.]+) seconds', res.stdout)
+    if match is None or float(match.group(1)) == 0:
+        return None
+
+    # NB: bench wraps around at the end of the image, so this is
+    #     the amount read even for images smaller than count * buf_size
+    return count * buf_size / float(match.group(1))
+
+
+def import_image(src_path, dest_path, fmt='qcow2', cluster_size='2M',
+                 preallocation=None, src_fmt=None, measure=False):
+    # convert a downloaded image into a layout that's quick to read
+    # as a backing file: no compressed clusters, large clusters, and
+    # (optionally) preallocated metadata or just a flat raw file
+    # NB: measuring reads a GiB from each image, so it's opt-in
+    #     (see 'vmup images sync --measure-import')
+    if fmt is None:
+        fmt = 'qcow2'
+
+    command = ['qemu-img', 'convert', '-O', fmt]
+    if src_fmt is not None:
+        command.extend(['-f', src_fmt])
+
+    opts = []
+    if fmt == 'qcow2':
+        opts.append('cluster_size=%s' % cluster_size)
+        if preallocation is not None:
+            opts.append('preallocation=%s' % preallocation)
+
+    if opts:
+        command.extend(['-o', ','.join(opts)])
+
+    # write to a temporary name, then rename into place
+    # so that nothing ever sees a partially converted image
+    tmp_path = os.path.join(os.path.dirname(dest_path),
+                            '.tmp-import-%s' % os.path.basename(dest_path))
+    command.extend([src_path, tmp_path])
+
+    before = None
+    if measure:
+        before = measure_read_throughput(src_path, src_fmt)
+
+    LOG.info("Importing image '%s' as %s..." %
+             (os.path.basename(dest_path), fmt))
+    LOG.debug("Running command %s to import image..." % command)
+    try:
+        subprocess.check_call(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    except subprocess.CalledProcessError as ex:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        # the CalledProcessError gets put in __cause__
+        raise Exception("Image import failed: %s" % ex.stderr)
+
+    os.rename(tmp_path, dest_path)
+
+    if before is not None:
+        after = measure_read_throughput(dest_path, fmt)
+        if after is not None:
+            LOG.info("Read throughput of imported image: %.1f MiB/s "
+                     "(was %.1f MiB/s; advisory only, page cache and "
+                     "other I/O skew this)" %
+                     (after / 2**20, before / 2**20))
+
+    return dest_path
 
 
 def _vol_conf(name, size, fmt='raw', backing_file=None, owned=False):
@@ -275,6 +764,25 @@ def make_iso_file(output_path, volid, *source_files,
             raise Exception("cloud-init iso file creation "
                             "failed: %s" % ex.stderr)
 
+        return output_path
+
+
+def make_overlay(path, backing_file, backing_fmt='qcow2'):
+    # a fresh, empty qcow2 on top of the given image, of the same size
+    command = ['qemu-img', 'create', '-f', 'qcow2', '-b', backing_file,
+               '-F', backing_fmt, path]
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    LOG.debug("Running command %s to create overlay..." % command)
+    try:
+        subprocess.run(command, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True,
+                       universal_newlines=True)
+    except subprocess.CalledProcessError as ex:
+        raise Exception("Overlay creation failed: %s" % ex.stderr)
+
 
 def make_disk_file(path, size, backing_file=None,
                    fmt='qcow2', overwrite=False):
@@ -287,7 +795,7 @@ def make_disk_file(path, size, backing_file=None,
     # convert from a libvirt-style size to a qemu-img-style size
     size_parts = size.split(' ')
     if len(size_parts) > 1:
-        size_parts[1] = size_parts[1][1]
+        size_parts[1] = size_parts[1][0]
 
     command.append(''.join(size_parts))
 
@@ -311,8 +819,11 @@ def make_disk_file(path, size, backing_file=None,
 
 
 def make_disk_volume(pool, name, size, fmt='qcow2',
-                     backing_file=None, overwrite=True):
-    pool.refresh()
+                     backing_file=None, overwrite=True, refresh=True):
+    # NB: pass refresh=False when creating several volumes at once, and
+    #     refresh the pool around all of them instead
+    if refresh:
+        pool.refresh()
 
     try:
         existing = pool.storageVolLookupByName(name)
@@ -373,3 +884,39 @@ def make_iso_volume(pool, name, volid, *source_files,
         # the CalledProcessError gets put in __cause__
         raise Exception("cloud-init iso file creation "
                         "failed: %s" % ex.stderr)
+
+    return vol
+
+
+def make_flat_volume(pool, name, size, source_path, fmt='qcow2',
+                     overwrite=False, refresh=True):
+    # like make_disk_volume, but the volume is a full copy of the source
+    # (this needs a file-backed pool, like 'dir' or 'fs')
+    if refresh:
+        pool.refresh()
+
+    try:
+        existing = pool.storageVolLookupByName(name)
+    except libvirt.libvirtError as ex:
+        if ex.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+            raise
+    else:
+        if not overwrite:
+            LOG.info("Disk volume '%s' exists in pool '%s', "
+                     "not recreating..." % (name, pool.name()))
+            return None
+
+        LOG.info("Disk volume '%s' exists in pool '%s', deleting to "
+                 "recreate..." % (name, pool.name()))
+        existing.delete()
+
+    conf = _vol_conf(name, '0 KiB', 'raw', owned=True)
+    vol = pool.createXML(conf.to_xml(encoding=str))
+
+    method = make_flat_disk(vol.path(), size, source_path, fmt=fmt,
+                            overwrite=True)
+
+    # have libvirt notice the new format and size
+    if refresh:
+        pool.refresh()
+    return method
@@ -0,0 +1,67 @@
+import logging
+import os
+import queue
+import threading
+
+import libvirt
+
+from vmup import builder
+from vmup import cleanup
+
+LOG = logging.getLogger(__name__)
+
+
+def _on_lifecycle(conn, dom, event, detail, stopped):
+    # NB: this runs in the event loop, so hand the actual work off
+    if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+        stopped.put(dom.name())
+
+
+def _run_events():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def _reap(conn, stopped, scratch_dir):
+    while True:
+        name = stopped.get()
+        if not os.path.isdir(builder.scratch_path(name, scratch_dir)):
+            continue
+
+        # a persistent domain by the same name isn't ours to clean up
+        try:
+            if conn.lookupByName(name).isPersistent():
+                continue
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                LOG.warning("Unable to check on '%s': %s" % (name, ex))
+                continue
+
+        LOG.info("Ephemeral VM '%s' stopped, cleaning up..." % name)
+        try:
+            cleanup.remove_scratch(conn, name, scratch_dir)
+        except Exception as ex:
+            LOG.warning("Unable to clean up after '%s': %s" % (name, ex))
+
+
+def watch(conn_uri, scratch_dir=builder.SCRATCH_DIR):
+    # Clean up after each ephemeral VM (see 'vmup --ephemeral') as soon
+    # as it stops, from background threads (e.g. in vmupd).  Anything
+    # that stopped while nobody was watching gets cleaned up right away.
+    # NB: the event loop has to be in place before the connection is
+    #     opened, so this gets a connection of its own
+    libvirt.virEventRegisterDefaultImpl()
+    conn = libvirt.open(conn_uri)
+
+    cleanup.reap_ephemeral(conn, scratch_dir)
+
+    stopped = queue.Queue()
+    conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                _on_lifecycle, stopped)
+
+    threading.Thread(target=_run_events, name='libvirt-events',
+                     daemon=True).start()
+    threading.Thread(target=_reap, args=(conn, stopped, scratch_dir),
+                     name='ephemeral-reaper', daemon=True).start()
+
+    return conn
@@ -0,0 +1,45 @@
+import collections
+import logging
+import os
+
+import libvirt
+
+LOG = logging.getLogger(__name__)
+
+MemoryUsage = collections.namedtuple('MemoryUsage', ['name', 'assigned',
+                                                     'balloon', 'rss',
+                                                     'unused', 'usable'])
+
+_KSM_DIR = '/sys/kernel/mm/ksm'
+
+
+def memory_usage(conn):
+    # NB: this is the bulk form of memoryStats, so it's one call for the
+    #     whole host, instead of one per domain (all values are in KiB,
+    #     and are None when the guest doesn't report them)
+    all_stats = conn.getAllDomainStats(
+        libvirt.VIR_DOMAIN_STATS_BALLOON,
+        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+
+    usage = []
+    for dom, stats in all_stats:
+        usage.append(MemoryUsage(dom.name(),
+                                 stats.get('balloon.maximum'),
+                                 stats.get('balloon.current'),
+                                 stats.get('balloon.rss'),
+                                 stats.get('balloon.unused'),
+                                 stats.get('balloon.usable')))
+
+    return sorted(usage, key=lambda u: u.rss or 0, reverse=True)
+
+
+def ksm_shared():
+    # the amount of memory (in KiB) that KSM is currently saving, if it's
+    # available on this host (this is only meaningful for local hosts)
+    try:
+        with open('%s/pages_sharing' % _KSM_DIR) as sharing_file:
+            pages = int(sharing_file.read())
+    except (OSError, ValueError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
@@ -0,0 +1,164 @@
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from vmup import disk as disk_helper
+
+LOG = logging.getLogger(__name__)
+
+STATE_PATH = '~/.cache/vmup/image-sync.json'
+USAGE_PATH = '~/.cache/vmup/image-usage.json'
+
+DEFAULT_ALIASES = ('fedora', 'fedora-atomic')
+
+# how long after a sync provisioning starts complaining about freshness
+MAX_SYNC_AGE = 2 * 24 * 60 * 60
+
+SyncResult = collections.namedtuple('SyncResult', ['alias', 'image',
+                                                   'fetched', 'error'])
+
+# upstream is the latest image seen by the last sync, and age is the time
+# since that sync (both None if the alias was never synced)
+Freshness = collections.namedtuple('Freshness', ['alias', 'image',
+                                                 'upstream', 'age', 'stale',
+                                                 'summary'])
+
+
+def load_state(path=STATE_PATH):
+    try:
+        with open(os.path.expanduser(path)) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_state(state, path=STATE_PATH):
+    # NB: the temporary name is unique, so that concurrent writers (e.g.
+    #     vmupd's threads) never rename each other's files away
+    path = os.path.expanduser(path)
+    tmp_path = '%s.tmp-%s-%s' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+
+    os.rename(tmp_path, path)
+
+
+@contextlib.contextmanager
+def _update_lock(path):
+    # for read-modify-write updates, which would otherwise lose each
+    # other's changes
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+@contextlib.contextmanager
+def _sync_lock(path=STATE_PATH):
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ValueError("Another image sync is already running")
+
+        yield
+
+
+def sync(aliases=DEFAULT_ALIASES, img_dir=None, pool=None, normalize=None,
+         peers=()):
+    # Make sure the latest image for each alias is present locally.
+    # Downloads go to temporary names first (see FedoraImageFetcher.fetch),
+    # so VMs being provisioned meanwhile only ever see complete images.
+    results = []
+    fmt = normalize.get('fmt') if normalize is not None else None
+    with _sync_lock():
+        state = load_state()
+        for alias in aliases:
+            try:
+                fetcher, version = disk_helper.parse_alias(alias)
+                upstream = fetcher.get_image(version)
+                local_name = disk_helper.normalized_name(upstream.full_name,
+                                                         fmt)
+
+                present = disk_helper.image_present(local_name, img_dir,
+                                                    pool)
+                if not present:
+                    LOG.info("Fetching '%s' for '%s'..." %
+                             (upstream.full_name, alias))
+                    fetcher.fetch(upstream.full_name, upstream.version[0],
+                                  img_dir=img_dir, pool=pool,
+                                  normalize=normalize, peers=peers)
+            except Exception as ex:
+                # keep going, so that one bad alias doesn't hold up the rest
+                LOG.warning("Unable to sync '%s': %s" % (alias, ex))
+                results.append(SyncResult(alias, None, False, str(ex)))
+                continue
+
+            state[alias] = {'upstream': upstream.full_name,
+                            'local': local_name, 'checked': time.time()}
+            _save_state(state)
+
+            results.append(SyncResult(alias, local_name, not present, None))
+
+    return results
+
+
+def last_used(path=USAGE_PATH):
+    # image names to when a VM was last created from them
+    return load_state(path)
+
+
+def record_use(image, path=USAGE_PATH):
+    with _update_lock(path):
+        usage = last_used(path)
+        usage[os.path.basename(image)] = time.time()
+        _save_state(usage, path)
+
+
+def forget(images, path=USAGE_PATH):
+    with _update_lock(path):
+        usage = last_used(path)
+        if any([usage.pop(image, None) is not None for image in images]):
+            _save_state(usage, path)
+
+
+def local_image(alias, img_dir=None, pool=None):
+    fetcher, version = disk_helper.parse_alias(alias)
+    img_info = fetcher.find_local_image(img_dir=img_dir, pool=pool,
+                                        version=version)
+    return img_info.full_name if img_info is not None else None
+
+
+def _fmt_age(seconds):
+    if seconds < 60 * 60:
+        return '%.0fm' % (seconds / 60)
+    elif seconds < 24 * 60 * 60:
+        return '%.1fh' % (seconds / 60 / 60)
+    else:
+        return '%.1fd' % (seconds / 24 / 60 / 60)
+
+
+def freshness(alias, image):
+    # how the given local image for an alias compares to the last sync
+    image = os.path.basename(image)
+
+    entry = load_state().get(alias)
+    if entry is None:
+        return Freshness(alias, image, None, None, True, 'never synced')
+
+    age = time.time() - entry['checked']
+    summary = 'synced %s ago' % _fmt_age(age)
+    stale = age > MAX_SYNC_AGE
+    if entry['local'] != image:
+        summary += ", but the latest is '%s'" % entry['upstream']
+        stale = True
+
+    return Freshness(alias, image, entry['upstream'], age, stale, summary)
@@ -0,0 +1,189 @@
+import contextlib
+import fcntl
+import ipaddress
+import json
+import logging
+import os
+
+import libvirt
+from lxml import etree
+
+LOG = logging.getLogger(__name__)
+
+STATE_DIR = '~/.cache/vmup/ipam'
+
+_ADD_HOST = libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST
+_MODIFY_HOST = libvirt.VIR_NETWORK_UPDATE_COMMAND_MODIFY
+_DELETE_HOST = libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE
+
+
+class IPAllocator(object):
+    # Hands out addresses from a libvirt network's DHCP range, and reserves
+    # them for each VM's MAC address, so that the guest gets its address
+    # on the very first DHCP exchange.  Allocations are tracked in a state
+    # file, so that they survive across runs (and hosts that aren't up).
+    # Nothing is recorded until commit, so that VMs that never get
+    # created don't hold on to their addresses.
+
+    def __init__(self, conn, network_name, state_dir=STATE_DIR):
+        self._conn = conn
+        self._net = conn.networkLookupByName(network_name)
+        self._state_path = os.path.join(os.path.expanduser(state_dir),
+                                        '%s.json' % network_name)
+
+        # (host XML, command) pairs waiting for commit(), along with the
+        # state changes that go with them (name --> allocation, or None
+        # for released names)
+        self._pending = []
+        self._pending_state = {}
+
+    def _dhcp_elem(self):
+        desc = etree.fromstring(self._net.XMLDesc())
+        for ip_elem in desc.findall('ip'):
+            dhcp = ip_elem.find('dhcp')
+            if dhcp is not None and dhcp.find('range') is not None:
+                return dhcp
+
+        raise ValueError("Network '%s' has no DHCP range to allocate "
+                         "from" % self._net.name())
+
+    @contextlib.contextmanager
+    def _state(self):
+        os.makedirs(os.path.dirname(self._state_path), exist_ok=True)
+        with open(self._state_path, 'a+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            raw = state_file.read()
+            state = json.loads(raw) if raw else {}
+
+            yield state
+
+            state_file.seek(0)
+            state_file.truncate()
+            json.dump(state, state_file, indent=2, sort_keys=True)
+
+    def allocate(self, name, mac):
+        # returns the address for the VM, queueing up a reservation
+        # for it if needed (see commit)
+        dhcp = self._dhcp_elem()
+        hosts = {h.get('mac'): h for h in dhcp.findall('host')}
+
+        with self._state() as state:
+            ip = None
+
+            existing = hosts.get(mac)
+            if existing is not None and existing.get('ip'):
+                ip = existing.get('ip')
+            elif name in state:
+                # NB: a recreated VM keeps its address, even with a new MAC
+                ip = state[name]['ip']
+
+            # drop any entries left over from before the VM was recreated
+            for old in hosts.values():
+                if old.get('name') == name and old.get('mac') != mac:
+                    self._pending.append(
+                        (etree.tostring(old, encoding=str), _DELETE_HOST))
+
+            if ip is None:
+                ip = self._next_free(dhcp, state)
+
+        # NB: a host entry for the MAC without an address has to be
+        #     modified, since libvirt refuses a second one for the same MAC
+        host = etree.Element('host', mac=mac, name=name, ip=ip)
+        if existing is None:
+            self._pending.append(
+                (etree.tostring(host, encoding=str), _ADD_HOST))
+        elif existing.get('ip') != ip:
+            self._pending.append(
+                (etree.tostring(host, encoding=str), _MODIFY_HOST))
+
+        self._pending_state[name] = {'mac': mac, 'ip': ip}
+
+        LOG.debug("Allocated %s to '%s' (%s)" % (ip, name, mac))
+        return ip
+
+    def reassign(self, old_mac, new_mac):
+        # move an uncommitted allocation over to another MAC (e.g. that of
+        # a claimed warm pool spare, which keeps its own)
+        # NB: this assumes the new MAC has no host entry of its own yet
+        pending = []
+        for host_xml, command in self._pending:
+            host = etree.fromstring(host_xml)
+            if host.get('mac') == old_mac:
+                host.set('mac', new_mac)
+            pending.append((etree.tostring(host, encoding=str), command))
+
+        self._pending = pending
+        for alloc in self._pending_state.values():
+            if alloc is not None and alloc['mac'] == old_mac:
+                alloc['mac'] = new_mac
+
+    def release(self, mac):
+        dhcp = self._dhcp_elem()
+        for host in dhcp.findall('host'):
+            if host.get('mac') == mac:
+                self._pending.append(
+                    (etree.tostring(host, encoding=str), _DELETE_HOST))
+
+        with self._state() as state:
+            for name in [n for n, a in state.items() if a['mac'] == mac]:
+                self._pending_state[name] = None
+
+        for name, alloc in list(self._pending_state.items()):
+            if alloc is not None and alloc['mac'] == mac:
+                self._pending_state[name] = None
+
+    def commit(self):
+        # push all the queued reservations to libvirt in one go
+        flags = libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG
+        if self._net.isActive():
+            flags |= libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE
+
+        with self._state() as state:
+            # someone else may have taken the address since it was
+            # allocated (nothing is recorded until now)
+            for name, alloc in self._pending_state.items():
+                taken = next((other for other, a in state.items()
+                              if alloc is not None and other != name and
+                              a['ip'] == alloc['ip']), None)
+                if taken is not None:
+                    raise ValueError("Address %s was taken by '%s' in the "
+                                     "meantime" % (alloc['ip'], taken))
+
+            for host_xml, command in self._pending:
+                self._net.update(command,
+                                 libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
+                                 -1, host_xml, flags)
+
+            for name, alloc in self._pending_state.items():
+                if alloc is None:
+                    state.pop(name, None)
+                else:
+                    state[name] = alloc
+
+        if self._pending:
+            LOG.info("Updated %s DHCP reservation(s) in network '%s'" %
+                     (len(self._pending), self._net.name()))
+
+        self._pending = []
+        self._pending_state = {}
+
+    def _next_free(self, dhcp, state):
+        used = set(h.get('ip') for h in dhcp.findall('host'))
+        used.update(a['ip'] for a in state.values())
+        if self._net.isActive():
+            used.update(lease['ipaddr'] for lease in self._net.DHCPLeases())
+
+        for ip_range in dhcp.findall('range'):
+            start = ipaddress.ip_address(ip_range.get('start'))
+            end = ipaddress.ip_address(ip_range.get('end'))
+
+            addr = start
+            while addr <= end:
+                if str(addr) not in used:
+                    return str(addr)
+
+                addr += 1
+
+        raise ValueError("No free addresses left in network '%s'" %
+                         self._net.name())
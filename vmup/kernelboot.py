@@ -0,0 +1,204 @@
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+LOG = logging.getLogger(__name__)
+
+BootFiles = collections.namedtuple('BootFiles', ['kernel', 'initrd',
+                                                 'cmdline'])
+
+# the extracted files, kept next to the image they came from
+# (as hidden files, so that they don't show up as volumes)
+_CACHE_EXTS = {'kernel': 'vmlinuz', 'initrd': 'initrd', 'meta': 'boot.json'}
+
+
+def _cache_path(image_path, kind):
+    img_dir, name = os.path.split(image_path)
+    return os.path.join(img_dir, '.%s.%s' % (name, _CACHE_EXTS[kind]))
+
+
+def _image_key(image_path):
+    # NB: importing or re-fetching an image always writes a new file, so
+    #     this changes whenever the image does
+    stat = os.stat(image_path)
+    return '%s:%s' % (stat.st_size, stat.st_mtime_ns)
+
+
+def _run(command, image_path):
+    LOG.debug("Running command %s..." % command)
+    try:
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+    except subprocess.CalledProcessError as ex:
+        # the CalledProcessError gets put in __cause__
+        raise Exception("Unable to read the boot files from '%s': %s" %
+                        (image_path, ex.stderr))
+
+    return res.stdout
+
+
+def _read_file(image_path, path):
+    return _run(['virt-cat', '-a', image_path, path], image_path)
+
+
+def _try_read(command, image_path):
+    # NB: not every image has every file, so a missing one is just empty
+    try:
+        return _run(command, image_path)
+    except Exception as ex:
+        LOG.debug(str(ex))
+        return ''
+
+
+def _expand_kernelopts(image_path, val):
+    if '$kernelopts' in val:
+        grubenv = _try_read(['virt-cat', '-a', image_path,
+                             '/boot/grub2/grubenv'], image_path)
+        opts = next((line[len('kernelopts='):]
+                     for line in grubenv.splitlines()
+                     if line.startswith('kernelopts=')), '')
+        val = val.replace('$kernelopts', opts)
+
+    return val.strip()
+
+
+def _entry_cmdline(image_path, version):
+    # the options line of the kernel's boot loader entry
+    entries = _try_read(['virt-ls', '-a', image_path,
+                         '/boot/loader/entries'], image_path).split()
+    entries = [entry for entry in entries
+               if version in entry and 'rescue' not in entry]
+    if not entries:
+        return ''
+
+    entry = _read_file(image_path, '/boot/loader/entries/%s' % entries[0])
+    for line in entry.splitlines():
+        key, _, val = line.partition(' ')
+        if key == 'options':
+            return _expand_kernelopts(image_path, val)
+
+    return ''
+
+
+def _grub_cmdline(image_path, version):
+    # the arguments on the kernel's linux (or linux16) line in grub.cfg
+    grub_cfg = _try_read(['virt-cat', '-a', image_path,
+                          '/boot/grub2/grub.cfg'], image_path)
+    for line in grub_cfg.splitlines():
+        parts = line.split(None, 2)
+        if (len(parts) == 3 and parts[0] in ('linux', 'linux16') and
+                version in parts[1]):
+            return _expand_kernelopts(image_path, parts[2])
+
+    return ''
+
+
+def _root_cmdline(image_path, version):
+    # Fedora keeps the kernel arguments in its boot loader entries (with
+    # the common ones in grubenv on some releases), in
+    # /etc/kernel/cmdline on newer ones, and in grub.cfg on older ones
+    cmdline = (_entry_cmdline(image_path, version) or
+               _try_read(['virt-cat', '-a', image_path,
+                          '/etc/kernel/cmdline'], image_path).strip() or
+               _grub_cmdline(image_path, version))
+    if not cmdline:
+        raise ValueError("Unable to find the kernel command line in '%s'" %
+                         image_path)
+
+    return cmdline
+
+
+def cached(image_path):
+    # the boot files extracted from the image, if they're still current
+    try:
+        with open(_cache_path(image_path, 'meta')) as meta_file:
+            meta = json.load(meta_file)
+    except FileNotFoundError:
+        return None
+
+    if meta.get('image') != _image_key(image_path):
+        return None
+
+    kernel = _cache_path(image_path, 'kernel')
+    initrd = _cache_path(image_path, 'initrd')
+    if not (os.path.exists(kernel) and os.path.exists(initrd)):
+        return None
+
+    return BootFiles(kernel, initrd, meta['cmdline'])
+
+
+@contextlib.contextmanager
+def _extract_lock(image_path):
+    with open(_cache_path(image_path, 'meta') + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def extract(image_path):
+    # pull the (newest) kernel, its initramfs, and its command line out of
+    # the image, replacing anything extracted from an older version of it
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-kernel-',
+                               dir=os.path.dirname(image_path))
+    try:
+        LOG.info("Extracting the kernel from '%s'..." %
+                 os.path.basename(image_path))
+        _run(['virt-get-kernel', '-a', image_path, '-o', tmp_dir],
+             image_path)
+
+        files = os.listdir(tmp_dir)
+        kernel = next((f for f in files if f.startswith('vmlinuz')), None)
+        initrd = next((f for f in files if f.startswith('init')), None)
+        if kernel is None or initrd is None:
+            raise ValueError("No kernel found in '%s'" % image_path)
+
+        version = kernel[len('vmlinuz-'):]
+        cmdline = _root_cmdline(image_path, version)
+
+        os.rename(os.path.join(tmp_dir, kernel),
+                  _cache_path(image_path, 'kernel'))
+        os.rename(os.path.join(tmp_dir, initrd),
+                  _cache_path(image_path, 'initrd'))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # NB: this goes last, since it's what marks the files as current
+    meta_path = _cache_path(image_path, 'meta')
+    with open(meta_path + '.tmp', 'w') as meta_file:
+        json.dump({'image': _image_key(image_path), 'version': version,
+                   'cmdline': cmdline}, meta_file)
+
+    os.rename(meta_path + '.tmp', meta_path)
+
+    return BootFiles(_cache_path(image_path, 'kernel'),
+                     _cache_path(image_path, 'initrd'), cmdline)
+
+
+def boot_files(image_path):
+    # extract once per image, even with several VMs being provisioned
+    # from it at the same time
+    files = cached(image_path)
+    if files is not None:
+        return files
+
+    with _extract_lock(image_path):
+        files = cached(image_path)
+        if files is None:
+            files = extract(image_path)
+
+    return files
+
+
+def forget(image_path):
+    # drop whatever was extracted from the image (e.g. once it's deleted)
+    paths = [_cache_path(image_path, kind) for kind in _CACHE_EXTS]
+    paths.append(_cache_path(image_path, 'meta') + '.lock')
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
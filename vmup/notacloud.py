@@ -1,6 +1,7 @@
 import copy
 import os
 import re
+import shlex
 import time
 import tempfile
 
@@ -10,6 +11,63 @@ from vmup import disk as disk_helpers
 
 _HOSTNAME_RE = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9\-]{0,62}(?<!-)$')
 
+BOOT_PROFILES = ('minimal', 'default', 'full')
+
+# The modules to run in each stage, in order, with the user-data keys that
+# need them (None means always needed).  'full' runs all of these, while
+# 'default' and 'minimal' only run the ones the user-data actually uses,
+# plus the extras for their profile below.
+# NB: did you know that write_files normally runs *before* 'create-users'?
+#     this makes the owner field pretty much worthless, so it runs after.
+_INIT_MODULES = [
+    ('migrator', ()),
+    ('bootcmd', ('bootcmd',)),
+    ('growpart', ('_grow_root',)),
+    ('resizefs', ('_grow_root',)),
+    ('set_hostname', None),
+    ('update_hostname', None),
+    ('update_etc_hosts', ()),
+    ('rsyslog', ()),
+    ('users-groups', None),
+    ('write-files', ('write_files',)),
+    ('ssh', None),
+]
+
+_CONFIG_MODULES = [
+    ('mounts', ('mounts', 'mount_default_fields', 'swap')),
+    ('locale', ()),
+    ('set-passwords', ('chpasswd', 'password', 'ssh_pwauth')),
+    ('yum-add-repo', ('yum_repos',)),
+    ('package-update-upgrade-install', ('packages', 'package_upgrade')),
+    ('timezone', ()),
+    ('disable-ec2-metadata', ()),
+    ('runcmd', ('runcmd',)),
+]
+
+_FINAL_MODULES = [
+    ('scripts-per-once', ()),
+    ('scripts-per-boot', ()),
+    ('scripts-per-instance', ()),
+    # (this is what actually runs the runcmd script)
+    ('scripts-user', ('runcmd',)),
+    ('ssh-authkey-fingerprints', ()),
+    ('keys-to-console', ()),
+]
+
+# what 'default' runs on top of 'minimal' (i.e. what's cheap and
+# commonly expected from a cloud image)
+_DEFAULT_EXTRAS = ('update_etc_hosts', 'scripts-per-once',
+                   'scripts-per-boot', 'scripts-per-instance')
+
+# where the generated run command script goes in the guest
+RUN_SCRIPT_PATH = '/var/lib/vmup/runcmd.sh'
+
+# NB: /var/lib/cloud/instance points at the current instance's directory,
+#     so markers there work just like 'cloud-init-per instance' (without
+#     starting up a python interpreter for every command)
+_SEM_DIRS = {'instance': '/var/lib/cloud/instance/sem',
+             'once': '/var/lib/cloud/sem'}
+
 
 def _validate_label(label):
     if not _HOSTNAME_RE.match(label):
@@ -40,13 +98,120 @@ def get_metadata(name, net=None):
     return res
 
 
+def _select_modules(modules, features, profile):
+    selected = []
+    for name, keys in modules:
+        if profile == 'full' or keys is None:
+            selected.append(name)
+        elif any(features.get(key) for key in keys):
+            selected.append(name)
+        elif profile == 'default' and name in _DEFAULT_EXTRAS:
+            selected.append(name)
+
+    return selected
+
+
+def _shell_line(command):
+    if isinstance(command, str):
+        return command
+
+    return ' '.join(shlex.quote(arg) for arg in command)
+
+
+def _compile_script(commands, name):
+    # Turn (command, freq) pairs into one shell script, keeping their
+    # order.  Each run of commands with the same frequency shares a
+    # single guard, instead of a cloud-init-per call per command (like
+    # cloud-init-per, the guard is only set once they all succeed).
+    lines = []
+    block = 0
+    marker = None
+    prev_freq = None
+    for command, freq in commands:
+        if freq not in _SEM_DIRS:
+            freq = None
+
+        if freq != prev_freq:
+            if marker is not None:
+                lines.append('  [ $ok = 1 ] && mkdir -p %s && touch %s' %
+                             (os.path.dirname(marker), marker))
+                lines.append('fi')
+                marker = None
+
+            if freq is not None:
+                marker = '%s/%s-%s' % (_SEM_DIRS[freq], name, block)
+                lines.append('if [ ! -e %s ]; then' % marker)
+                lines.append('  ok=1')
+                block += 1
+
+            prev_freq = freq
+
+        if marker is not None and isinstance(command, str):
+            lines.append('  { %s; } || ok=0' % command)
+        elif marker is not None:
+            lines.append('  %s || ok=0' % _shell_line(command))
+        else:
+            lines.append(_shell_line(command))
+
+    if marker is not None:
+        lines.append('  [ $ok = 1 ] && mkdir -p %s && touch %s' %
+                     (os.path.dirname(marker), marker))
+        lines.append('fi')
+
+    return '\n'.join(lines) + '\n'
+
+
 class UserData(object):
     def __getstate__(self):
-        return {k: copy.deepcopy(v) for k, v in self.__dict__.items()
-                if not k.startswith('_')}
+        state = {k: copy.deepcopy(v) for k, v in self.__dict__.items()
+                 if not k.startswith('_')}
+
+        # NB: bootcmd runs before write-files, so the boot commands get
+        #     inlined as a single script, while the run commands are
+        #     written out and run as one
+        if self._boot_commands:
+            state['bootcmd'] = [_compile_script(self._boot_commands,
+                                                'vmup-boot')]
+
+        if self._run_commands:
+            state.setdefault('write_files', []).append({
+                'path': RUN_SCRIPT_PATH, 'permissions': '0700',
+                'content': '#!/bin/sh\n' + _compile_script(
+                    [(cmd, None) for cmd in self._run_commands],
+                    'vmup-run')})
+            state['runcmd'] = [[RUN_SCRIPT_PATH]]
+
+        # only run the modules that this user-data needs
+        features = dict(state, _grow_root=self._grow_root)
+        state['cloud_init_modules'] = _select_modules(
+            _INIT_MODULES, features, self._boot_profile)
+        state['cloud_config_modules'] = _select_modules(
+            _CONFIG_MODULES, features, self._boot_profile)
+        state['cloud_final_modules'] = _select_modules(
+            _FINAL_MODULES, features, self._boot_profile)
+
+        return state
 
     def __init__(self):
         self._default_added = False
+        self._boot_profile = 'default'
+
+        # commands get compiled into scripts (see __getstate__)
+        self._boot_commands = []
+        self._run_commands = []
+
+        # whether the root filesystem needs growing to fill its disk
+        self._grow_root = True
+
+    def set_boot_profile(self, profile):
+        if profile not in BOOT_PROFILES:
+            raise ValueError("Unknown boot profile '%s' (must be one of "
+                             "%s)" % (profile, ', '.join(BOOT_PROFILES)))
+
+        self._boot_profile = profile
+
+    def set_grow_root(self, val=True):
+        self._grow_root = val
 
     def set_passwords(self, passwords=None, expire=None):
         self.chpasswd = {}
@@ -174,28 +339,18 @@ class UserData(object):
         self.swap = {'filename': filename, 'size': size, maxsize: maxsize}
 
     def run_command(self, command, when=None, freq=None, ind=None):
+        # freq may be 'once', 'instance', or 'always'/None (every boot),
+        # as with cloud-init-per
         if when is None:
-            if getattr(self, 'runcmd', None) is None:
-                self.runcmd = []
-
             if ind is None:
-                ind = len(self.runcmd)
+                ind = len(self._run_commands)
 
-            self.runcmd.insert(ind, command)
+            self._run_commands.insert(ind, command)
         elif when == 'boot':
-            if getattr(self, 'bootcmd', None) is None:
-                self.bootcmd = []
-
             if ind is None:
-                ind = len(self.bootcmd)
-
-            if freq is None:
-                self.bootcmd.insert(ind, command)
-            else:
-                self.bootcmd.insert(
-                    ind, ['cloud-init-per', freq,
-                          "vmup-cust-%s" % len(self.bootcmd)] + command)
+                ind = len(self._boot_commands)
 
+            self._boot_commands.insert(ind, (command, freq))
         else:
             raise ValueError("Cannot run command on '%s' -- "
                              "only 'boot' or None is supported" % when)
@@ -204,11 +359,15 @@ class UserData(object):
     #       reboot, ssh-keys, puppet?, timezone, etc
 
 
+def get_userdata(user_data):
+    return yaml.safe_dump(user_data.__getstate__())
+
+
 def make_cloud_init(hostname, user_data, outname='{hostname}-cidata.iso',
                     outdir='/var/lib/libvirt/images', pool=None,
                     net=None, overwrite=False):
     metadata = get_metadata(hostname, net=net)
-    userdata = yaml.safe_dump(user_data.__getstate__())
+    userdata = get_userdata(user_data)
 
     with tempfile.TemporaryDirectory('cloud-init-work-') as tmpdir:
         with open(os.path.join(tmpdir, 'meta-data'), 'x') as mdf:
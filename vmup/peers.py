@@ -0,0 +1,267 @@
+from concurrent import futures
+import hashlib
+import http.server
+import logging
+import os
+import re
+import socketserver
+import threading
+
+import requests
+
+from vmup import web
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8643
+
+# how many ranged requests to split a download from a peer into
+DEFAULT_STREAMS = 4
+
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def file_checksum(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as img_file:
+        for chunk in iter(lambda: img_file.read(_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def _checksum_path(path):
+    # kept next to the image, as a hidden file (like kernelboot's)
+    img_dir, name = os.path.split(path)
+    return os.path.join(img_dir, '.%s.sha256' % name)
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return '%s:%s' % (stat.st_size, stat.st_mtime_ns)
+
+
+def stored_checksum(path):
+    # the checksum recorded for the image, if it's still current
+    try:
+        with open(_checksum_path(path)) as sum_file:
+            key, _, checksum = sum_file.read().strip().partition(' ')
+    except FileNotFoundError:
+        return None
+
+    return checksum if key == _file_key(path) else None
+
+
+def record_checksum(path):
+    # NB: this happens once an image is fetched or imported, so that
+    #     serving it never has to wait on checksumming all of it
+    checksum = file_checksum(path)
+    sum_path = _checksum_path(path)
+    tmp_path = '%s.tmp-%s' % (sum_path, os.getpid())
+    with open(tmp_path, 'w') as sum_file:
+        sum_file.write('%s %s' % (_file_key(path), checksum))
+    os.rename(tmp_path, sum_path)
+
+    return checksum
+
+
+def forget_checksum(path):
+    if os.path.exists(_checksum_path(path)):
+        os.remove(_checksum_path(path))
+
+
+class _ImageHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'vmup-images'
+
+    def log_message(self, fmt, *args):
+        LOG.debug(fmt % args)
+
+    def _find(self):
+        prefix, _, name = self.path.lstrip('/').partition('/')
+        if prefix != 'images' or not name or '/' in name:
+            return None
+
+        return self.server.lookup(name)
+
+    def _send_headers(self, status, path, start, end):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        checksum = self.server.checksum(path)
+        if checksum is not None:
+            self.send_header('X-Checksum-Sha256', checksum)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' %
+                             (start, end - 1, os.path.getsize(path)))
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._find()
+        if path is None:
+            self.send_error(404)
+            return
+
+        self._send_headers(200, path, 0, os.path.getsize(path))
+
+    def do_GET(self):
+        path = self._find()
+        if path is None:
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end, status = 0, size, 200
+
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            m = _RANGE_RE.match(range_header)
+            if not m or int(m.group(1)) >= size:
+                self.send_error(416)
+                return
+
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)) + 1, size)
+            status = 206
+
+        self._send_headers(status, path, start, end)
+        with open(path, 'rb') as img_file:
+            img_file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = img_file.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class ImageServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # Serves base images read-only to other vmup hosts, under
+    # /images/NAME.  Which images get served is up to lookup, which
+    # returns the path for a name (or None).
+    daemon_threads = True
+
+    def __init__(self, address, lookup):
+        super(ImageServer, self).__init__(address, _ImageHandler)
+        self.lookup = lookup
+
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def checksum(self, path):
+        # the image's checksum, or None if it isn't known yet
+        # NB: checksumming a whole image takes longer than peers wait
+        #     for a response, so images without a recorded checksum
+        #     (e.g. from older versions) get one in the background, and
+        #     are served without one meanwhile
+        checksum = stored_checksum(path)
+        if checksum is not None:
+            return checksum
+
+        with self._lock:
+            if path not in self._pending:
+                self._pending.add(path)
+                threading.Thread(target=self._record, args=(path,),
+                                 name='image-checksum', daemon=True).start()
+
+        return None
+
+    def _record(self, path):
+        try:
+            record_checksum(path)
+        except OSError as ex:
+            LOG.warning("Unable to checksum '%s': %s" % (path, ex))
+        finally:
+            with self._lock:
+                self._pending.discard(path)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='image-server', daemon=True)
+        thread.start()
+        return thread
+
+
+def find_peer(peers, name, checksum=None):
+    # the first peer that has the image (with the given checksum, if any),
+    # as (url, size, checksum), or None
+    for peer in peers:
+        url = '%s/images/%s' % (peer.rstrip('/'), name)
+        try:
+            resp = web.session().head(url, timeout=web.DEFAULT_TIMEOUT)
+        except requests.RequestException as ex:
+            LOG.debug("Unable to reach peer '%s': %s" % (peer, ex))
+            continue
+
+        if resp.status_code != 200:
+            continue
+
+        peer_checksum = resp.headers.get('X-Checksum-Sha256')
+        if checksum is not None and peer_checksum != checksum:
+            LOG.debug("Peer '%s' has a different '%s'" % (peer, name))
+            continue
+
+        return url, int(resp.headers['Content-Length']), peer_checksum
+
+    return None
+
+
+def _fetch_range(url, out_path, start, end):
+    resp = web.session().get(url, stream=True, timeout=web.DEFAULT_TIMEOUT,
+                             headers={'Range': 'bytes=%s-%s' %
+                                      (start, end - 1)})
+    with resp:
+        if resp.status_code != 206:
+            raise ValueError("Peer didn't return the requested range "
+                             "(status %s)" % resp.status_code)
+
+        # NB: each stream writes its own part of the (preallocated) file
+        with open(out_path, 'r+b') as out:
+            out.seek(start)
+            for chunk in resp.iter_content(_CHUNK_SIZE):
+                out.write(chunk)
+
+
+def download(url, size, checksum, out_path, streams=DEFAULT_STREAMS):
+    with open(out_path, 'wb') as out:
+        out.truncate(size)
+
+    part_size = max(-(-size // streams), _CHUNK_SIZE)
+    ranges = [(start, min(start + part_size, size))
+              for start in range(0, size, part_size)]
+
+    with futures.ThreadPoolExecutor(max_workers=len(ranges) or 1) as executor:
+        for job in [executor.submit(_fetch_range, url, out_path, start, end)
+                    for start, end in ranges]:
+            job.result()
+
+    actual = file_checksum(out_path)
+    if checksum is not None and actual != checksum:
+        raise ValueError("Checksum mismatch for '%s' (expected %s, got %s)" %
+                         (url, checksum, actual))
+
+
+def fetch(peers, name, out_path, checksum=None, streams=DEFAULT_STREAMS):
+    # Try to get the image from one of the peers, over the LAN.  Returns
+    # whether that worked (if not, fetch it from the internet instead).
+    found = find_peer(peers, name, checksum)
+    if found is None:
+        return False
+
+    url, size, peer_checksum = found
+    LOG.info("Fetching '%s' from peer %s..." % (name, url))
+    try:
+        download(url, size, checksum or peer_checksum, out_path, streams)
+    except (requests.RequestException, ValueError) as ex:
+        LOG.warning("Unable to fetch '%s' from a peer: %s" % (name, ex))
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return False
+
+    return True
+
@@ -0,0 +1,307 @@
+import hashlib
+import http.server
+import ipaddress
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import urllib.parse as urlparse
+
+import requests
+
+from vmup import web
+
+LOG = logging.getLogger(__name__)
+
+CACHE_DIR = '~/.cache/vmup/packages'
+
+# these change in place upstream, so they always get revalidated
+_VOLATILE_NAMES = ('repomd.xml', 'repomd.xml.asc', 'metalink.xml')
+
+# how many redirects to follow (each one gets checked like the original)
+_MAX_REDIRECTS = 10
+
+
+def proxied_url(cache_url, url):
+    # http://mirror/pub/x.rpm --> CACHE_URL/http/mirror/pub/x.rpm
+    parts = urlparse.urlsplit(url)
+    query = '?%s' % parts.query if parts.query else ''
+    return '%s/%s/%s%s%s' % (cache_url.rstrip('/'), parts.scheme,
+                             parts.netloc, parts.path, query)
+
+
+def upstream_host(host_or_url):
+    # the host part of a repo baseurl (or just a host, as given)
+    if '://' in host_or_url:
+        return urlparse.urlsplit(host_or_url).hostname
+    return host_or_url.lower()
+
+
+def _refused_reason(url, allowed_hosts=None):
+    # why the proxy won't fetch the given URL, or None if it will
+    host = urlparse.urlsplit(url).hostname
+    if not host:
+        return "no host"
+
+    if allowed_hosts is not None and host.lower() not in allowed_hosts:
+        return "'%s' isn't an allowed upstream" % host
+
+    # NB: the guests must not be able to reach the host's own services
+    #     (or anything link-local, like cloud metadata) through us
+    #     NB: the name could resolve differently by the time we connect,
+    #     but this keeps out anyone that isn't running their own DNS
+    try:
+        addrs = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as ex:
+        return "unable to resolve '%s': %s" % (host, ex)
+
+    for addr_info in addrs:
+        addr = ipaddress.ip_address(addr_info[4][0].partition('%')[0])
+        if (addr.is_loopback or addr.is_link_local or addr.is_multicast or
+                addr.is_unspecified):
+            return "'%s' resolves to %s" % (host, addr)
+
+        if _is_local_address(addr):
+            return "'%s' is this host (%s)" % (host, addr)
+
+    return None
+
+
+def _is_local_address(addr):
+    # whether the address is one of this host's own (e.g. the bridge
+    # address the guests reach us on), i.e. whether we can bind to it
+    family = socket.AF_INET6 if addr.version == 6 else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind((str(addr), 0))
+        except OSError:
+            return False
+
+    return True
+
+
+class PackageCache(object):
+    # A content-addressed store of everything fetched through the proxy:
+    # blobs/ holds files by the SHA-256 of their contents, while index/
+    # maps each upstream URL to its blob (and the blob's Content-Encoding,
+    # since blobs are kept exactly as upstream sent them).
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(os.path.join(self.cache_dir, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, 'index'), exist_ok=True)
+
+        self._stats_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_served': 0,
+                      'bytes_fetched': 0}
+
+    def _index_path(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, 'index', key)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, 'blobs', digest[:2], digest)
+
+    def lookup(self, url):
+        # (path, encoding) of the cached blob, or None
+        try:
+            with open(self._index_path(url)) as index_file:
+                digest, _, encoding = index_file.read().strip().partition(' ')
+        except FileNotFoundError:
+            return None
+
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            return None
+
+        return path, encoding or None
+
+    def store(self, url, tmp_path, digest, encoding=None):
+        path = self._blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.rename(tmp_path, path)
+
+        # NB: write the index entry last, so it never points at nothing
+        index_path = self._index_path(url)
+        with open(index_path + '.tmp', 'w') as index_file:
+            index_file.write(('%s %s' % (digest, encoding or '')).strip())
+        os.rename(index_path + '.tmp', index_path)
+
+    def count(self, **kwargs):
+        with self._stats_lock:
+            for stat, val in kwargs.items():
+                self.stats[stat] += val
+
+
+class _CacheHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'vmup-pkg-cache'
+
+    def log_message(self, fmt, *args):
+        LOG.debug(fmt % args)
+
+    def do_GET(self):
+        cache = self.server.cache
+
+        if self.path == '/_stats':
+            body = json.dumps(cache.stats).encode()
+            self._send_headers(200, len(body), 'application/json')
+            self.wfile.write(body)
+            return
+
+        scheme, _, rest = self.path.lstrip('/').partition('/')
+        if scheme not in ('http', 'https') or not rest:
+            self.send_error(404)
+            return
+
+        url = '%s://%s' % (scheme, rest)
+        refused = _refused_reason(url, self.server.allowed_hosts)
+        if refused is not None:
+            LOG.warning("Refusing to fetch '%s': %s" % (url, refused))
+            self.send_error(403, refused)
+            return
+
+        volatile = os.path.basename(urlparse.urlsplit(url).path) in \
+            _VOLATILE_NAMES
+
+        cached = cache.lookup(url)
+        if cached is not None and not volatile:
+            cache.count(hits=1, bytes_served=os.path.getsize(cached[0]))
+            self._send_file(*cached)
+            return
+
+        try:
+            self._fetch(url, cached)
+        except requests.RequestException as ex:
+            if cached is not None:
+                LOG.warning("Unable to refresh '%s' (%s), serving the "
+                            "cached copy" % (url, ex))
+                self._send_file(*cached)
+            else:
+                self.send_error(502, str(ex))
+
+    def _fetch(self, url, cached=None):
+        cache = self.server.cache
+
+        # NB: follow redirects by hand, since each hop needs the same
+        #     checks as the URL we were asked for
+        session = web.session()
+        fetch_url = url
+        for _ in range(_MAX_REDIRECTS + 1):
+            resp = session.get(fetch_url, stream=True, allow_redirects=False,
+                               timeout=web.DEFAULT_TIMEOUT)
+            if not resp.is_redirect:
+                break
+
+            target = urlparse.urljoin(resp.url, resp.headers['Location'])
+            resp.close()
+
+            refused = _refused_reason(target, self.server.allowed_hosts)
+            if refused is not None:
+                LOG.warning("Refusing to follow '%s' to '%s': %s"
+                            % (url, target, refused))
+                self.send_error(403, refused)
+                return
+
+            fetch_url = target
+        else:
+            resp.close()
+            raise requests.TooManyRedirects(
+                "Exceeded %s redirects" % _MAX_REDIRECTS)
+
+        with resp:
+            if resp.status_code != 200:
+                self.send_error(resp.status_code)
+                return
+
+            cache.count(misses=1)
+
+            # stream to the guest and the cache at the same time
+            # NB: the body gets passed through exactly as upstream sent it
+            #     (i.e. still compressed), so that its length and encoding
+            #     still hold
+            encoding = resp.headers.get('Content-Encoding')
+            self._send_headers(200, resp.headers.get('Content-Length'),
+                               resp.headers.get('Content-Type'), encoding)
+
+            hasher = hashlib.sha256()
+            fd, tmp_path = tempfile.mkstemp(dir=cache.cache_dir,
+                                            prefix='.tmp-')
+            size = 0
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    for chunk in resp.raw.stream(1024 * 1024,
+                                                 decode_content=False):
+                        hasher.update(chunk)
+                        tmp_file.write(chunk)
+                        self.wfile.write(chunk)
+                        size += len(chunk)
+
+                cache.store(url, tmp_path, hasher.hexdigest(), encoding)
+            except Exception as ex:
+                # the headers are already out, so the only way left to
+                # tell the guest is to cut the connection short
+                LOG.warning("Unable to fetch '%s': %s" % (url, ex))
+                self._abort()
+                return
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            cache.count(bytes_served=size, bytes_fetched=size)
+
+    def _send_file(self, path, encoding=None):
+        self._send_headers(200, os.path.getsize(path), encoding=encoding)
+        with open(path, 'rb') as blob:
+            shutil.copyfileobj(blob, self.wfile)
+
+    def _send_headers(self, status, length=None, content_type=None,
+                      encoding=None):
+        self.send_response(status)
+        self.send_header('Content-Type',
+                         content_type or 'application/octet-stream')
+        if length is not None:
+            self.send_header('Content-Length', str(length))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+
+    def _abort(self):
+        # reset the connection (instead of closing it cleanly), so that a
+        # truncated body never looks complete
+        self.close_connection = True
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.connection.close()
+
+
+class CacheServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache, allowed_hosts=None):
+        # allowed_hosts: the upstream hosts the guests may fetch from
+        # (e.g. those of the repos' baseurls), or None for any
+        super(CacheServer, self).__init__(address, _CacheHandler)
+        self.cache = cache
+        self.allowed_hosts = None
+        if allowed_hosts is not None:
+            self.allowed_hosts = {upstream_host(h) for h in allowed_hosts}
+
+    def start(self):
+        # serve from a background thread (e.g. in vmupd)
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='pkg-cache', daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_address(addr, default_port=3142):
+    host, _, port = addr.rpartition(':')
+    if not host:
+        return addr, default_port
+
+    return host, int(port)
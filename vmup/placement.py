@@ -0,0 +1,211 @@
+import collections
+from concurrent import futures
+import logging
+
+import libvirt
+import yaml
+
+from vmup import builder
+from vmup import disk as disk_helper
+
+LOG = logging.getLogger(__name__)
+
+# what a host has, and what's already promised to its defined domains
+# (memory is in KiB, disk in bytes, and disk_free is None when unknown)
+Host = collections.namedtuple('Host', ['uri', 'cpus', 'memory',
+                                       'free_memory', 'committed_memory',
+                                       'committed_cpus', 'disk_free'])
+
+# what a VM needs (in the same units as Host)
+Request = collections.namedtuple('Request', ['name', 'memory', 'cpus',
+                                             'disk'])
+
+
+def _host_info(uri, pool_name=None):
+    conn = builder.get_connection(uri)
+
+    # [model, memory (MiB), cpus, mhz, nodes, sockets, cores, threads]
+    info = conn.getInfo()
+    memory = info[1] * 1024
+
+    try:
+        free_memory = conn.getFreeMemory() // 1024
+    except libvirt.libvirtError as ex:
+        LOG.debug("Unable to get the free memory on '%s': %s" % (uri, ex))
+        free_memory = None
+
+    committed_memory = 0
+    committed_cpus = 0
+    for dom in conn.listAllDomains():
+        # [state, max memory (KiB), memory, vcpus, cpu time]
+        dom_info = dom.info()
+        committed_memory += dom_info[1]
+        committed_cpus += dom_info[3]
+
+    disk_free = None
+    if pool_name is not None:
+        try:
+            pool = conn.storagePoolLookupByName(pool_name)
+            pool.refresh()
+            disk_free = pool.info()[3]
+        except libvirt.libvirtError as ex:
+            LOG.debug("Unable to check pool '%s' on '%s': %s" %
+                      (pool_name, uri, ex))
+
+    return Host(uri, info[2], memory, free_memory, committed_memory,
+                committed_cpus, disk_free)
+
+
+def gather(uris, image_dir='POOL:default'):
+    # check all the hosts at once, skipping any that can't be reached
+    pool_name = None
+    if image_dir.startswith('POOL:'):
+        pool_name = image_dir[len('POOL:'):]
+
+    hosts = []
+    with futures.ThreadPoolExecutor(max_workers=len(uris)) as executor:
+        jobs = {executor.submit(_host_info, uri, pool_name): uri
+                for uri in uris}
+        for job in futures.as_completed(jobs):
+            try:
+                hosts.append(job.result())
+            except libvirt.libvirtError as ex:
+                LOG.warning("Skipping unreachable host '%s': %s" %
+                            (jobs[job], ex))
+
+    # keep the order stable, so that ties go to the first host listed
+    return sorted(hosts, key=lambda h: uris.index(h.uri))
+
+
+def headroom(host, mem_overcommit=1.0):
+    # the memory (in KiB) that can still be promised to new domains
+    return int(host.memory * mem_overcommit) - host.committed_memory
+
+
+def fits(host, req, mem_overcommit=1.0, cpu_overcommit=4.0):
+    if req.memory > headroom(host, mem_overcommit):
+        return False
+
+    # NB: what's promised isn't what's used, so a host can have headroom
+    #     to spare and still be short on actual memory (e.g. swapping)
+    if host.free_memory is not None and req.memory > host.free_memory:
+        return False
+
+    if host.committed_cpus + req.cpus > host.cpus * cpu_overcommit:
+        return False
+
+    if host.disk_free is not None and req.disk > host.disk_free:
+        return False
+
+    return True
+
+
+def _spread(host, req):
+    # leave as much room as possible on every host, going by whichever
+    # is tighter of what's promised and what's actually in use
+    room = headroom(host)
+    if host.free_memory is not None:
+        room = min(room, host.free_memory)
+
+    return room - req.memory
+
+
+def _pack(host, req):
+    # fill up hosts one at a time, keeping the rest free
+    return -(headroom(host) - req.memory)
+
+
+# the placement policies, which score a host for a request (higher wins);
+# add to this to plug in another policy
+POLICIES = {
+    'spread': _spread,
+    'pack': _pack,
+}
+
+
+def _commit(host, req):
+    disk_free = host.disk_free
+    if disk_free is not None:
+        disk_free -= req.disk
+
+    free_memory = host.free_memory
+    if free_memory is not None:
+        free_memory -= req.memory
+
+    return host._replace(committed_memory=host.committed_memory + req.memory,
+                         committed_cpus=host.committed_cpus + req.cpus,
+                         free_memory=free_memory, disk_free=disk_free)
+
+
+def place(hosts, reqs, policy='spread', **fit_args):
+    # Returns a dict of request names to host URIs.  Larger requests
+    # get placed first (first-fit decreasing), so that they don't end up
+    # with nowhere to go.
+    score = POLICIES[policy]
+    hosts = list(hosts)
+
+    placed = {}
+    for req in sorted(reqs, key=lambda r: (r.memory, r.cpus),
+                      reverse=True):
+        candidates = [(score(host, req), -i, i)
+                      for i, host in enumerate(hosts)
+                      if fits(host, req, **fit_args)]
+        if not candidates:
+            raise ValueError("No host has room for '%s' (%s KiB, %s CPUs)" %
+                             (req.name, req.memory, req.cpus))
+
+        _, _, best = max(candidates)
+        placed[req.name] = hosts[best].uri
+        hosts[best] = _commit(hosts[best], req)
+
+        LOG.debug("Placed '%s' on '%s'" % (req.name, hosts[best].uri))
+
+    return placed
+
+
+def find_existing(uris, name):
+    # re-runs should stay on the host that already has the VM
+    for uri in uris:
+        try:
+            builder.get_connection(uri).lookupByName(name)
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                LOG.debug("Unable to check '%s': %s" % (uri, ex))
+        else:
+            return uri
+
+    return None
+
+
+def make_request(name, memory='3 GiB', cpus=2, size='20 GiB'):
+    memory = disk_helper.normalize_size(str(memory))
+    size = disk_helper.normalize_size(str(size))
+    return Request(name.replace('.', '-'),
+                   disk_helper.size_to_bytes(memory) // 1024, int(cpus),
+                   disk_helper.size_to_bytes(size))
+
+
+def choose(uris, req, policy='spread', image_dir='POOL:default'):
+    existing = find_existing(uris, req.name)
+    if existing is not None:
+        LOG.debug("VM '%s' already exists on '%s'" % (req.name, existing))
+        return existing
+
+    return place(gather(uris, image_dir), [req], policy)[req.name]
+
+
+def load_manifest(path):
+    # a list of VMs, like [{name: web1, memory: 4GiB, cpus: 2}, ...]
+    with open(path) as manifest_file:
+        entries = yaml.safe_load(manifest_file) or []
+
+    reqs = []
+    for entry in entries:
+        if 'name' not in entry:
+            raise ValueError("Manifest entry %s has no name" % entry)
+
+        opts = {k: v for k, v in entry.items()
+                if k in ('memory', 'cpus', 'size')}
+        reqs.append(make_request(entry['name'], **opts))
+
+    return reqs
@@ -0,0 +1,91 @@
+import collections
+from concurrent import futures
+import logging
+import time
+
+import libvirt
+
+LOG = logging.getLogger(__name__)
+
+# the formats QEMU can write save images in (besides the default, raw)
+SAVE_FORMATS = ('raw', 'gzip', 'bzip2', 'xz', 'lzop', 'zstd')
+
+# what happened to each domain, with error set if it failed
+Result = collections.namedtuple('Result', ['name', 'action', 'elapsed',
+                                           'error'])
+
+
+def _managed_save(dom, image_format=None):
+    if image_format is None:
+        dom.managedSave(0)
+        return
+
+    # NB: older libvirts only take the format from save_image_format in
+    #     qemu.conf, for every domain on the host
+    param = getattr(libvirt, 'VIR_DOMAIN_SAVE_PARAM_IMAGE_FORMAT', None)
+    if param is None or not hasattr(dom, 'saveParams'):
+        raise ValueError("This version of libvirt can't choose the save "
+                         "image format per VM, set save_image_format in "
+                         "qemu.conf instead")
+
+    # (without a file parameter, this is a managed save)
+    dom.saveParams({param: image_format}, 0)
+
+
+def _suspend_one(dom, image_format=None):
+    start = time.time()
+    if not dom.isActive():
+        return Result(dom.name(), 'not running', 0, None)
+
+    _managed_save(dom, image_format)
+    return Result(dom.name(), 'saved', time.time() - start, None)
+
+
+def _resume_one(dom):
+    start = time.time()
+    if dom.isActive():
+        return Result(dom.name(), 'already running', 0, None)
+
+    # NB: create restores the managed save image, if there is one
+    restored = dom.hasManagedSaveImage(0)
+    dom.create()
+    return Result(dom.name(), 'restored' if restored else 'booted',
+                  time.time() - start, None)
+
+
+def _run_all(func, doms, max_workers):
+    if not doms:
+        return []
+
+    results = []
+    workers = min(max_workers, len(doms))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = {executor.submit(func, dom): dom for dom in doms}
+        for job in futures.as_completed(jobs):
+            dom = jobs[job]
+            try:
+                results.append(job.result())
+            except (libvirt.libvirtError, ValueError) as ex:
+                LOG.debug("Failed on '%s': %s" % (dom.name(), ex))
+                results.append(Result(dom.name(), 'failed', 0, str(ex)))
+
+    return sorted(results, key=lambda r: r.name)
+
+
+def suspend(doms, image_format=None, max_workers=4):
+    # save the domains' memory to disk and stop them, so that starting
+    # them again picks up where they left off instead of booting
+    return _run_all(lambda dom: _suspend_one(dom, image_format), doms,
+                    max_workers)
+
+
+def resume(doms, max_workers=4):
+    return _run_all(_resume_one, doms, max_workers)
+
+
+def running_domains(conn):
+    return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+
+
+def saved_domains(conn):
+    return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_MANAGEDSAVE)
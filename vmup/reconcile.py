@@ -0,0 +1,262 @@
+import collections
+import logging
+
+import libvirt
+
+from vmup import disk as disk_helper
+from vmup import virxml as vx
+
+LOG = logging.getLogger(__name__)
+
+# summary is what gets printed for the plan, apply makes the change
+Change = collections.namedtuple('Change', ['summary', 'apply'])
+
+
+def _fmt_size(num_bytes):
+    return '%.1f GiB' % (num_bytes / 2**30)
+
+
+def plan(vm, disks, start=True):
+    # Diff the desired VM (fully configured, but not finalized) against
+    # the existing domain, returning the list of changes to make.
+    # disks is the list of disk specs that would go to provision_disks.
+    vm.provision_disks(disks, create=False)
+    desired_xml = vm.finalize(write_seed=False)
+
+    dom = vm._lookup_domain()
+    if dom is None:
+        def _create():
+            vm.create_disks(disks)
+            vm.write_seed(overwrite=True)
+            vm.launch(xml=desired_xml, start=start)
+
+        return [Change("+ define new VM '%s'" % vm.name, _create)]
+
+    current = vx.Domain(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    active = dom.isActive() != 0
+
+    # config changes always persist, and apply live when possible
+    live_flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if active:
+        live_flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+
+    changes = []
+    changes.extend(_plan_size(vm, dom, current))
+    changes.extend(_plan_disks(vm, dom, current, disks, active, live_flags))
+    changes.extend(_plan_shares(vm, dom, current, live_flags))
+    changes.extend(_plan_interfaces(vm, dom, current, live_flags))
+    changes.extend(_plan_seed(vm, dom, active))
+
+    if start and not active:
+        changes.append(Change("> start VM '%s'" % vm.name, dom.create))
+
+    return changes
+
+
+def apply(changes, vm=None):
+    # make sure the DHCP reservation is in place before anything boots
+    if vm is not None and vm._ipam is not None:
+        vm._ipam.commit()
+
+    for change in changes:
+        LOG.info("Applying: %s" % change.summary)
+        change.apply()
+
+    # the domain now matches the VM's configuration, so a saved state
+    # stays valid from here on (see VM.launch)
+    dom = vm._lookup_domain() if vm is not None else None
+    if changes and dom is not None:
+        vm.record_config_digest(dom)
+
+
+def _plan_size(vm, dom, current):
+    changes = []
+    config = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+
+    new_mem = disk_helper.size_to_bytes(vm.memory) // 1024
+    old_mem = disk_helper.size_to_bytes(current.memory) // 1024
+    if new_mem != old_mem:
+        def _set_memory():
+            dom.setMemoryFlags(new_mem,
+                               config | libvirt.VIR_DOMAIN_MEM_MAXIMUM)
+            dom.setMemoryFlags(new_mem, config)
+
+        changes.append(Change("~ memory: %s KiB -> %s KiB (on next boot)" %
+                              (old_mem, new_mem), _set_memory))
+
+    new_cpus = int(vm.cpus)
+    old_cpus = int(current.cpus)
+    if new_cpus != old_cpus:
+        def _set_cpus():
+            dom.setVcpusFlags(new_cpus,
+                              config | libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+            dom.setVcpusFlags(new_cpus, config)
+
+        changes.append(Change("~ cpus: %s -> %s (on next boot)" %
+                              (old_cpus, new_cpus), _set_cpus))
+
+    return changes
+
+
+def _plan_disks(vm, dom, current, disks, active, live_flags):
+    changes = []
+
+    confs = {vm._disk_source(d): d for d in vm.disks}
+    existing = {vm._disk_source(d): d for d in current.disks}
+
+    for spec in disks:
+        fmt = spec.get('fmt', 'qcow2')
+        source = vm.disk_source(spec['name'], fmt)
+        conf = confs[source]
+
+        if source not in existing:
+            def _attach(spec=spec, conf=conf):
+                vm.create_disks([spec])
+                dom.attachDeviceFlags(conf.to_xml(encoding=str), live_flags)
+
+            changes.append(Change("+ attach disk '%s' (%s) as %s" %
+                                  (spec['name'], spec['size'],
+                                   conf.target.split(':')[1]), _attach))
+            continue
+
+        capacity = vm.disk_capacity(spec['name'], fmt)
+        wanted = disk_helper.size_to_bytes(spec['size'])
+        if capacity is None or capacity == wanted:
+            continue
+
+        if wanted < capacity:
+            LOG.warning("Not shrinking disk '%s' from %s to %s" %
+                        (spec['name'], _fmt_size(capacity),
+                         _fmt_size(wanted)))
+            continue
+
+        target = existing[source].target.split(':')[1]
+        if active:
+            def _resize(target=target, wanted=wanted):
+                dom.blockResize(target, wanted,
+                                libvirt.VIR_DOMAIN_BLOCK_RESIZE_BYTES)
+        else:
+            def _resize(spec=spec, fmt=fmt):
+                vm.resize_disk(spec['name'], spec['size'], fmt)
+
+        changes.append(Change("~ resize disk '%s' (%s): %s -> %s" %
+                              (spec['name'], target, _fmt_size(capacity),
+                               _fmt_size(wanted)), _resize))
+
+    # NB: we never remove disks, since that could lose data
+    for source in set(existing) - set(confs):
+        LOG.debug("Disk '%s' is no longer requested, leaving it "
+                  "attached" % source)
+
+    return changes
+
+
+def _attach_share(dom, conf, live_flags):
+    try:
+        dom.attachDeviceFlags(conf.to_xml(encoding=str), live_flags)
+    except libvirt.libvirtError as ex:
+        if not live_flags & libvirt.VIR_DOMAIN_AFFECT_LIVE:
+            raise
+
+        # not every hypervisor can hotplug filesystems
+        LOG.warning("Unable to attach share live (%s), it will be "
+                    "available on next boot" % ex)
+        dom.attachDeviceFlags(conf.to_xml(encoding=str),
+                              libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+
+def _plan_shares(vm, dom, current, live_flags):
+    changes = []
+
+    desired = {fs.target_name: fs for fs in vm.filesystems}
+    existing = {fs.target_name: fs for fs in current.filesystems}
+
+    for name, conf in desired.items():
+        old = existing.get(name)
+        if old is not None and (old.source_dir, old.read_only,
+                                old.access_mode) == (conf.source_dir,
+                                                     conf.read_only,
+                                                     conf.access_mode):
+            continue
+
+        if old is not None:
+            def _update(conf=conf):
+                dom.updateDeviceFlags(conf.to_xml(encoding=str),
+                                      libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+            changes.append(Change("~ update share '%s' (on next boot)" %
+                                  name, _update))
+        else:
+            def _attach(conf=conf):
+                _attach_share(dom, conf, live_flags)
+
+            changes.append(Change("+ attach share '%s' from %s" %
+                                  (name, conf.source_dir), _attach))
+
+    for name in set(existing) - set(desired):
+        def _detach(old=existing[name]):
+            dom.detachDeviceFlags(old.to_xml(encoding=str),
+                                  libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+        changes.append(Change("- detach share '%s' (on next boot)" % name,
+                              _detach))
+
+    return changes
+
+
+def _iface_tuning(iface):
+    # the parts of an interface that QEMU can't change while it's running
+    return (iface.model_type, iface.driver_name, iface.queues,
+            iface.rx_queue_size, iface.tx_queue_size, iface.mtu,
+            iface.host_offloads or {}, iface.guest_offloads or {})
+
+
+def _plan_interfaces(vm, dom, current, live_flags):
+    changes = []
+
+    existing = {iface.mac_address: iface for iface in current.interfaces}
+    for iface in vm.interfaces:
+        old = existing.get(iface.mac_address)
+        if old is None:
+            def _attach(iface=iface):
+                dom.attachDeviceFlags(iface.to_xml(encoding=str), live_flags)
+
+            changes.append(Change("+ attach interface %s" %
+                                  iface.mac_address, _attach))
+        elif _iface_tuning(old) != _iface_tuning(iface):
+            # NB: this takes the new source along with it, but all of it
+            #     has to wait for the next boot
+            def _update(iface=iface):
+                dom.updateDeviceFlags(iface.to_xml(encoding=str),
+                                      libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+            changes.append(Change("~ update interface %s (on next boot)" %
+                                  iface.mac_address, _update))
+        elif (old.iface_type, old.source) != (iface.iface_type,
+                                              iface.source):
+            def _update(iface=iface):
+                dom.updateDeviceFlags(iface.to_xml(encoding=str), live_flags)
+
+            changes.append(Change("~ update interface %s" %
+                                  iface.mac_address, _update))
+
+    return changes
+
+
+def _plan_seed(vm, dom, active):
+    if vm.existing_seed_digest(dom) == vm.seed_digest():
+        return []
+
+    def _rewrite():
+        vm.write_seed(overwrite=True)
+        vm.record_seed_digest(dom)
+
+        # have QEMU pick up the new media (if it's not served over HTTP)
+        seed = next((d for d in vm.disks
+                     if d.device_type.endswith(':cdrom')), None)
+        if active and seed is not None:
+            dom.updateDeviceFlags(seed.to_xml(encoding=str),
+                                  libvirt.VIR_DOMAIN_AFFECT_LIVE)
+
+    return [Change("~ rebuild cloud-init seed (applies on next boot)",
+                   _rewrite)]
@@ -0,0 +1,198 @@
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+
+LOG = logging.getLogger(__name__)
+
+SECRET_PATH = '~/.cache/vmup/seed-secret'
+SEED_DIR = '~/.cache/vmup/seeds'
+
+# the files cloud-init's nocloud-net datasource asks for
+_SEED_FILES = ('meta-data', 'user-data', 'vendor-data')
+
+# the server running in this process (i.e. in vmupd), if any
+_ACTIVE = None
+
+# bind addresses that say nothing about where the VMs can reach us
+WILDCARD_ADDRESSES = ('', '0.0.0.0', '::')
+
+
+def _load_secret(path=SECRET_PATH):
+    # NB: the tokens are derived from this, so that they (and thus the
+    #     seed URLs in the domain XML) stay the same across restarts
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(path, 'rb') as secret_file:
+            return secret_file.read()
+    except FileNotFoundError:
+        pass
+
+    secret = os.urandom(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as secret_file:
+        secret_file.write(secret)
+
+    return secret
+
+
+def _token(secret, name):
+    return hmac.new(secret, name.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+class SeedStore(object):
+    # The seeds of every VM, served from memory.  Each VM's seed lives
+    # under an unguessable token, so that guests can't read each other's
+    # user-data (which may well contain password hashes).  Seeds are also
+    # written out to seed_dir, so that they survive restarts (otherwise
+    # a rebooted guest would see a new instance).
+
+    def __init__(self, secret_path=SECRET_PATH, seed_dir=SEED_DIR):
+        self._secret = _load_secret(secret_path)
+        self._seed_dir = os.path.expanduser(seed_dir)
+        self._lock = threading.Lock()
+
+        os.makedirs(self._seed_dir, mode=0o700, exist_ok=True)
+        self._seeds = {}
+        for token in os.listdir(self._seed_dir):
+            if token.startswith('.'):
+                continue
+
+            with open(os.path.join(self._seed_dir, token)) as seed_file:
+                seed = json.load(seed_file)
+
+            self._seeds[token] = {k: v.encode() for k, v in seed.items()}
+
+    def token(self, name):
+        return _token(self._secret, name)
+
+    def has(self, name):
+        with self._lock:
+            return self.token(name) in self._seeds
+
+    def put(self, name, metadata, userdata):
+        token = self.token(name)
+        seed = {'meta-data': metadata,
+                'user-data': "#cloud-config\n" + userdata,
+                'vendor-data': ''}
+
+        tmp_path = os.path.join(self._seed_dir, '.tmp-%s' % token)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as seed_file:
+            json.dump(seed, seed_file)
+
+        with self._lock:
+            os.rename(tmp_path, os.path.join(self._seed_dir, token))
+            self._seeds[token] = {k: v.encode() for k, v in seed.items()}
+
+        LOG.debug("Updated the seed for '%s'" % name)
+
+    def get(self, token, seed_file):
+        # NB: other processes (e.g. 'vmup destroy --no-daemon') remove
+        #     seeds by deleting their files, so check that it's still there
+        with self._lock:
+            if token not in self._seeds:
+                return None
+
+            if not os.path.exists(os.path.join(self._seed_dir, token)):
+                del self._seeds[token]
+                return None
+
+            return self._seeds[token].get(seed_file)
+
+    def remove(self, name):
+        token = self.token(name)
+        with self._lock:
+            self._seeds.pop(token, None)
+            try:
+                os.remove(os.path.join(self._seed_dir, token))
+            except FileNotFoundError:
+                pass
+
+
+class _SeedHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'vmup-seed'
+
+    def log_message(self, fmt, *args):
+        LOG.debug(fmt % args)
+
+    def do_GET(self):
+        token, _, seed_file = self.path.strip('/').partition('/')
+        body = None
+        if seed_file in _SEED_FILES:
+            body = self.server.store.get(token, seed_file)
+
+        if body is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SeedServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, advertise=None):
+        # NB: the seed URLs end up in the guests, so they need an address
+        #     the guests can actually reach, which a wildcard bind isn't
+        if advertise is None:
+            if address[0] in WILDCARD_ADDRESSES:
+                raise ValueError("Seed server bound to '%s' needs an "
+                                 "address to advertise to the VMs"
+                                 % address[0])
+
+            advertise = address[0]
+
+        super(SeedServer, self).__init__(address, _SeedHandler)
+        self.store = store
+        self.advertise = advertise
+
+    def url(self, name):
+        # where the VM with the given name should get its seed from
+        host = self.advertise
+        if ':' in host:
+            host = '[%s]' % host
+
+        port = self.server_address[1]
+        return 'http://%s:%s/%s/' % (host, port, self.store.token(name))
+
+    def start(self):
+        global _ACTIVE
+
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='seed-server', daemon=True)
+        thread.start()
+        _ACTIVE = self
+        return thread
+
+
+def active_server():
+    return _ACTIVE
+
+
+def remove_seed(name, secret_path=SECRET_PATH, seed_dir=SEED_DIR):
+    # drop the VM's seed, if it has one, without setting up a store (and
+    # its secret and seed dir) just for that
+    if _ACTIVE is not None:
+        _ACTIVE.store.remove(name)
+        return
+
+    try:
+        with open(os.path.expanduser(secret_path), 'rb') as secret_file:
+            secret = secret_file.read()
+    except FileNotFoundError:
+        return
+
+    seed_path = os.path.join(os.path.expanduser(seed_dir),
+                             _token(secret, name))
+    if os.path.exists(seed_path):
+        os.remove(seed_path)
@@ -18,6 +18,29 @@ def _from_dict():
     return mp.Custom(_loads, _dumps)
 
 
+def _entries():
+    # <entry name="key">value</entry>, as a dict
+    def _loads(elem):
+        return {entry.get('name'): entry.text
+                for entry in elem.findall('entry')}
+
+    def _dumps(val, elem):
+        if val is None:
+            return None
+
+        for entry in elem.findall('entry'):
+            elem.remove(entry)
+
+        for name, text in val.items():
+            entry = elem.makeelement('entry', {'name': name})
+            entry.text = text
+            elem.append(entry)
+
+        return elem
+
+    return mp.Custom(_loads, _dumps)
+
+
 def _optional_tag_with_attr(attr):
     def _loads(elem):
         return elem.get(attr)
@@ -67,6 +90,9 @@ class Disk(mp.Model):
     device_type = mp.ROOT % _split_loader('type', 'device')
 
     driver = mp.ROOT.driver % _split_loader('name', 'type')
+    cache = mp.ROOT.driver['cache']
+    io_mode = mp.ROOT.driver['io']
+    discard = mp.ROOT.driver['discard']
     source_file = mp.ROOT.source['file']
     source_vol = mp.ROOT.source % _split_loader('pool', 'volume')
     target = mp.ROOT.target % _split_loader('bus', 'dev')
@@ -100,6 +126,22 @@ class Interface(mp.Model):
     mac_address = mp.ROOT.mac['address']
     model_type = mp.ROOT.model['type']
 
+    driver_name = mp.ROOT.driver['name']
+    queues = mp.ROOT.driver['queues'] % (int, _none_str)
+    rx_queue_size = mp.ROOT.driver['rx_queue_size'] % (int, _none_str)
+    tx_queue_size = mp.ROOT.driver['tx_queue_size'] % (int, _none_str)
+    host_offloads = mp.ROOT.driver.host % _from_dict()
+    guest_offloads = mp.ROOT.driver.guest % _from_dict()
+
+    mtu = mp.ROOT.mtu['size'] % (int, _none_str)
+
+
+class Channel(mp.Model):
+    ROOT_ELEM = 'channel'
+
+    channel_type = mp.ROOT['type']
+    target = mp.ROOT.target % _split_loader('type', 'name')
+
 
 class Domain(mp.Model):
     ROOT_ELEM = 'domain'
@@ -109,9 +151,29 @@ class Domain(mp.Model):
     memory = mp.ROOT.memory % _unit_loader()
     cpus = mp.ROOT.vcpu
 
+    share_pages = mp.ROOT.memoryBacking.nosharepages % mp.Custom(
+        lambda elem: not xh.load_presence(elem),
+        lambda val, elem: xh.dump_presence(not val, elem))
+    memory_discard = mp.ROOT.memoryBacking.discard % mp.Custom(
+        xh.load_presence, xh.dump_presence)
+
+    balloon_model = mp.ROOT.devices.memballoon['model']
+    balloon_autodeflate = mp.ROOT.devices.memballoon['autodeflate']
+    free_page_reporting = mp.ROOT.devices.memballoon['freePageReporting']
+    balloon_stats_period = mp.ROOT.devices.memballoon.stats['period'] % (
+        int, _none_str)
+
     disks = mp.ROOT.devices[...].disk % Disk
     filesystems = mp.ROOT.devices[...].filesystem % Filesystem
     interfaces = mp.ROOT.devices[...].interface % Interface
+    channels = mp.ROOT.devices[...].channel % Channel
+
+    smbios_mode = mp.ROOT.os.smbios['mode']
+    kernel = mp.ROOT.os.kernel
+    initrd = mp.ROOT.os.initrd
+    kernel_cmdline = mp.ROOT.os.cmdline
+    sysinfo_type = mp.ROOT.sysinfo['type']
+    system_info = mp.ROOT.sysinfo.system % _entries()
 
 
 class VolumeTarget(mp.Model):
@@ -0,0 +1,358 @@
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import libvirt
+
+from vmup import agent
+from vmup import builder
+from vmup import disk as disk_helper
+from vmup import virxml as vx
+
+LOG = logging.getLogger(__name__)
+
+SPARE_PREFIX = 'vmup-warm-'
+
+# defined: disk created and domain defined, but never booted
+# paused: booted through base cloud-init, then paused in memory
+# saved: booted through base cloud-init, then managed-saved to disk
+MODES = ('defined', 'paused', 'saved')
+
+SpareClass = collections.namedtuple('SpareClass', ['name', 'count',
+                                                   'base_image', 'size',
+                                                   'memory', 'cpus', 'mode'])
+
+# what a claim can't change about a spare (see _shape): everything but
+# its name, size, disks and channels
+_SHAPE_SKIP = ('name', 'title', 'description', 'memory', 'currentMemory',
+               'vcpu', 'devices/disk', 'devices/channel')
+
+# once the seed has been swapped out, this makes cloud-init treat
+# the spare as a brand new instance
+_RERUN_CLOUD_INIT = ('cloud-init clean --logs && cloud-init init --local && '
+                     'cloud-init init && '
+                     'cloud-init modules --mode=config && '
+                     'cloud-init modules --mode=final')
+
+
+def parse_class(spec):
+    # NAME=COUNT[:IMAGE[:SIZE[:MEMORY[:CPUS[:MODE]]]]]
+    name, _, rest = spec.partition('=')
+    parts = rest.split(':')
+    if not name or not parts[0].isdigit():
+        raise ValueError("Invalid warm pool class '%s'" % spec)
+
+    defaults = ['fedora', '20 GiB', '3 GiB', '2', 'defined']
+    for i, part in enumerate(parts[1:]):
+        if part:
+            defaults[i] = part
+
+    base_image, size, memory, cpus, mode = defaults
+    if mode not in MODES:
+        raise ValueError("Unknown warm pool mode '%s'" % mode)
+
+    return SpareClass(name, int(parts[0]), base_image,
+                      disk_helper.normalize_size(size),
+                      disk_helper.normalize_size(memory), int(cpus), mode)
+
+
+class WarmPool(object):
+    def __init__(self, conn_uri=None, image_dir='POOL:default',
+                 stats_path='~/.cache/vmup/warm-pool.json',
+                 template='.vmup.template.xml'):
+        self._conn_uri = conn_uri
+        self._image_dir = image_dir
+        self._stats_path = os.path.expanduser(stats_path)
+
+        # NB: resolve this now, since the working directory may change
+        #     under a background refill (e.g. in vmupd)
+        self._template = os.path.abspath(template)
+
+    @property
+    def _conn(self):
+        return builder.get_connection(self._conn_uri)
+
+    def spares(self, cls_name):
+        # NB: claimed spares that were already running keep their names
+        #     (see _claim_booted), so skip the ones marked as claimed
+        prefix = '%s%s-' % (SPARE_PREFIX, cls_name)
+        return [dom for dom in self._conn.listAllDomains()
+                if dom.name().startswith(prefix) and
+                builder.domain_metadata(dom).get('claimed') is None]
+
+    def fill(self, cls):
+        missing = cls.count - len(self.spares(cls.name))
+        for _ in range(missing):
+            self._make_spare(cls)
+
+        return max(missing, 0)
+
+    def claim(self, vm, cls_name, size, base_image):
+        # Returns True if a spare was taken over (and started) as the
+        # given VM, or False if the VM should be provisioned as usual.
+        # Only spares of the same shape, main disk size, and base image
+        # count, so VMs that need anything more never get one.
+        start = time.time()
+
+        try:
+            builder.lookup_domain(vm._conn, vm.name)
+            LOG.debug("VM '%s' already exists, not using the warm pool" %
+                      vm.name)
+            return False
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+
+        # NB: the spare gets marked as ours before letting go of the lock,
+        #     so that concurrent claims (e.g. from vmupd and a --no-daemon
+        #     run) never pick the same one
+        with self._claim_lock(cls_name):
+            dom = next((d for d in self.spares(cls_name)
+                        if self._usable(vm, d, size, base_image)), None)
+            if dom is not None:
+                spare_name = dom.name()
+                booted = dom.isActive() or dom.hasManagedSaveImage()
+                if booted:
+                    vm._update_metadata(dom, claimed=vm.name)
+                else:
+                    dom.rename(vm.name, 0)
+
+        if dom is None:
+            LOG.info("No usable spares in warm pool class '%s'" % cls_name)
+            self._record(hit=False)
+            return False
+
+        if booted:
+            self._claim_booted(vm, dom)
+        else:
+            self._claim_defined(vm, dom, spare_name)
+
+        self._record(hit=True, latency=time.time() - start)
+        return True
+
+    def stats(self):
+        try:
+            with open(self._stats_path) as stats_file:
+                return json.load(stats_file)
+        except FileNotFoundError:
+            return {'hits': 0, 'misses': 0, 'latencies': []}
+
+    @contextlib.contextmanager
+    def _lock(self, name):
+        lock_path = '%s.%s.lock' % (os.path.splitext(self._stats_path)[0],
+                                    name)
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _claim_lock(self, cls_name):
+        return self._lock('claim-%s' % cls_name)
+
+    def start_refill(self, classes, interval=60):
+        def _refill():
+            while True:
+                for cls in classes:
+                    try:
+                        made = self.fill(cls)
+                        if made:
+                            LOG.info("Added %s spare(s) to warm pool "
+                                     "class '%s'" % (made, cls.name))
+                    except Exception:
+                        LOG.exception("Unable to refill warm pool class "
+                                      "'%s'" % cls.name)
+
+                time.sleep(interval)
+
+        thread = threading.Thread(target=_refill, name='warm-pool-refill',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _make_spare(self, cls):
+        name = '%s%s-%s' % (SPARE_PREFIX, cls.name, os.urandom(3).hex())
+        LOG.debug("Creating warm pool spare '%s'..." % name)
+
+        vm = builder.VM(name, image_dir=self._image_dir,
+                        conn_uri=self._conn_uri, template=self._template)
+        vm.memory = cls.memory
+        vm.cpus = cls.cpus
+        vm.configure_memory()
+
+        backing_file = vm.fetch_base_image(cls.base_image)
+        vm.provision_disk('main', cls.size, backing_file)
+
+        vm.configure_user(password_hash=None)
+        vm.configure_networking('default')
+
+        if cls.mode != 'defined':
+            # claiming a booted spare needs the agent to re-run cloud-init
+            vm.add_agent_channel()
+            vm.install_package('qemu-guest-agent')
+            vm.run_command(['systemctl', 'start', 'qemu-guest-agent'])
+
+        vm.finalize(recreate_ci=True)
+        vm.launch(start=(cls.mode != 'defined'))
+
+        # claims check these against the requested VM (see _usable)
+        dom = vm._lookup_domain()
+        vm._update_metadata(dom, base_image=cls.base_image,
+                            shape=self._shape(vm))
+
+        if cls.mode == 'defined':
+            return
+
+        agent.wait_for_cloud_init(dom)
+
+        if cls.mode == 'paused':
+            dom.suspend()
+        else:
+            dom.managedSave()
+
+    def _shape(self, vm):
+        return vm.config_digest(skip=_SHAPE_SKIP)
+
+    def _usable(self, vm, dom, size, base_image):
+        spare_name = dom.name()
+        meta = builder.domain_metadata(dom)
+        spare = vx.Domain(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        booted = dom.isActive() or dom.hasManagedSaveImage()
+
+        if vm._seed_server is not None:
+            # the spare's seed is an ISO, which can't be switched over to
+            # one served over HTTP
+            return False
+
+        if vm._ipam is not None and booted:
+            # the spare already got its address from DHCP
+            LOG.debug("Spare '%s' is already running with an address of "
+                      "its own" % spare_name)
+            return False
+
+        # NB: spares from before these were recorded can't be checked,
+        #     so they never match
+        if (meta.get('base_image') != base_image or
+                meta.get('shape') != self._shape(vm)):
+            LOG.debug("Spare '%s' is configured differently than '%s'" %
+                      (spare_name, vm.name))
+            return False
+
+        if (disk_helper.size_to_bytes(spare.memory) !=
+                disk_helper.size_to_bytes(vm.memory) or
+                int(spare.cpus) != int(vm.cpus)):
+            LOG.debug("Spare '%s' has a different size than '%s'" %
+                      (spare_name, vm.name))
+            return False
+
+        targets = set(c.target for c in spare.channels)
+        if any(c.target not in targets for c in vm.channels):
+            LOG.debug("Spare '%s' lacks channels '%s' needs" %
+                      (spare_name, vm.name))
+            return False
+
+        disk_name = '%s-main.qcow2' % spare_name
+        if vm._img_loc_type == 'pool':
+            vm._img_loc.refresh()
+            spare_size = vm._img_loc.storageVolLookupByName(
+                disk_name).info()[1]
+        else:
+            spare_size = disk_helper.image_info(
+                os.path.join(vm._img_loc, disk_name))['virtual-size']
+
+        if spare_size != disk_helper.size_to_bytes(size):
+            LOG.debug("Spare '%s' has a different disk size than '%s'" %
+                      (spare_name, vm.name))
+            return False
+
+        return True
+
+    def _swap_seed(self, vm, dom, spare, flags):
+        # replace the spare's seed with the claimed VM's own, in place
+        vm.finalize(recreate_ci=True)
+        seed = vm.disks[-1]
+        seed.target = next(d.target for d in spare.disks
+                           if d.device_type.endswith(':cdrom'))
+        dom.updateDeviceFlags(seed.to_xml(encoding=str), flags)
+        vm.record_seed_digest(dom)
+
+    def _claim_defined(self, vm, dom, spare_name):
+        # NB: the spare keeps its definition (already renamed by claim),
+        #     disks, and MACs, so reserve the VM's addresses for those
+        spare = vx.Domain(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        self._swap_seed(vm, dom, spare, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        self._remove_seed(vm, spare_name)
+
+        if vm._ipam is not None:
+            for mine, theirs in zip(vm.interfaces, spare.interfaces):
+                vm._ipam.reassign(mine.mac_address, theirs.mac_address)
+            vm._ipam.commit()
+
+        LOG.info("Claimed warm pool spare '%s' for '%s'" %
+                 (spare_name, vm.name))
+
+        LOG.info("Launching VM...")
+        dom.create()
+        if vm.ip_address is not None:
+            LOG.info("Launched VM at %s!" % vm.ip_address)
+        else:
+            LOG.info("Launched VM!")
+
+    def _claim_booted(self, vm, dom):
+        spare = vx.Domain(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+
+        if dom.hasManagedSaveImage():
+            dom.create()
+        elif dom.info()[0] == libvirt.VIR_DOMAIN_PAUSED:
+            dom.resume()
+
+        self._swap_seed(vm, dom, spare,
+                        libvirt.VIR_DOMAIN_AFFECT_LIVE |
+                        libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+        # NB: running domains can't be renamed, so the domain keeps its
+        #     name, and the claimed name goes in the title (and in our
+        #     metadata, for builder.lookup_domain and spares) instead
+        dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_TITLE, vm.name,
+                        None, None,
+                        libvirt.VIR_DOMAIN_AFFECT_LIVE |
+                        libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+        agent.run(dom, ['sh', '-c', _RERUN_CLOUD_INIT], wait=False)
+
+        LOG.info("Claimed running warm pool spare '%s' for '%s'" %
+                 (dom.name(), vm.name))
+
+    def _remove_seed(self, vm, spare_name):
+        seed_name = '%s-cidata.iso' % spare_name
+        if vm._img_loc_type == 'pool':
+            try:
+                vm._img_loc.storageVolLookupByName(seed_name).delete()
+            except libvirt.libvirtError as ex:
+                if ex.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                    raise
+        else:
+            seed_path = os.path.join(vm._img_loc, seed_name)
+            if os.path.exists(seed_path):
+                os.remove(seed_path)
+
+    def _record(self, hit, latency=None):
+        # NB: claims can happen concurrently, so this has to be a locked
+        #     read-modify-write, with the new stats renamed into place
+        with self._lock('stats'):
+            stats = self.stats()
+            if hit:
+                stats['hits'] += 1
+                stats['latencies'] = (stats['latencies'] +
+                                      [latency])[-100:]
+            else:
+                stats['misses'] += 1
+
+            tmp_path = '%s.tmp-%s' % (self._stats_path, os.getpid())
+            with open(tmp_path, 'w') as stats_file:
+                json.dump(stats, stats_file)
+            os.rename(tmp_path, self._stats_path)
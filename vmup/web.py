@@ -0,0 +1,102 @@
+from concurrent import futures
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+from requests import adapters
+
+LOG = logging.getLogger(__name__)
+
+# (connect, read) timeouts, in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+CACHE_DIR = '~/.cache/vmup/http'
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def session():
+    # a single session means connections get reused across requests
+    # (and across requests in vmupd)
+    global _SESSION
+
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = adapters.HTTPAdapter(pool_connections=8,
+                                           pool_maxsize=16, max_retries=2)
+            _SESSION.mount('http://', adapter)
+            _SESSION.mount('https://', adapter)
+
+    return _SESSION
+
+
+def _write_atomic(path, content, mode='w'):
+    tmp_path = '%s.tmp-%s' % (path, threading.get_ident())
+    with open(tmp_path, mode) as out:
+        out.write(content)
+
+    os.rename(tmp_path, path)
+
+
+def get_cached(url, cache_dir=CACHE_DIR, timeout=DEFAULT_TIMEOUT):
+    # fetch the given URL as text, revalidating any cached copy with
+    # its ETag or Last-Modified instead of downloading it again
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key = hashlib.sha256(url.encode()).hexdigest()
+    body_path = os.path.join(cache_dir, key)
+    meta_path = body_path + '.json'
+
+    meta = {}
+    if os.path.exists(meta_path) and os.path.exists(body_path):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        resp = session().get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as ex:
+        if not meta:
+            raise
+
+        LOG.warning("Unable to revalidate '%s' (%s), using the cached "
+                    "copy" % (url, ex))
+        resp = None
+
+    if resp is None or resp.status_code == 304:
+        LOG.debug("Using cached copy of '%s'" % url)
+        with open(body_path) as body_file:
+            return body_file.read()
+
+    resp.raise_for_status()
+
+    _write_atomic(body_path, resp.text)
+    _write_atomic(meta_path, json.dumps({
+        'url': url,
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+    }))
+
+    return resp.text
+
+
+def get_all_cached(urls, max_workers=8, **kwargs):
+    # fetch all the given URLs at once, returning their text in order
+    if not urls:
+        return []
+
+    workers = min(max_workers, len(urls))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda url: get_cached(url, **kwargs),
+                                 urls))
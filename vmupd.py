@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+
+from vmup import daemon
+
+
+daemon.main()